@@ -29,35 +29,252 @@ def _add_path(path):
 _add_path(_hooks)
 
 
-import subprocess
+import json
+
 from charmhelpers.core import hookenv
 
-SYSFS = '/sys'
+import nova_compute_hugepages as hugepages
+
 KERNELCMD = '/proc/cmdline'
+MEMINFO = '/proc/meminfo'
+# /proc/meminfo fields on the default huge page size pool
+MEMINFO_POOL_FIELDS = {
+    'total': 'HugePages_Total',
+    'free': 'HugePages_Free',
+    'reserved': 'HugePages_Rsvd',
+    'surplus': 'HugePages_Surp',
+}
+
+
+def read_meminfo():
+    """Fields of /proc/meminfo, in kB for those with a unit.
+
+    :rtype: Dict[str, int]
+    """
+    meminfo = {}
+    with open(MEMINFO) as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            try:
+                meminfo[name.strip()] = int(value.split()[0])
+            except (IndexError, ValueError):
+                continue
+    return meminfo
+
+
+def parse_cmdline(cmdline):
+    """Huge pages allocated on the kernel command line.
+
+    hugepages= applies to the size of the preceding hugepagesz=, or to the
+    default size, and is either a number of pages or per node numbers, e.g.
+    hugepages=0:8,1:8.
+
+    :param cmdline: the kernel command line
+    :type cmdline: str
+    :returns: default page size in kB if set and {size_kb: {'total': n,
+              'nodes': {node: n}}}
+    :rtype: Tuple[Optional[int], Dict[int, Dict[str, Any]]]
+    """
+    default_size_kb = None
+    allocations = []
+    size_kb = None
+    for param in cmdline.split():
+        name, _, value = param.partition('=')
+        try:
+            if name == 'default_hugepagesz':
+                default_size_kb = hugepages.page_size_kb(value)
+            elif name == 'hugepagesz':
+                size_kb = hugepages.page_size_kb(value)
+            elif name == 'hugepages':
+                nodes = {}
+                if ':' in value:
+                    for node_pages in value.split(','):
+                        node, _, count = node_pages.partition(':')
+                        nodes[int(node)] = int(count)
+                    total = sum(nodes.values())
+                else:
+                    total = int(value)
+                allocations.append((size_kb, total, nodes))
+                size_kb = None
+        except ValueError:
+            hookenv.log('Ignoring kernel parameter {}'.format(param),
+                        level=hookenv.WARNING)
+    sizes = {}
+    for size_kb, total, nodes in allocations:
+        size_kb = size_kb or default_size_kb or hugepages.page_size_kb(
+            hugepages.DEFAULT_PAGE_SIZE)
+        sizes[size_kb] = {'total': total, 'nodes': nodes}
+    return default_size_kb, sizes
+
+
+def planned_hugepages(value, meminfo):
+    """Huge pages the charm allocates according to the hugepages option.
+
+    :param value: the hugepages option
+    :type value: Optional[str]
+    :param meminfo: from read_meminfo
+    :type meminfo: Dict[str, int]
+    :returns: {size_kb: {'total': n, 'nodes': {node: n}}}
+    :rtype: Dict[int, Dict[str, Any]]
+    """
+    sizes = {}
+    if hugepages.is_hugepage_plan(value):
+        try:
+            plan = hugepages.plan_hugepages(value)
+        except ValueError as e:
+            hookenv.log('Invalid hugepages plan: {}'.format(e),
+                        level=hookenv.WARNING)
+            return sizes
+        for allocation in plan:
+            size = sizes.setdefault(allocation.size_kb,
+                                    {'total': 0, 'nodes': {}})
+            size['total'] += allocation.count
+            size['nodes'][allocation.node] = allocation.count
+    elif value:
+        # NOTE: 2M pages as computed by get_hugepage_number
+        size_kb = hugepages.page_size_kb(hugepages.DEFAULT_PAGE_SIZE)
+        try:
+            if value.endswith('%'):
+                total = int(meminfo.get('MemTotal', 0) *
+                            float(value.strip('%')) / 100 / size_kb)
+            else:
+                total = int(value)
+        except ValueError:
+            hookenv.log('Invalid hugepages option: {}'.format(value),
+                        level=hookenv.WARNING)
+            return sizes
+        sizes[size_kb] = {'total': total, 'nodes': {}}
+    return sizes
+
+
+def _usage(pool):
+    """Add the used pages and percentage to a pool."""
+    pool = dict(pool)
+    pool['used'] = pool.get('total', 0) - pool.get('free', 0)
+    pool['used_percent'] = (round(100.0 * pool['used'] / pool['total'], 2)
+                            if pool.get('total') else 0.0)
+    return pool
+
+
+def _expected(planned, cmdline, size_kb, node=None):
+    """Pages expected in a pool, from the charm or else the command line."""
+    for source in (planned, cmdline):
+        if size_kb not in source:
+            continue
+        if node is None:
+            return source[size_kb]['total']
+        if node in source[size_kb]['nodes']:
+            return source[size_kb]['nodes'][node]
+    return None
+
+
+def _pool_key(size_kb):
+    return '{}kB'.format(size_kb)
+
+
+def build_report(cmdline, meminfo, hugepages_option):
+    """Report the huge page pools and check them against their sources.
+
+    :param cmdline: the kernel command line
+    :type cmdline: str
+    :param meminfo: from read_meminfo
+    :type meminfo: Dict[str, int]
+    :param hugepages_option: the hugepages option
+    :type hugepages_option: Optional[str]
+    :rtype: Dict[str, Any]
+    """
+    default_size_kb, cmdline_sizes = parse_cmdline(cmdline)
+    planned = planned_hugepages(hugepages_option, meminfo)
+    pools = hugepages.hugepage_pools()
+    node_pools = hugepages.node_hugepage_pools()
+    mismatches = []
+
+    sizes = {}
+    for size_kb, pool in sorted(pools.items()):
+        pool = _usage(pool)
+        expected = _expected(planned, cmdline_sizes, size_kb)
+        pool['expected'] = expected
+        pool['gap'] = expected - pool['total'] if expected is not None else 0
+        for attribute in ('total', 'surplus'):
+            node_sum = sum(p.get(size_kb, {}).get(attribute, 0)
+                           for p in node_pools.values())
+            if node_pools and node_sum != pool.get(attribute):
+                mismatches.append(
+                    '{} {} pages: {} in nodes, {} in total'.format(
+                        _pool_key(size_kb), attribute, node_sum,
+                        pool.get(attribute)))
+        sizes[_pool_key(size_kb)] = pool
+
+    nodes = {}
+    for node, node_sizes in sorted(node_pools.items()):
+        nodes[str(node)] = node_report = {}
+        for size_kb, pool in sorted(node_sizes.items()):
+            pool = _usage(pool)
+            expected = _expected(planned, cmdline_sizes, size_kb, node)
+            pool['expected'] = expected
+            pool['gap'] = (expected - pool['total']
+                           if expected is not None else 0)
+            node_report[_pool_key(size_kb)] = pool
+
+    meminfo_size_kb = meminfo.get('Hugepagesize')
+    meminfo_pool = dict((attribute, meminfo.get(field))
+                        for attribute, field in MEMINFO_POOL_FIELDS.items())
+    if meminfo_size_kb in pools:
+        for attribute, value in meminfo_pool.items():
+            if pools[meminfo_size_kb].get(attribute) != value:
+                mismatches.append(
+                    '{} {} pages: {} in sysfs, {} in {}'.format(
+                        _pool_key(meminfo_size_kb), attribute,
+                        pools[meminfo_size_kb].get(attribute), value,
+                        MEMINFO))
+    if 'Hugetlb' in meminfo:
+        sysfs_kb = sum(size_kb * pool.get('total', 0)
+                       for size_kb, pool in pools.items())
+        if sysfs_kb != meminfo['Hugetlb']:
+            mismatches.append(
+                'huge page memory: {}kB in sysfs, {}kB in {}'.format(
+                    sysfs_kb, meminfo['Hugetlb'], MEMINFO))
+    if default_size_kb and meminfo_size_kb and \
+            default_size_kb != meminfo_size_kb:
+        mismatches.append(
+            'default huge page size: {}kB on the kernel command line, '
+            '{}kB in {}'.format(default_size_kb, meminfo_size_kb, MEMINFO))
+
+    return {
+        'sizes': sizes,
+        'nodes': nodes,
+        'meminfo': dict(meminfo_pool, size_kb=meminfo_size_kb,
+                        hugetlb_kb=meminfo.get('Hugetlb')),
+        'kernel_cmdline': {
+            'default_size_kb': default_size_kb,
+            'sizes': dict((_pool_key(k), v)
+                          for k, v in cmdline_sizes.items()),
+        },
+        'planned': dict((_pool_key(k), v) for k, v in planned.items()),
+        'consistent': not mismatches,
+        'mismatches': mismatches,
+    }
 
 
 def hugepages_report():
-    '''Action to return current hugepage usage and kernel cmdline for static
-    hugepage allocation. Takes no params.
-    '''
-    outmap = {}
+    """Action to report the huge page pools, per page size and NUMA node.
+
+    The report is returned as JSON, with the pages planned by the charm or
+    allocated on the kernel command line and any inconsistency between
+    sysfs and /proc/meminfo.  Takes no params.
+    """
     try:
-        devp = "{}/devices/system/node/node*/hugepages/*/*".format(SYSFS)
-        outmap['hugepagestats'] = subprocess.check_output(
-            "grep -H . {}".format(devp),
-            shell=True).decode('UTF-8')
-    except subprocess.CalledProcessError as e:
-        hookenv.log(e)
-        hookenv.action_fail(
-            "Getting hugepages report failed: {}".format(e.message)
-        )
-    with open(KERNELCMD, 'rb') as cmdline:
-        try:
-            outmap['kernelcmd'] = cmdline.read().strip()
-        except IOError as e:
-            hookenv.action_fail('Could not read {}: {}'.format(KERNELCMD, e))
-            return
-    hookenv.action_set(outmap)
+        with open(KERNELCMD) as f:
+            cmdline = f.read().strip()
+        meminfo = read_meminfo()
+    except (IOError, OSError) as e:
+        hookenv.action_fail('Getting hugepages report failed: {}'.format(e))
+        return
+    report = build_report(cmdline, meminfo, hookenv.config('hugepages'))
+    hookenv.action_set({
+        'report': json.dumps(report, sort_keys=True),
+        'kernelcmd': cmdline,
+    })
 
 
 if __name__ == '__main__':
@@ -43,6 +43,7 @@ from nova_compute_hooks import (
     neutron_plugin_joined,
     nova_ceilometer_joined,
     nova_vgpu_joined,
+    request_full_config_changed,
 )
 
 
@@ -68,6 +69,7 @@ def package_upgrade():
             nova_vgpu_joined(rid, remote_restart=True)
         # NOTE(ajkavanagh) - if unit is paused (usually true for managed
         # upgrade) then the config_changed() function is a no-op
+        request_full_config_changed()
         config_changed()
 
 
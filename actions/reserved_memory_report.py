@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+#
+# Copyright 2024 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+
+_path = os.path.dirname(os.path.realpath(__file__))
+_hooks = os.path.abspath(os.path.join(_path, '../hooks'))
+
+
+def _add_path(path):
+    if path not in sys.path:
+        sys.path.insert(1, path)
+
+
+_add_path(_hooks)
+
+
+import json
+
+from charmhelpers.core import hookenv
+from charmhelpers.core.unitdata import kv
+
+import nova_compute_memory as memory
+
+
+def reserved_memory_report():
+    """Action to report the memory to reserve for the host, by use.
+
+    The breakdown is computed from the current state of the host whether or
+    not reserved-host-memory-auto is set.  Takes no params.
+    """
+    breakdown = memory.memory_breakdown()
+    configured = hookenv.config('reserved-host-memory')
+    if hookenv.config('reserved-host-memory-auto'):
+        configured = kv().get(memory.RESERVED_HOST_MEMORY_KEY, configured)
+    hookenv.action_set({
+        'breakdown': json.dumps(breakdown),
+        'recommended': memory.recommended_reserved_host_memory(breakdown),
+        'configured': configured,
+    })
+
+
+if __name__ == '__main__':
+    reserved_memory_report()
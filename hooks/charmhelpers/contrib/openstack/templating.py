@@ -12,11 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import json
 import os
+import types
+from contextlib import contextmanager
 
+from charmhelpers.core import profiler
 from charmhelpers.fetch import apt_install, apt_update
 from charmhelpers.core.hookenv import (
     log,
+    prefetch_relations,
+    DEBUG,
     ERROR,
     INFO,
     TRACE
@@ -35,6 +42,51 @@ class OSConfigException(Exception):
     pass
 
 
+def _write_if_changed(path, content):
+    """Atomically replace the file at path with content unless it is already
+    identical.
+
+    The content is written to a temporary file in the same directory, which
+    then takes the place of the original with a rename, so readers never see
+    a partially written file.  The mode and ownership of an existing file are
+    preserved and symlinks are followed.
+
+    :param path: the file to write
+    :type path: str
+    :param content: the new file content
+    :type content: bytes
+    :returns: True if the file was written, False if it was unchanged
+    :rtype: bool
+    """
+    path = os.path.realpath(path)
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == content:
+                return False
+        st = os.stat(path)
+    except FileNotFoundError:
+        st = None
+
+    tmp_path = os.path.join(
+        os.path.dirname(path),
+        '.{}.{}.tmp'.format(os.path.basename(path), os.getpid()))
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(content)
+            if st is not None:
+                os.fchmod(out.fileno(), st.st_mode & 0o7777)
+                tmp_st = os.fstat(out.fileno())
+                if (tmp_st.st_uid, tmp_st.st_gid) != (st.st_uid, st.st_gid):
+                    os.fchown(out.fileno(), st.st_uid, st.st_gid)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return True
+
+
 def get_loader(templates_dir, os_release):
     """
     Create a jinja2.ChoiceLoader containing template dirs up to
@@ -83,6 +135,80 @@ def get_loader(templates_dir, os_release):
     return ChoiceLoader(loaders)
 
 
+def _call_context(context):
+    """Call a context generator, recording it in the hook profile."""
+    name = (getattr(context, '__qualname__', None) or
+            type(context).__name__)
+    with profiler.phase('contexts', name):
+        return context()
+
+
+class ContextCache(object):
+    """
+    Memoizes the results of context generators during a single render pass,
+    so that a context registered for several config files is only evaluated
+    once.
+
+    Context generator instances are keyed on their class and their instance
+    attributes, i.e. the arguments they were constructed with, so separate
+    but equivalent instances share one result.  The state a generator records
+    about its last evaluation ('complete', 'missing_data' and 'related') is
+    copied onto instances served from the cache.  Plain functions are keyed
+    on their identity.
+    """
+    STATE_ATTRS = ('complete', 'missing_data', 'related')
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._keys = {}
+        self._results = {}
+
+    def _key(self, context):
+        # NOTE: the context is kept along with its key so that its id is not
+        # reused by another object while the cache is alive.
+        try:
+            return self._keys[id(context)][1]
+        except KeyError:
+            pass
+        if isinstance(context, (types.FunctionType, types.MethodType)):
+            key = (id(context),)
+        else:
+            args = {k: v for k, v in vars(context).items()
+                    if k not in self.STATE_ATTRS}
+            key = (type(context), json.dumps(
+                args, sort_keys=True,
+                default=lambda o: getattr(o, '__qualname__', None) or str(o)))
+        self._keys[id(context)] = (context, key)
+        return key
+
+    def __call__(self, context):
+        """Evaluate context, or return its result from earlier in the pass.
+
+        :param context: the context generator
+        :type context: Callable[[], Dict[str, Any]]
+        :returns: the generated context
+        :rtype: Dict[str, Any]
+        """
+        key = self._key(context)
+        try:
+            result, state = self._results[key]
+        except KeyError:
+            self.misses += 1
+            result, state = self._results[key] = self._evaluate(context)
+            return copy.copy(result)
+        self.hits += 1
+        for attr, value in state.items():
+            setattr(context, attr, value)
+        return copy.copy(result)
+
+    def _evaluate(self, context):
+        result = _call_context(context)
+        state = {attr: getattr(context, attr)
+                 for attr in self.STATE_ATTRS if hasattr(context, attr)}
+        return result, state
+
+
 class OSConfigTemplate(object):
     """
     Associates a config file template with a list of context generators.
@@ -101,10 +227,17 @@ class OSConfigTemplate(object):
 
         self.config_template = config_template
 
-    def context(self):
+    def context(self, cache=None):
+        """Generate the template context from the context generators.
+
+        :param cache: optional cache for the generator results
+        :type cache: Optional[ContextCache]
+        :returns: the template context
+        :rtype: Dict[str, Any]
+        """
         ctxt = {}
         for context in self.contexts:
-            _ctxt = context()
+            _ctxt = cache(context) if cache else _call_context(context)
             if _ctxt:
                 ctxt.update(_ctxt)
                 # track interfaces for every complete context.
@@ -113,13 +246,13 @@ class OSConfigTemplate(object):
                  if interface not in self._complete_contexts]
         return ctxt
 
-    def complete_contexts(self):
+    def complete_contexts(self, cache=None):
         '''
         Return a list of interfaces that have satisfied contexts.
         '''
         if self._complete_contexts:
             return self._complete_contexts
-        self.context()
+        self.context(cache=cache)
         return self._complete_contexts
 
     @property
@@ -205,7 +338,8 @@ class OSConfigRenderer(object):
     generates are called in a chain to generate the context dictionary
     passed to the jinja2 template. See context.py for more info.
     """
-    def __init__(self, templates_dir, openstack_release):
+    def __init__(self, templates_dir, openstack_release,
+                 prefetch_relations=False):
         if not os.path.isdir(templates_dir):
             log('Could not locate templates dir %s' % templates_dir,
                 level=ERROR)
@@ -215,6 +349,11 @@ class OSConfigRenderer(object):
         self.openstack_release = openstack_release
         self.templates = {}
         self._tmpl_env = None
+        self._context_cache = None
+        # read the relations of all registered contexts before a render pass
+        self.prefetch_relations = prefetch_relations
+        # cache of the last render pass, kept to inspect its hit/miss counters
+        self.last_context_cache = None
 
         if None in [Environment, ChoiceLoader, FileSystemLoader]:
             # if this code is running, the object is created pre-install hook.
@@ -264,13 +403,55 @@ class OSConfigRenderer(object):
             level=INFO)
         return template
 
+    @contextmanager
+    def context_cache(self):
+        """Evaluate each context generator at most once within the block.
+
+        Used by write_all() and complete_contexts(); callers rendering several
+        files individually can use it to the same effect.  Nested uses share
+        the outermost cache.  With prefetch_relations set, the relations named
+        by the registered contexts' interfaces are read up front, see
+        :func:`charmhelpers.core.hookenv.prefetch_relations`.
+
+        :returns: the cache in use
+        :rtype: ContextCache
+        """
+        if self._context_cache is not None:
+            yield self._context_cache
+            return
+        if self.prefetch_relations:
+            prefetch_relations(self.interfaces())
+        self._context_cache = ContextCache()
+        try:
+            yield self._context_cache
+        finally:
+            cache = self._context_cache
+            self._context_cache = None
+            self.last_context_cache = cache
+            log('Context cache: {} hits, {} misses'.format(
+                cache.hits, cache.misses), level=DEBUG)
+
+    def interfaces(self):
+        """
+        Returns the interfaces of all registered context generators.
+
+        :rtype: List[str]
+        """
+        interfaces = []
+        for ostmpl in self.templates.values():
+            for context in ostmpl.contexts:
+                for interface in getattr(context, 'interfaces', None) or []:
+                    if interface not in interfaces:
+                        interfaces.append(interface)
+        return interfaces
+
     def render(self, config_file):
         if config_file not in self.templates:
             log('Config not registered: {}'.format(config_file), level=ERROR)
             raise OSConfigException
 
         ostmpl = self.templates[config_file]
-        ctxt = ostmpl.context()
+        ctxt = ostmpl.context(cache=self._context_cache)
 
         if ostmpl.is_string_template:
             template = self._get_template_from_string(ostmpl)
@@ -300,11 +481,18 @@ class OSConfigRenderer(object):
 
             log('Rendering from template: {}'.format(config_file),
                 level=INFO)
-        return template.render(ctxt)
+        with profiler.phase('renders', config_file):
+            return template.render(ctxt)
 
     def write(self, config_file):
         """
         Write a single config file, raises if config file is not registered.
+
+        The file is only replaced, atomically, if the rendered content differs
+        from what is already on disk.
+
+        :returns: True if the file was written, False if it was unchanged.
+        :rtype: bool
         """
         if config_file not in self.templates:
             log('Config not registered: %s' % config_file, level=ERROR)
@@ -312,17 +500,21 @@ class OSConfigRenderer(object):
 
         _out = self.render(config_file).encode('UTF-8')
 
-        with open(config_file, 'wb') as out:
-            out.write(_out)
+        if not _write_if_changed(config_file, _out):
+            log('Template %s unchanged, not writing.' % config_file,
+                level=INFO)
+            return False
 
         log('Wrote template %s.' % config_file, level=INFO)
+        return True
 
     def write_all(self):
         """
         Write out all registered config files.
         """
-        for k in self.templates.keys():
-            self.write(k)
+        with self.context_cache():
+            for k in self.templates.keys():
+                self.write(k)
 
     def set_release(self, openstack_release):
         """
@@ -338,8 +530,9 @@ class OSConfigRenderer(object):
         Returns a list of context interfaces that yield a complete context.
         '''
         interfaces = []
-        for i in self.templates.values():
-            interfaces.extend(i.complete_contexts())
+        with self.context_cache() as cache:
+            for i in self.templates.values():
+                interfaces.extend(i.complete_contexts(cache=cache))
         return interfaces
 
     def get_incomplete_context_data(self, interfaces):
@@ -87,11 +87,13 @@ from charmhelpers.core.host import (
     mounts,
     umount,
     service_running,
+    services_running as host_services_running,
     service_pause,
     service_resume,
     service_stop,
     service_start,
     restart_on_change_helper,
+    run_service_actions,
 )
 
 from charmhelpers.fetch import (
@@ -1305,7 +1307,8 @@ def _check_running_services(services):
     @returns [(service, boolean), ...], : results for checks
              [boolean]                  : just the result of the service checks
     """
-    services_running = [service_running(s) for s in services]
+    running = host_services_running(list(services))
+    services_running = [running[s] for s in services]
     return list(zip(services, services_running)), services_running
 
 
@@ -1616,7 +1619,8 @@ def is_hook_allowed(hookname, check_deferred_restarts=True):
     return permitted, " and ".join(reasons)
 
 
-def manage_payload_services(action, services=None, charm_func=None):
+def manage_payload_services(action, services=None, charm_func=None,
+                            dependencies=None):
     """Run an action against all services.
 
     An optional charm_func() can be called. It should raise an Exception to
@@ -1640,6 +1644,11 @@ def manage_payload_services(action, services=None, charm_func=None):
     :type services: See above
     :param charm_func: function to run for custom charm pausing.
     :type charm_func: f()
+    :param dependencies: {service: [services it depends on, ...]}, to run the
+                         action concurrently for independent services,
+                         stopping dependent services first and starting them
+                         last. See charmhelpers.core.host.run_service_actions
+    :type dependencies: Optional[Dict[str, List[str]]]
     :returns: Status boolean and list of messages
     :rtype: (bool, [])
     :raises: RuntimeError
@@ -1658,8 +1667,12 @@ def manage_payload_services(action, services=None, charm_func=None):
     messages = []
     success = True
     if services:
-        for service in services.keys():
-            rc = actions[action](service)
+        results = run_service_actions(
+            list(services.keys()), actions[action],
+            dependencies=dependencies,
+            reverse=action in ('pause', 'stop'),
+            name=action)
+        for service, rc in results.items():
             if not rc:
                 success = False
                 messages.append("{} didn't {} cleanly.".format(service,
@@ -1691,7 +1704,7 @@ def make_wait_for_ports_barrier(ports, retry_count=5):
 
 
 def pause_unit(assess_status_func, services=None, ports=None,
-               charm_func=None):
+               charm_func=None, dependencies=None):
     """Pause a unit by stopping the services and setting 'unit-paused'
     in the local kv() store.
 
@@ -1717,13 +1730,15 @@ def pause_unit(assess_status_func, services=None, ports=None,
     @param services: OPTIONAL see above
     @param ports: OPTIONAL list of port
     @param charm_func: function to run for custom charm pausing.
+    @param dependencies: OPTIONAL see manage_payload_services()
     @returns None
     @raises Exception(message) on an error for action_fail().
     """
     _, messages = manage_payload_services(
         'pause',
         services=services,
-        charm_func=charm_func)
+        charm_func=charm_func,
+        dependencies=dependencies)
     set_unit_paused()
 
     if assess_status_func:
@@ -1735,7 +1750,7 @@ def pause_unit(assess_status_func, services=None, ports=None,
 
 
 def resume_unit(assess_status_func, services=None, ports=None,
-                charm_func=None):
+                charm_func=None, dependencies=None):
     """Resume a unit by starting the services and clearning 'unit-paused'
     in the local kv() store.
 
@@ -1760,13 +1775,15 @@ def resume_unit(assess_status_func, services=None, ports=None,
     @param services: OPTIONAL see above
     @param ports: OPTIONAL list of port
     @param charm_func: function to run for custom charm resuming.
+    @param dependencies: OPTIONAL see manage_payload_services()
     @returns None
     @raises Exception(message) on an error for action_fail().
     """
     _, messages = manage_payload_services(
         'resume',
         services=services,
-        charm_func=charm_func)
+        charm_func=charm_func,
+        dependencies=dependencies)
     clear_unit_paused()
     if assess_status_func:
         message = assess_status_func()
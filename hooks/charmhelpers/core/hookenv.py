@@ -17,6 +17,7 @@
 # Authors:
 #  Charm Helpers Developers <juju@lists.ubuntu.com>
 
+import atexit as _interpreter_atexit
 import copy
 try:
     from distutils.version import LooseVersion
@@ -34,9 +35,12 @@ import subprocess
 import sys
 import errno
 import tempfile
+import threading
+import time
 from subprocess import CalledProcessError
 
 from charmhelpers import deprecate
+from charmhelpers.core import profiler
 
 
 CRITICAL = "CRITICAL"
@@ -82,9 +86,13 @@ def cached(func):
         global cache
         key = json.dumps((func, args, kwargs), sort_keys=True, default=str)
         try:
-            return cache[key]
+            res = cache[key]
         except KeyError:
             pass  # Drop out of the exception handler scope.
+        else:
+            _record_cache_lookup(func, args, kwargs, True)
+            return res
+        _record_cache_lookup(func, args, kwargs, False)
         res = func(*args, **kwargs)
         cache[key] = res
         return res
@@ -92,6 +100,19 @@ def cached(func):
     return wrapper
 
 
+def _cache_store(func, value, *args, **kwargs):
+    """Store value as the cached result of the ``@cached`` func for args."""
+    key = json.dumps((func._wrapped, args, kwargs), sort_keys=True,
+                     default=str)
+    cache[key] = value
+
+
+def _is_cached(func, *args, **kwargs):
+    key = json.dumps((func._wrapped, args, kwargs), sort_keys=True,
+                     default=str)
+    return key in cache
+
+
 def flush(key):
     """Flushes any entries from function cache where the
     key is found in the function+args """
@@ -103,18 +124,260 @@ def flush(key):
         del cache[item]
 
 
+_tool_lock = threading.Lock()
+# tool -> (invocations, seconds) and cached function -> (hits, misses)
+_tool_calls = {}
+_cache_lookups = {}
+# list of invocations and cache lookups in order when tracing, else None
+_tool_trace = None
+
+
+def enable_tool_trace():
+    """Record each juju tool invocation and cache lookup with its arguments.
+
+    The arguments of tools setting data, e.g. ``relation-set``, are traced
+    with their values elided.
+    """
+    global _tool_trace
+    with _tool_lock:
+        if _tool_trace is None:
+            _tool_trace = []
+
+
+def reset_tool_invocations():
+    """Discard the recorded juju tool invocations and stop tracing."""
+    global _tool_trace
+    with _tool_lock:
+        _tool_calls.clear()
+        _cache_lookups.clear()
+        _tool_trace = None
+
+
+def tool_invocations():
+    """Summarise the juju tool invocations made by this process.
+
+    :returns: invocations and time spent per tool, hits and misses per
+              ``@cached`` function and, if enabled, the trace
+    :rtype: Dict[str, Any]
+    """
+    with _tool_lock:
+        return {
+            'tools': {tool: {'calls': calls, 'time': round(elapsed, 6)}
+                      for tool, (calls, elapsed)
+                      in sorted(_tool_calls.items())},
+            'cache': {name: {'hits': hits, 'misses': misses}
+                      for name, (hits, misses)
+                      in sorted(_cache_lookups.items())},
+            'trace': list(_tool_trace) if _tool_trace is not None else None,
+        }
+
+
+def log_tool_invocations(level=DEBUG):
+    """Log a one line summary of the juju tool invocations made so far."""
+    data = tool_invocations()
+    calls = sum(t['calls'] for t in data['tools'].values())
+    hits = sum(c['hits'] for c in data['cache'].values())
+    log('Juju tool invocations: {} ({:.3f}s), cache hits: {}; {}'.format(
+        calls, sum(t['time'] for t in data['tools'].values()), hits,
+        ', '.join('{} {}'.format(tool, t['calls'])
+                  for tool, t in data['tools'].items())), level=level)
+
+
+def _record_cache_lookup(func, args, kwargs, hit):
+    name = getattr(func, '__qualname__', str(func))
+    with _tool_lock:
+        hits, misses = _cache_lookups.get(name, (0, 0))
+        _cache_lookups[name] = (hits + 1, misses) if hit else (hits,
+                                                               misses + 1)
+        if _tool_trace is not None:
+            _tool_trace.append({
+                'function': name,
+                'args': json.dumps([args, kwargs], sort_keys=True,
+                                   default=str),
+                'cached': hit,
+            })
+
+
+def _run_tool(func, cmd, **kwargs):
+    """Run a juju tool through func, counting and timing the invocation."""
+    tool = os.path.basename(cmd[0])
+    start = time.monotonic()
+    try:
+        with profiler.phase('subprocesses', tool):
+            return func(cmd, **kwargs)
+    finally:
+        elapsed = time.monotonic() - start
+        with _tool_lock:
+            calls, total = _tool_calls.get(tool, (0, 0.0))
+            _tool_calls[tool] = (calls + 1, total + elapsed)
+            if _tool_trace is not None:
+                if tool.endswith('-set'):
+                    cmd = [a.split('=', 1)[0] + '=...' if '=' in a else a
+                           for a in cmd]
+                _tool_trace.append({'cmd': list(cmd),
+                                    'time': round(elapsed, 6)})
+
+
+def _check_outputs(cmds):
+    """Run juju tools side by side and collect their output.
+
+    All processes are started before the first one is waited for, so the
+    total wait is that of the slowest tool rather than the sum of all of
+    them.  Everything runs on the calling thread.
+
+    :param cmds: the tool command lines
+    :type cmds: List[List[str]]
+    :returns: the stdout of each command, or None where it could not be
+              started, and its exit status
+    :rtype: List[Tuple[Optional[bytes], int]]
+    """
+    started = []
+    for cmd in cmds:
+        start = time.monotonic()
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        except OSError:
+            proc = None
+        started.append((cmd, proc, start))
+    results = []
+    for cmd, proc, start in started:
+        if proc is None:
+            results.append((None, -1))
+            continue
+        out, _ = proc.communicate()
+        elapsed = time.monotonic() - start
+        tool = os.path.basename(cmd[0])
+        with _tool_lock:
+            calls, total = _tool_calls.get(tool, (0, 0.0))
+            _tool_calls[tool] = (calls + 1, total + elapsed)
+            if _tool_trace is not None:
+                _tool_trace.append({'cmd': list(cmd),
+                                    'time': round(elapsed, 6)})
+        results.append((out, proc.returncode))
+    return results
+
+
+def _check_output(cmd, **kwargs):
+    return _run_tool(subprocess.check_output, cmd, **kwargs)
+
+
+def _check_call(cmd, **kwargs):
+    return _run_tool(subprocess.check_call, cmd, **kwargs)
+
+
+def _call(cmd, **kwargs):
+    return _run_tool(subprocess.call, cmd, **kwargs)
+
+
 def log(message, level=None):
-    """Write a message to the juju log"""
+    """Write a message to the juju log
+
+    When the log buffer is enabled, see :func:`enable_log_buffer`, the
+    message is only written out when the buffer is flushed.
+    """
+    if not isinstance(message, str):
+        message = repr(message)
+    message = message[:SH_MAX_ARG]
+    buf = _log_buffer
+    if buf is not None:
+        buf.append(message, level)
+    else:
+        _juju_log(message, level)
+
+
+LOG_BUFFER_SIZE = 16 * 1024
+_LOG_LEVELS = (TRACE, DEBUG, INFO, WARNING, ERROR, CRITICAL)
+
+
+class _LogBuffer(object):
+    """Messages waiting to be written to the juju log.
+
+    Consecutive messages of the same level are written with a single
+    ``juju-log`` invocation, one message per line, so the order and level of
+    each message is preserved.
+    """
+
+    def __init__(self, max_bytes, flush_level):
+        self.max_bytes = max_bytes
+        self.flush_level = _LOG_LEVELS.index(flush_level)
+        self.lock = threading.RLock()
+        self.messages = []
+        self.size = 0
+
+    def append(self, message, level):
+        with self.lock:
+            self.messages.append((level, message))
+            self.size += len(message) + 1
+            severity = level.upper() if level else INFO
+            if (self.size >= self.max_bytes or
+                    severity in _LOG_LEVELS and
+                    _LOG_LEVELS.index(severity) >= self.flush_level):
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            messages, self.messages, self.size = self.messages, [], 0
+            batch, batch_level, batch_size = [], None, 0
+            for level, message in messages:
+                if batch and (level != batch_level or
+                              batch_size + len(message) + 1 > SH_MAX_ARG):
+                    _juju_log('\n'.join(batch), batch_level)
+                    batch, batch_size = [], 0
+                batch.append(message)
+                batch_level = level
+                batch_size += len(message) + 1
+            if batch:
+                _juju_log('\n'.join(batch), batch_level)
+
+
+_log_buffer = None
+
+
+def enable_log_buffer(max_bytes=LOG_BUFFER_SIZE, flush_level=ERROR):
+    """Buffer messages passed to :func:`log` instead of writing each one out.
+
+    The buffer is flushed when it holds more than max_bytes, when a message
+    of flush_level or above is logged, when the hook function run by
+    :class:`Hooks` returns or raises, and when the interpreter exits.
+
+    :param max_bytes: size of the buffered messages which triggers a flush
+    :type max_bytes: int
+    :param flush_level: level of messages which are written out immediately,
+                        along with all messages buffered before them
+    :type flush_level: str
+    """
+    global _log_buffer
+    if _log_buffer is None:
+        _interpreter_atexit.register(flush_log_buffer)
+    else:
+        _log_buffer.flush()
+    _log_buffer = _LogBuffer(max_bytes, flush_level)
+
+
+def flush_log_buffer():
+    """Write out the messages in the log buffer, if enabled."""
+    buf = _log_buffer
+    if buf is not None:
+        buf.flush()
+
+
+def disable_log_buffer():
+    """Flush the log buffer and write each further message out directly."""
+    global _log_buffer
+    buf, _log_buffer = _log_buffer, None
+    if buf is not None:
+        buf.flush()
+
+
+def _juju_log(message, level=None):
     command = ['juju-log']
     if level:
         command += ['-l', level]
-    if not isinstance(message, str):
-        message = repr(message)
-    command += [message[:SH_MAX_ARG]]
+    command += [message]
     # Missing juju-log should not cause failures in unit tests
     # Send log output to stderr
     try:
-        subprocess.call(command)
+        _call(command)
     except OSError as e:
         if e.errno == errno.ENOENT:
             if level:
@@ -134,7 +397,7 @@ def function_log(message):
     # Missing function-log should not cause failures in unit tests
     # Send function_log output to stderr
     try:
-        subprocess.call(command)
+        _call(command)
     except OSError as e:
         if e.errno == errno.ENOENT:
             message = "function-log: {}".format(message)
@@ -444,7 +707,7 @@ def config(scope=None):
     try:
         if _cache_config is None:
             config_data = json.loads(
-                subprocess.check_output(config_cmd_line).decode('UTF-8'))
+                _check_output(config_cmd_line).decode('UTF-8'))
             _cache_config = Config(config_data)
         if scope is not None:
             return _cache_config.get(scope)
@@ -457,8 +720,28 @@ def config(scope=None):
 
 
 @cached
-def relation_get(attribute=None, unit=None, rid=None, app=None):
-    """Get relation information"""
+def relation_snapshot(unit=None, rid=None, app=None):
+    """Get the complete relation settings of a unit or application.
+
+    The whole settings dict is fetched with a single ``relation-get`` call and
+    cached for the rest of the hook, so that subsequent lookups of individual
+    attributes through :func:`relation_get` are served from memory instead of
+    forking a ``relation-get`` process per key. Snapshots of the local unit
+    are invalidated by :func:`relation_set`.
+
+    NOTE: the returned dict is shared by all callers and must not be
+    modified; use ``relation_get()`` to obtain a private copy.
+
+    :param unit: the unit to read settings for, defaults to the remote unit.
+    :type unit: Optional[str]
+    :param rid: the relation id, defaults to the current relation.
+    :type rid: Optional[str]
+    :param app: the application to read settings for.
+    :type app: Optional[str]
+    :returns: the relation settings, or None if they can't be read.
+    :rtype: Optional[Dict[str, str]]
+    :raises: ValueError if both unit and app are passed.
+    """
     _args = ['relation-get', '--format=json']
     if app is not None:
         if unit is not None:
@@ -467,12 +750,12 @@ def relation_get(attribute=None, unit=None, rid=None, app=None):
     if rid:
         _args.append('-r')
         _args.append(rid)
-    _args.append(attribute or '-')
+    _args.append('-')
     # unit or application name
     if unit or app:
         _args.append(unit or app)
     try:
-        return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+        return json.loads(_check_output(_args).decode('UTF-8'))
     except ValueError:
         return None
     except CalledProcessError as e:
@@ -481,6 +764,20 @@ def relation_get(attribute=None, unit=None, rid=None, app=None):
         raise
 
 
+def relation_get(attribute=None, unit=None, rid=None, app=None):
+    """Get relation information
+
+    Attribute lookups are served from :func:`relation_snapshot`, so reading
+    any number of keys for a (rid, unit) pair costs one ``relation-get``.
+    """
+    settings = relation_snapshot(unit=unit, rid=rid, app=app)
+    if settings is None:
+        return None
+    if attribute is None:
+        return copy.deepcopy(settings)
+    return settings.get(attribute)
+
+
 @cached
 def _relation_set_accepts_file():
     """Return True if the juju relation-set command accepts a file.
@@ -493,7 +790,7 @@ def _relation_set_accepts_file():
     :rtype: bool
     :raises: subprocess.CalledProcessError if the check fails.
     """
-    return "--file" in subprocess.check_output(
+    return "--file" in _check_output(
         ["relation-set", "--help"], universal_newlines=True)
 
 
@@ -519,7 +816,7 @@ def relation_set(relation_id=None, relation_settings=None, app=False, **kwargs):
         # stdin, but that feature is broken in 1.23.2: Bug #1454678.
         with tempfile.NamedTemporaryFile(delete=False) as settings_file:
             settings_file.write(yaml.safe_dump(settings).encode("utf-8"))
-        subprocess.check_call(
+        _check_call(
             relation_cmd_line + ["--file", settings_file.name])
         os.remove(settings_file.name)
     else:
@@ -528,9 +825,11 @@ def relation_set(relation_id=None, relation_settings=None, app=False, **kwargs):
                 relation_cmd_line.append('{}='.format(key))
             else:
                 relation_cmd_line.append('{}={}'.format(key, value))
-        subprocess.check_call(relation_cmd_line)
-    # Flush cache of any relation-gets for local unit
+        _check_call(relation_cmd_line)
+    # Flush cache of any relation-gets and relation snapshots for local unit
     flush(local_unit())
+    if app:
+        flush(json.dumps(application_name()))
 
 
 def relation_clear(r_id=None):
@@ -552,7 +851,7 @@ def relation_ids(reltype=None):
     if reltype is not None:
         relid_cmd_line.append(reltype)
         return json.loads(
-            subprocess.check_output(relid_cmd_line).decode('UTF-8')) or []
+            _check_output(relid_cmd_line).decode('UTF-8')) or []
     return []
 
 
@@ -564,7 +863,78 @@ def related_units(relid=None):
     if relid is not None:
         units_cmd_line.extend(('-r', relid))
     return json.loads(
-        subprocess.check_output(units_cmd_line).decode('UTF-8')) or []
+        _check_output(units_cmd_line).decode('UTF-8')) or []
+
+
+def _load_json(out):
+    try:
+        return json.loads(out.decode('UTF-8'))
+    except ValueError:
+        return None
+
+
+def prefetch_relations(reltypes):
+    """Read the charm config and all settings of units on reltypes up front.
+
+    Rendering configs reads the relations one ``relation-get`` at a time.
+    This runs the ``config-get`` and ``relation-ids`` calls, then the
+    ``relation-list`` calls and then the ``relation-get`` calls of each
+    stage side by side, see :func:`_check_outputs`, and stores the results
+    in the function cache, so the serial reads that follow are cache hits.
+    Nothing runs on another thread.
+
+    Values that are already cached are not read again.  A tool that fails
+    leaves its entry uncached, so the serial read runs it again and raises
+    or logs as it would have without the prefetch.
+
+    :param reltypes: the relation names to read
+    :type reltypes: Iterable[str]
+    """
+    global _cache_config
+    reltypes = sorted(set(r for r in reltypes if r))
+    cmds = [['relation-ids', '--format=json', r] for r in reltypes
+            if not _is_cached(relation_ids, r)]
+    get_config = _cache_config is None
+    if get_config:
+        cmds.append(['config-get', '--all', '--format=json'])
+    results = _check_outputs(cmds)
+    if get_config:
+        out, status = results.pop()
+        if status == 0:
+            config_data = _load_json(out)
+            if config_data is not None:
+                _cache_config = Config(config_data)
+    for cmd, (out, status) in zip(cmds, results):
+        rids = _load_json(out) if status == 0 else None
+        if rids is not None:
+            _cache_store(relation_ids, rids or [], cmd[-1])
+
+    rids = [rid for r in reltypes if _is_cached(relation_ids, r)
+            for rid in relation_ids(r)]
+    cmds = [['relation-list', '--format=json', '-r', rid] for rid in rids
+            if not _is_cached(related_units, rid)]
+    for cmd, (out, status) in zip(cmds, _check_outputs(cmds)):
+        units = _load_json(out) if status == 0 else None
+        if units is not None:
+            _cache_store(related_units, units or [], cmd[-1])
+
+    pairs = [(rid, unit) for rid in rids if _is_cached(related_units, rid)
+             for unit in related_units(rid)
+             if not _is_cached(relation_snapshot, unit=unit, rid=rid,
+                               app=None)]
+    cmds = [['relation-get', '--format=json', '-r', rid, '-', unit]
+            for rid, unit in pairs]
+    for (rid, unit), (out, status) in zip(pairs, _check_outputs(cmds)):
+        # NOTE: as in relation_snapshot(), exit status 2 and unparsable
+        # output both mean there are no settings.
+        if status == 0:
+            settings = _load_json(out)
+        elif status == 2:
+            settings = None
+        else:
+            continue
+        _cache_store(relation_snapshot, settings, unit=unit, rid=rid,
+                     app=None)
 
 
 def expected_peer_units():
@@ -822,7 +1192,7 @@ def _port_op(op_name, port, protocol="TCP"):
     else:
         _args.append('{}/{}'.format(port, protocol))
     try:
-        subprocess.check_call(_args)
+        _check_call(_args)
     except subprocess.CalledProcessError:
         # Older Juju pre 2.3 doesn't support ICMP
         # so treat it as a no-op if it fails.
@@ -844,14 +1214,14 @@ def open_ports(start, end, protocol="TCP"):
     """Opens a range of service network ports"""
     _args = ['open-port']
     _args.append('{}-{}/{}'.format(start, end, protocol))
-    subprocess.check_call(_args)
+    _check_call(_args)
 
 
 def close_ports(start, end, protocol="TCP"):
     """Close a range of service network ports"""
     _args = ['close-port']
     _args.append('{}-{}/{}'.format(start, end, protocol))
-    subprocess.check_call(_args)
+    _check_call(_args)
 
 
 def opened_ports():
@@ -862,7 +1232,7 @@ def opened_ports():
     :returns: Opened ports as a list of strings: ``['8080/tcp', '8081-8083/tcp']``
     """
     _args = ['opened-ports', '--format=json']
-    return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+    return json.loads(_check_output(_args).decode('UTF-8'))
 
 
 @cached
@@ -870,7 +1240,7 @@ def unit_get(attribute):
     """Get the unit ID for the remote unit"""
     _args = ['unit-get', '--format=json', attribute]
     try:
-        return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+        return json.loads(_check_output(_args).decode('UTF-8'))
     except ValueError:
         return None
 
@@ -894,7 +1264,7 @@ def storage_get(attribute=None, storage_id=None):
     if attribute:
         _args.append(attribute)
     try:
-        return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+        return json.loads(_check_output(_args).decode('UTF-8'))
     except ValueError:
         return None
 
@@ -906,7 +1276,7 @@ def storage_list(storage_name=None):
     if storage_name:
         _args.append(storage_name)
     try:
-        return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+        return json.loads(_check_output(_args).decode('UTF-8'))
     except ValueError:
         return None
     except OSError as e:
@@ -963,12 +1333,16 @@ class Hooks(object):
         hook_name = os.path.basename(args[0])
         if hook_name in self._hooks:
             try:
-                self._hooks[hook_name]()
+                with profiler.phase('hook', hook_name):
+                    self._hooks[hook_name]()
             except SystemExit as x:
                 if x.code is None or x.code == 0:
                     _run_atexit()
                 raise
-            _run_atexit()
+            else:
+                _run_atexit()
+            finally:
+                flush_log_buffer()
         else:
             raise UnregisteredHookError(hook_name)
 
@@ -1013,7 +1387,7 @@ def action_get(key=None):
     if key is not None:
         cmd.append(key)
     cmd.append('--format=json')
-    action_data = json.loads(subprocess.check_output(cmd).decode('UTF-8'))
+    action_data = json.loads(_check_output(cmd).decode('UTF-8'))
     return action_data
 
 
@@ -1032,7 +1406,7 @@ def function_get(key=None):
     if key is not None:
         cmd.append(key)
     cmd.append('--format=json')
-    function_data = json.loads(subprocess.check_output(cmd).decode('UTF-8'))
+    function_data = json.loads(_check_output(cmd).decode('UTF-8'))
     return function_data
 
 
@@ -1041,7 +1415,7 @@ def action_set(values):
     cmd = ['action-set']
     for k, v in list(values.items()):
         cmd.append('{}={}'.format(k, v))
-    subprocess.check_call(cmd)
+    _check_call(cmd)
 
 
 @deprecate("moved to action_set()", log=log)
@@ -1057,7 +1431,7 @@ def function_set(values):
 
     for k, v in list(values.items()):
         cmd.append('{}={}'.format(k, v))
-    subprocess.check_call(cmd)
+    _check_call(cmd)
 
 
 def action_fail(message):
@@ -1066,7 +1440,7 @@ def action_fail(message):
 
     The results set by action_set are preserved.
     """
-    subprocess.check_call(['action-fail', message])
+    _check_call(['action-fail', message])
 
 
 @deprecate("moved to action_fail()", log=log)
@@ -1083,7 +1457,7 @@ def function_fail(message):
         cmd = ['action-fail']
     cmd.append(message)
 
-    subprocess.check_call(cmd)
+    _check_call(cmd)
 
 
 def action_name():
@@ -1144,7 +1518,7 @@ def status_set(workload_state, message, application=False):
         cmd.append('--application')
     cmd.extend([workload_state.value, message])
     try:
-        ret = subprocess.call(cmd)
+        ret = _call(cmd)
         if ret == 0:
             return
     except OSError as e:
@@ -1164,7 +1538,7 @@ def status_get():
     """
     cmd = ['status-get', "--format=json", "--include-data"]
     try:
-        raw_status = subprocess.check_output(cmd)
+        raw_status = _check_output(cmd)
     except OSError as e:
         if e.errno == errno.ENOENT:
             return ('unknown', "")
@@ -1198,7 +1572,7 @@ def application_version_set(version):
     cmd = ['application-version-set']
     cmd.append(version)
     try:
-        subprocess.check_call(cmd)
+        _check_call(cmd)
     except OSError:
         log("Application Version: {}".format(version))
 
@@ -1208,7 +1582,7 @@ def application_version_set(version):
 def goal_state():
     """Juju goal state values"""
     cmd = ['goal-state', '--format=json']
-    return json.loads(subprocess.check_output(cmd).decode('UTF-8'))
+    return json.loads(_check_output(cmd).decode('UTF-8'))
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -1218,14 +1592,14 @@ def is_leader():
     Uses juju to determine whether the current unit is the leader of its peers
     """
     cmd = ['is-leader', '--format=json']
-    return json.loads(subprocess.check_output(cmd).decode('UTF-8'))
+    return json.loads(_check_output(cmd).decode('UTF-8'))
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
 def leader_get(attribute=None):
     """Juju leader get value(s)"""
     cmd = ['leader-get', '--format=json'] + [attribute or '-']
-    return json.loads(subprocess.check_output(cmd).decode('UTF-8'))
+    return json.loads(_check_output(cmd).decode('UTF-8'))
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -1241,7 +1615,7 @@ def leader_set(settings=None, **kwargs):
             cmd.append('{}='.format(k))
         else:
             cmd.append('{}={}'.format(k, v))
-    subprocess.check_call(cmd)
+    _check_call(cmd)
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -1251,7 +1625,7 @@ def payload_register(ptype, klass, pid):
     cmd = ['payload-register']
     for x in [ptype, klass, pid]:
         cmd.append(x)
-    subprocess.check_call(cmd)
+    _check_call(cmd)
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -1263,7 +1637,7 @@ def payload_unregister(klass, pid):
     cmd = ['payload-unregister']
     for x in [klass, pid]:
         cmd.append(x)
-    subprocess.check_call(cmd)
+    _check_call(cmd)
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -1275,7 +1649,7 @@ def payload_status_set(klass, pid, status):
     cmd = ['payload-status-set']
     for x in [klass, pid, status]:
         cmd.append(x)
-    subprocess.check_call(cmd)
+    _check_call(cmd)
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -1291,7 +1665,7 @@ def resource_get(name):
 
     cmd = ['resource-get', name]
     try:
-        return subprocess.check_output(cmd).decode('UTF-8')
+        return _check_output(cmd).decode('UTF-8')
     except subprocess.CalledProcessError:
         return False
 
@@ -1301,8 +1675,8 @@ def juju_version():
     """Full version string (eg. '1.23.3.1-trusty-amd64')"""
     # Per https://bugs.launchpad.net/juju-core/+bug/1455368/comments/1
     jujud = glob.glob('/var/lib/juju/tools/machine-*/jujud')[0]
-    return subprocess.check_output([jujud, 'version'],
-                                   universal_newlines=True).strip()
+    return _check_output([jujud, 'version'],
+                         universal_newlines=True).strip()
 
 
 def has_juju_version(minimum_version):
@@ -1374,7 +1748,7 @@ def network_get_primary_address(binding):
     '''
     cmd = ['network-get', '--primary-address', binding]
     try:
-        response = subprocess.check_output(
+        response = _check_output(
             cmd,
             stderr=subprocess.STDOUT).decode('UTF-8').strip()
     except CalledProcessError as e:
@@ -1404,7 +1778,7 @@ def network_get(endpoint, relation_id=None):
     if relation_id:
         cmd.append('-r')
         cmd.append(relation_id)
-    response = subprocess.check_output(
+    response = _check_output(
         cmd,
         stderr=subprocess.STDOUT).decode('UTF-8').strip()
     return yaml.safe_load(response)
@@ -1421,7 +1795,7 @@ def add_metric(*args, **kwargs):
     _kvpairs.extend(['{}={}'.format(k, v) for k, v in kwargs.items()])
     _args.extend(sorted(_kvpairs))
     try:
-        subprocess.check_call(_args)
+        _check_call(_args)
         return
     except EnvironmentError as e:
         if e.errno != errno.ENOENT:
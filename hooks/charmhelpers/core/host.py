@@ -30,11 +30,16 @@ import string
 import subprocess
 import hashlib
 import functools
+import time
 import itertools
 
+from concurrent import futures
 from contextlib import contextmanager
 from collections import OrderedDict, defaultdict
-from .hookenv import log, INFO, DEBUG, local_unit, charm_name
+from .hookenv import log, INFO, DEBUG, WARNING, local_unit, charm_name
+from . import profiler
+from . import systemd
+from . import unitdata
 from .fstab import Fstab
 from charmhelpers.osplatform import get_platform
 
@@ -289,6 +294,14 @@ def service(action, service_name=None, **kwargs):
                     the form of key=value.
     """
     if init_is_systemd(service_name=service_name):
+        if service_name is not None and action in systemd.JOB_METHODS:
+            # NOTE: run the job over D-Bus rather than forking systemctl,
+            # unless systemd is not reachable that way.
+            with profiler.phase('services',
+                                '{} {}'.format(action, service_name)):
+                result = systemd.run_job(action, service_name)
+            if result is not None:
+                return result
         cmd = ['systemctl', action]
         if service_name is not None:
             cmd.append(service_name)
@@ -297,7 +310,8 @@ def service(action, service_name=None, **kwargs):
         for key, value in kwargs.items():
             parameter = '%s=%s' % (key, value)
             cmd.append(parameter)
-    return subprocess.call(cmd) == 0
+    with profiler.phase('services', '{} {}'.format(action, service_name)):
+        return subprocess.call(cmd) == 0
 
 
 _UPSTART_CONF = "/etc/init/{}.conf"
@@ -315,6 +329,9 @@ def service_running(service_name, **kwargs):
                      are ignored in systemd services.
     """
     if init_is_systemd(service_name=service_name):
+        states = systemd.active_states([service_name])
+        if states is not None:
+            return states[service_name] in systemd.ACTIVE_STATES
         return service('is-active', service_name)
     else:
         if os.path.exists(_UPSTART_CONF.format(service_name)):
@@ -341,6 +358,29 @@ def service_running(service_name, **kwargs):
         return False
 
 
+def services_running(service_names):
+    """Determine whether system services are running.
+
+    The state of services managed by systemd is queried with a single
+    round-trip where systemd is reachable over D-Bus.
+
+    :param service_names: the names of the services
+    :type service_names: List[str]
+    :returns: {service: whether it is running}
+    :rtype: Dict[str, bool]
+    """
+    names = [name for name in service_names
+             if init_is_systemd(service_name=name)]
+    states = systemd.active_states(names) if names else None
+    running = {}
+    for name in service_names:
+        if states is not None and name in states:
+            running[name] = states[name] in systemd.ACTIVE_STATES
+        else:
+            running[name] = service_running(name)
+    return running
+
+
 SYSTEMD_SYSTEM = '/run/systemd/system'
 
 
@@ -679,31 +719,81 @@ def fstab_mount(mountpoint):
     return True
 
 
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Digest used by path_hash() to detect changed files during restart_on_change.
+# The digests are only ever compared with each other within a hook, so a
+# faster algorithm than file_hash()'s md5 default can be used.
+PATH_HASH_TYPE = 'blake2b'
+
+# {path: ((st_ino, st_size, st_mtime_ns, hash_type), digest)}
+_file_hash_cache = {}
+
+
 def file_hash(path, hash_type='md5'):
     """Generate a hash checksum of the contents of 'path' or None if not found.
 
+    The file is hashed incrementally in chunks of HASH_CHUNK_SIZE bytes.
+
     :param str hash_type: Any hash alrgorithm supported by :mod:`hashlib`,
                           such as md5, sha1, sha256, sha512, etc.
     """
     if os.path.exists(path):
         h = getattr(hashlib, hash_type)()
         with open(path, 'rb') as source:
-            h.update(source.read())
+            for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b''):
+                h.update(chunk)
         return h.hexdigest()
     else:
         return None
 
 
+def cached_file_hash(path, hash_type=PATH_HASH_TYPE):
+    """Generate a hash checksum of 'path', reusing a previous checksum if the
+    file is unchanged.
+
+    The file is only read and hashed if its (inode, size, mtime_ns) differ
+    from when it was last hashed by this function.  Files modified within the
+    last second are never cached, as a subsequent write could go unnoticed on
+    filesystems with coarse timestamps.
+
+    :param path: the file to hash
+    :type path: str
+    :param hash_type: Any hash algorithm supported by :mod:`hashlib`
+    :type hash_type: str
+    :returns: the hex digest of the file or None if not found
+    :rtype: Optional[str]
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        _file_hash_cache.pop(path, None)
+        return None
+    key = (st.st_ino, st.st_size, st.st_mtime_ns, hash_type)
+    cached = _file_hash_cache.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    digest = file_hash(path, hash_type)
+    if st.st_mtime_ns < time.time_ns() - 10 ** 9:
+        _file_hash_cache[path] = (key, digest)
+    else:
+        _file_hash_cache.pop(path, None)
+    return digest
+
+
 def path_hash(path):
     """Generate a hash checksum of all files matching 'path'. Standard
     wildcards like '*' and '?' are supported, see documentation for the 'glob'
     module for more information.
 
+    Files whose inode, size and mtime are unchanged since they were last
+    hashed are not read again, see :func:`cached_file_hash`.
+
     :return: dict: A { filename: hash } dictionary for all matched files.
                    Empty if none found.
     """
     return {
-        filename: file_hash(filename)
+        filename: cached_file_hash(filename)
         for filename in glob.iglob(path)
     }
 
@@ -868,14 +958,17 @@ def restart_on_change_helper(lambda_f, restart_map, stopstart=False,
     :rtype: ANY
     """
     checksums = _pre_restart_on_change_helper(restart_map)
-    r = lambda_f()
-    _post_restart_on_change_helper(checksums,
-                                   restart_map,
-                                   stopstart,
-                                   restart_functions,
-                                   can_restart_now_f,
-                                   post_svc_restart_f,
-                                   pre_restarts_wait_f)
+    # NOTE: restarts needed by nested restart_on_change scopes are queued
+    # and done once, when the outermost scope exits.
+    with deferred_restarts():
+        r = lambda_f()
+        _post_restart_on_change_helper(checksums,
+                                       restart_map,
+                                       stopstart,
+                                       restart_functions,
+                                       can_restart_now_f,
+                                       post_svc_restart_f,
+                                       pre_restarts_wait_f)
     return r
 
 
@@ -887,7 +980,8 @@ def _pre_restart_on_change_helper(restart_map):
     :returns: Dictionary of file paths and the files checksum.
     :rtype: Dict[str, str]
     """
-    return {path: path_hash(path) for path in restart_map}
+    with profiler.phase('hashing'):
+        return {path: path_hash(path) for path in restart_map}
 
 
 def _post_restart_on_change_helper(checksums,
@@ -922,30 +1016,393 @@ def _post_restart_on_change_helper(checksums,
     changed_files = defaultdict(list)
     restarts = []
     # create a list of lists of the services to restart
-    for path, services in restart_map.items():
-        if path_hash(path) != checksums[path]:
-            restarts.append(services)
-            for svc in services:
-                changed_files[svc].append(path)
+    with profiler.phase('hashing'):
+        for path, services in restart_map.items():
+            if path_hash(path) != checksums[path]:
+                restarts.append(services)
+                for svc in services:
+                    changed_files[svc].append(path)
     # create a flat list of ordered services without duplicates from lists
     services_list = list(OrderedDict.fromkeys(itertools.chain(*restarts)))
-    if services_list:
-        if pre_restarts_wait_f:
-            pre_restarts_wait_f()
-        actions = ('stop', 'start') if stopstart else ('restart',)
+    if not services_list:
+        return
+    with deferred_restarts() as queue:
+        queue.add(services_list,
+                  changed_files=changed_files,
+                  stopstart=stopstart,
+                  restart_functions=restart_functions,
+                  can_restart_now_f=can_restart_now_f,
+                  post_svc_restart_f=post_svc_restart_f,
+                  pre_restarts_wait_f=pre_restarts_wait_f)
+
+
+class RestartQueue(object):
+    """Services to restart, merged from nested restart_on_change scopes.
+
+    Each service is restarted once.  The services are restarted in an order
+    consistent with the order of every list they were added in, so that a
+    service listed after another one by any scope, e.g. nova-compute after
+    libvirtd, is restarted after it.  Where the lists disagree the order in
+    which services were first added wins.
+
+    The restart options of all scopes wanting a service restarted are
+    combined: it is stopped and started if any scope asked for that, its
+    restart function is that of the first scope providing one, and it is
+    only restarted if all ``can_restart_now_f`` functions permit it.
+
+    Given service dependencies, the order above is not used; services are
+    restarted concurrently instead, each once the services it depends on
+    have been restarted, see run_service_actions().  Only the service jobs
+    run on worker threads: ``can_restart_now_f`` functions are called for
+    all services before the first restart, ``post_svc_restart_f`` functions
+    once the service has been restarted, both from the calling thread, as
+    they may use the unit kv store or the hookenv cache.  Restart functions
+    may do the same, so with any of them the services are restarted one
+    after the other, from the calling thread.
+
+    :param dependencies: {service: [services it depends on, ...]}, or a
+                         callable returning them when restarting
+    :type dependencies: Optional[Union[Dict[str, List[str]], Callable]]
+    """
+
+    def __init__(self, dependencies=None):
+        self.services = OrderedDict()
+        self.orders = []
+        self.pre_restarts_wait_fs = []
+        self.dependencies = dependencies
+
+    def __bool__(self):
+        return bool(self.services)
+
+    def add(self, services_list, changed_files=None, stopstart=False,
+            restart_functions=None, can_restart_now_f=None,
+            post_svc_restart_f=None, pre_restarts_wait_f=None):
+        """Queue services for restart.
+
+        :param services_list: services to restart, in order
+        :type services_list: List[str]
+        :param changed_files: {service: [changed file, ...]}
+        :type changed_files: Dict[str, List[str]]
+        See restart_on_change_helper() for the other parameters.
+        """
+        self.orders.append(list(services_list))
+        if (pre_restarts_wait_f and
+                pre_restarts_wait_f not in self.pre_restarts_wait_fs):
+            self.pre_restarts_wait_fs.append(pre_restarts_wait_f)
         for service_name in services_list:
-            if can_restart_now_f:
-                if not can_restart_now_f(service_name,
-                                         changed_files[service_name]):
-                    continue
-            if service_name in restart_functions:
-                restart_functions[service_name](service_name)
+            entry = self.services.setdefault(service_name, {
+                'changed_files': [],
+                'stopstart': False,
+                'restart_function': None,
+                'can_restart_now_fs': [],
+                'post_svc_restart_fs': [],
+            })
+            for path in (changed_files or {}).get(service_name, []):
+                if path not in entry['changed_files']:
+                    entry['changed_files'].append(path)
+            entry['stopstart'] = entry['stopstart'] or stopstart
+            if entry['restart_function'] is None:
+                entry['restart_function'] = (
+                    restart_functions or {}).get(service_name)
+            for f, fs in ((can_restart_now_f, entry['can_restart_now_fs']),
+                          (post_svc_restart_f, entry['post_svc_restart_fs'])):
+                if f and f not in fs:
+                    fs.append(f)
+
+    def order(self):
+        """Services in the order they are to be restarted.
+
+        :rtype: List[str]
+        """
+        after = {svc: set() for svc in self.services}
+        for services_list in self.orders:
+            for i, svc in enumerate(services_list):
+                after[svc].update(services_list[:i])
+        ordered, done = [], set()
+        pending = list(self.services)
+        while pending:
+            # the first service not waiting for another pending one; should
+            # the scopes disagree, fall back to the order first added.
+            ready = next((svc for svc in pending
+                          if not (after[svc] - done)), pending[0])
+            pending.remove(ready)
+            done.add(ready)
+            ordered.append(ready)
+        return ordered
+
+    def run(self):
+        """Restart the queued services and empty the queue."""
+        services_list = self.order()
+        entries, wait_fs = self.services, self.pre_restarts_wait_fs
+        self.services, self.orders = OrderedDict(), []
+        self.pre_restarts_wait_fs = []
+        if not services_list:
+            return
+        for pre_restarts_wait_f in wait_fs:
+            pre_restarts_wait_f()
+        services_list = [
+            service_name for service_name in services_list
+            if all(f(service_name, entries[service_name]['changed_files'])
+                   for f in entries[service_name]['can_restart_now_fs'])]
+
+        def restart(service_name):
+            entry = entries[service_name]
+            if entry['restart_function']:
+                entry['restart_function'](service_name)
             else:
+                actions = (('stop', 'start') if entry['stopstart']
+                           else ('restart',))
                 for action in actions:
                     service(action, service_name)
-            if post_svc_restart_f:
+
+        def restarted(service_name, result):
+            for post_svc_restart_f in entries[service_name][
+                    'post_svc_restart_fs']:
                 post_svc_restart_f(service_name)
 
+        dependencies = self.dependencies
+        if any(entries[svc]['restart_function'] for svc in services_list):
+            dependencies = None
+        elif callable(dependencies):
+            dependencies = dependencies()
+        run_service_actions(services_list, restart,
+                            dependencies=dependencies, name='restart',
+                            on_done=restarted)
+
+
+# most service actions run at once by run_service_actions()
+SERVICE_ACTION_WORKERS = 4
+
+
+def run_service_actions(services_list, func, dependencies=None,
+                        reverse=False, name='action', on_done=None):
+    """Run an action for each service, concurrently where possible.
+
+    Without dependencies the action is run for one service after the other,
+    in order.  Otherwise it is run concurrently, by up to
+    SERVICE_ACTION_WORKERS threads, for each service once it completed for
+    the services it depends on; services depending on services not in the
+    list need not wait for them.  Services missing from the dependencies,
+    neither depending on nor depended on by any service, keep their place
+    in the list: they wait for the services before them and the services
+    after them wait for them, as without dependencies.  With reverse, e.g.
+    to stop services, a service waits for the services depending on it
+    instead.  Should the dependencies have a cycle, the services on it are
+    run in order.
+
+    The time taken by the action is logged for each service.  Should it,
+    or on_done, raise, no further actions are started and the first
+    exception raised once the running ones are done.  on_done is always
+    called from the calling thread, never from a worker thread.
+
+    :param services_list: services to run the action for, in order
+    :type services_list: List[str]
+    :param func: the action, called with the service name
+    :type func: Callable[[str], Any]
+    :param dependencies: {service: [services it depends on, ...]}
+    :type dependencies: Optional[Dict[str, List[str]]]
+    :param reverse: whether to run the action for dependent services first
+    :type reverse: bool
+    :param name: the name of the action, for logging
+    :type name: str
+    :param on_done: called with the service name and the result of func
+                    once the action completed for the service
+    :type on_done: Optional[Callable[[str, Any], None]]
+    :returns: {service: result of func}
+    :rtype: Dict[str, Any]
+    """
+    def timed(service_name):
+        start = time.monotonic()
+        result = func(service_name)
+        return result, time.monotonic() - start
+
+    def done(service_name, elapsed):
+        log('{} {}: {:.2f}s'.format(name, service_name, elapsed),
+            level=DEBUG)
+        if on_done is not None:
+            on_done(service_name, results[service_name])
+
+    results = OrderedDict()
+    if dependencies is None or len(services_list) < 2:
+        for service_name in services_list:
+            results[service_name], elapsed = timed(service_name)
+            done(service_name, elapsed)
+        return results
+
+    known = set(dependencies)
+    for svc_dependencies in dependencies.values():
+        known.update(svc_dependencies)
+    waits_for = {svc: set() for svc in services_list}
+    for i, svc in enumerate(services_list):
+        for dependency in dependencies.get(svc, ()):
+            if dependency in waits_for and dependency != svc:
+                if reverse:
+                    waits_for[dependency].add(svc)
+                else:
+                    waits_for[svc].add(dependency)
+        for before in services_list[:i]:
+            if svc not in known or before not in known:
+                waits_for[svc].add(before)
+    pending = list(services_list)
+    running = {}
+    error = None
+    workers = min(len(services_list), SERVICE_ACTION_WORKERS)
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            if error is None:
+                ready = [svc for svc in pending if not waits_for[svc]]
+                if not ready and not running:
+                    log('Dependency cycle between {}, running them in order'
+                        .format(', '.join(pending)), level=INFO)
+                    ready = pending[:1]
+                for svc in ready:
+                    pending.remove(svc)
+                    running[pool.submit(timed, svc)] = svc
+            if not running:
+                break
+            finished, _ = futures.wait(
+                running, return_when=futures.FIRST_COMPLETED)
+            for future in finished:
+                svc = running.pop(future)
+                try:
+                    results[svc], elapsed = future.result()
+                    done(svc, elapsed)
+                except Exception as e:
+                    error = error or e
+                    continue
+                for waiting in waits_for.values():
+                    waiting.discard(svc)
+    if error is not None:
+        raise error
+    return results
+
+
+_restart_queue = None
+# unit kv key of the restarts of a failed hook, replayed by the next one
+PENDING_RESTARTS_KEY = 'charmhelpers.host.pending-restarts'
+
+
+@contextmanager
+def deferred_restarts(dependencies=None, pending_restarts=False):
+    """Queue service restarts, doing them once when the block exits.
+
+    Restarts needed by restart_on_change scopes, and requested with
+    queue_restart(), within the block are added to a single
+    :class:`RestartQueue`.  Nested blocks share the queue of the outermost
+    one, which restarts the services when it exits.
+
+    Should the block raise, other than with a zero exit status, no service
+    is restarted: the hook failed and may have left the configuration
+    partly updated.  The queued restarts were earned by scopes which
+    completed, though, and their changed files will not change again when
+    the hook is retried.  With pending_restarts they are recorded in the
+    unit kv store, and queued again by the next block using
+    pending_restarts, e.g. in the next hook.  Restarts needing a
+    ``can_restart_now_f`` or restart function cannot be recorded and are
+    dropped; ``post_svc_restart_f`` functions are not called for recorded
+    restarts.
+
+    :param dependencies: {service: [services it depends on, ...]}, or a
+                         callable returning them, to restart services
+                         concurrently, see :class:`RestartQueue`.  Only used
+                         by the outermost block.
+    :type dependencies: Optional[Union[Dict[str, List[str]], Callable]]
+    :param pending_restarts: whether to record the restarts of a failed
+                             block and queue those recorded before.  Only
+                             used by the outermost block.
+    :type pending_restarts: bool
+    :returns: the queue
+    :rtype: RestartQueue
+    """
+    global _restart_queue
+    if _restart_queue is not None:
+        yield _restart_queue
+        return
+    _restart_queue = queue = RestartQueue(dependencies)
+    if pending_restarts:
+        _load_restarts(queue)
+    try:
+        yield queue
+    except SystemExit as e:
+        _restart_queue = None
+        if e.code not in (0, None):
+            _drop_restarts(queue, pending_restarts)
+            raise
+        _run_restarts(queue)
+        raise
+    except BaseException:
+        _restart_queue = None
+        _drop_restarts(queue, pending_restarts)
+        raise
+    _restart_queue = None
+    _run_restarts(queue)
+
+
+def _run_restarts(queue):
+    if queue:
+        log('Restarting {}'.format(', '.join(queue.order())), level=DEBUG)
+    queue.run()
+
+
+def _load_restarts(queue):
+    db = unitdata.kv()
+    pending = db.get(PENDING_RESTARTS_KEY) or []
+    if not pending:
+        return
+    log('Restarting {} as a previous hook failed'.format(
+        ', '.join(p['service'] for p in pending)), level=INFO)
+    queue.add([p['service'] for p in pending],
+              changed_files={p['service']: p['changed_files']
+                             for p in pending})
+    for p in pending:
+        if p['stopstart']:
+            queue.add([p['service']], stopstart=True)
+    db.unset(PENDING_RESTARTS_KEY)
+
+
+def _drop_restarts(queue, pending_restarts=False):
+    saved, dropped = [], []
+    for service_name in queue.order():
+        entry = queue.services[service_name]
+        if (not pending_restarts or entry['can_restart_now_fs'] or
+                entry['restart_function']):
+            dropped.append(service_name)
+            continue
+        saved.append({'service': service_name,
+                      'stopstart': entry['stopstart'],
+                      'changed_files': entry['changed_files']})
+    if pending_restarts:
+        # NOTE: flushed, so that the record is kept even if the failed hook
+        # runs in a unit kv transaction.
+        db = unitdata.kv()
+        if saved:
+            db.set(PENDING_RESTARTS_KEY, saved)
+        else:
+            db.unset(PENDING_RESTARTS_KEY)
+        db.flush()
+    if saved:
+        log('Not restarting {} as the hook failed, recorded for the next '
+            'hook'.format(', '.join(p['service'] for p in saved)),
+            level=WARNING)
+    if dropped:
+        log('Not restarting {} as the hook failed'.format(
+            ', '.join(dropped)), level=WARNING)
+
+
+def queue_restart(service_name, post_restart_f=None):
+    """Restart a service, once the outermost deferred_restarts() exits.
+
+    Outside deferred_restarts() the service is restarted straight away.
+
+    :param service_name: the service to restart
+    :type service_name: str
+    :param post_restart_f: called with the service name once it has been
+                           restarted, e.g. to record that it was
+    :type post_restart_f: Optional[Callable[[str], None]]
+    """
+    with deferred_restarts() as queue:
+        queue.add([service_name], post_svc_restart_f=post_restart_f)
+
 
 def pwgen(length=None):
     """Generate a random password."""
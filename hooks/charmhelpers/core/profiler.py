@@ -0,0 +1,184 @@
+# Copyright 2024 Canonical Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Wall time profiler for hook executions.
+
+Code paths of interest are wrapped in :func:`phase`, which records the time
+spent in them under a category such as ``contexts`` or ``renders`` when
+profiling has been enabled for the hook, and does nothing otherwise::
+
+    from charmhelpers.core import profiler
+
+    with profiler.phase('renders', config_file):
+        ...
+
+Phases may nest, the time of a phase is included in the time of any phase
+enclosing it.  The time between interpreter start and :func:`enable` is
+recorded as the ``imports`` phase, so charms should enable profiling as
+early as possible.
+"""
+
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+REPORT_FILE = 'hook-profile.json'
+HISTORY_KEY = 'hook-profiles'
+HISTORY_LENGTH = 50
+# number of individual phases kept in the report, slowest first
+SLOWEST = 25
+
+_lock = threading.Lock()
+_enabled = False
+_start = None
+_totals = {}
+_phases = []
+
+
+def enable():
+    """Start profiling the current hook execution."""
+    global _enabled, _start
+    reset()
+    _enabled = True
+    _start = time.monotonic()
+    imports = _process_age()
+    if imports is not None:
+        record('imports', None, imports)
+
+
+def enabled():
+    """Whether the current hook execution is being profiled.
+
+    :rtype: bool
+    """
+    return _enabled
+
+
+def reset():
+    """Stop profiling and discard the recorded phases."""
+    global _enabled, _start
+    _enabled = False
+    _start = None
+    _totals.clear()
+    del _phases[:]
+
+
+def _process_age():
+    """Seconds since the current process was started, if available.
+
+    :rtype: Optional[float]
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            # the command name may contain spaces, fields resume after it
+            fields = f.read().rsplit(')', 1)[1].split()
+        started = int(fields[19]) / os.sysconf('SC_CLK_TCK')
+        return max(time.clock_gettime(time.CLOCK_BOOTTIME) - started, 0.0)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def record(category, name, elapsed):
+    """Record time spent in a phase.
+
+    :param category: the kind of phase, e.g. 'contexts'
+    :type category: str
+    :param name: what was being done, e.g. the context class name
+    :type name: Optional[str]
+    :param elapsed: wall time in seconds
+    :type elapsed: float
+    """
+    if not _enabled:
+        return
+    with _lock:
+        count, total = _totals.get(category, (0, 0.0))
+        _totals[category] = (count + 1, total + elapsed)
+        _phases.append((elapsed, category, name))
+
+
+@contextmanager
+def phase(category, name=None):
+    """Record the wall time of the enclosed block when profiling.
+
+    :param category: the kind of phase, e.g. 'contexts'
+    :type category: str
+    :param name: what is being done, e.g. the context class name
+    :type name: Optional[str]
+    """
+    if not _enabled:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record(category, name, time.monotonic() - start)
+
+
+def report(hook_name):
+    """Summarise the recorded phases.
+
+    :param hook_name: name of the hook being profiled
+    :type hook_name: str
+    :returns: totals per category and the slowest individual phases
+    :rtype: Dict[str, Any]
+    """
+    with _lock:
+        totals = dict(_totals)
+        slowest = sorted(_phases, key=lambda p: p[0], reverse=True)[:SLOWEST]
+    wall = time.monotonic() - _start if _start is not None else 0.0
+    return {
+        'hook': hook_name,
+        'timestamp': time.time(),
+        'wall_time': round(wall + totals.get('imports', (0, 0.0))[1], 6),
+        'phases': {category: {'count': count, 'time': round(total, 6)}
+                   for category, (count, total) in sorted(totals.items())},
+        'slowest': [{'phase': category, 'name': name,
+                     'time': round(elapsed, 6)}
+                    for elapsed, category, name in slowest],
+    }
+
+
+def save(hook_name, charm_dir, kv, extra=None):
+    """Write the report for the current hook and add it to the history.
+
+    The report is written to ``hook-profile.json`` in the charm directory and
+    appended, without the extra data, to the list of the last reports kept in
+    the unit kv store under ``hook-profiles``.  The kv store is not flushed.
+
+    :param hook_name: name of the hook being profiled
+    :type hook_name: str
+    :param charm_dir: directory to write the report to
+    :type charm_dir: str
+    :param kv: the unit kv store
+    :type kv: charmhelpers.core.unitdata.Storage
+    :param extra: additional data to include in the report
+    :type extra: Optional[Dict[str, Any]]
+    :returns: the report
+    :rtype: Dict[str, Any]
+    """
+    summary = report(hook_name)
+    data = dict(summary, **(extra or {}))
+    path = os.path.join(charm_dir, REPORT_FILE)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+    history = kv.get(HISTORY_KEY) or []
+    history.append(summary)
+    kv.set(HISTORY_KEY, history[-HISTORY_LENGTH:])
+    return data
@@ -0,0 +1,706 @@
+# Copyright 2024 Canonical Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Minimal systemd client speaking D-Bus, so as not to fork systemctl.
+
+Only the few manager methods needed to query and control services are
+implemented, over the private socket systemd provides for root, which needs
+neither a bus daemon nor any python D-Bus bindings::
+
+    from charmhelpers.core import systemd
+
+    states = systemd.active_states(['nova-compute', 'libvirtd'])
+    if states is None:
+        # systemd not reachable over D-Bus, use systemctl
+        ...
+
+:func:`active_states` gets the state of any number of units with a single
+round-trip, :func:`run_job` starts, stops, restarts or reloads a unit and
+waits for the job to complete like systemctl does.  Both return None when
+systemd cannot be reached so that callers fall back to systemctl.
+
+:class:`LocalSystemd` is an in-process stand-in for systemd serving the same
+methods over a socket, for tests::
+
+    with systemd.LocalSystemd({'nova-compute.service': 'active'}) as local:
+        systemd.set_client(systemd.Systemd(local.path))
+"""
+
+import binascii
+import collections
+import os
+import socket
+import struct
+import tempfile
+import threading
+
+from .hookenv import log, DEBUG, WARNING
+
+SYSTEMD_PRIVATE_SOCKET = '/run/systemd/private'
+SYSTEMD_PATH = '/org/freedesktop/systemd1'
+MANAGER_INTERFACE = 'org.freedesktop.systemd1.Manager'
+# seconds to wait for a reply or for a job to complete
+TIMEOUT = 300
+# most signals kept per watched (interface, member), see DBusConnection.watch
+MAX_SIGNALS = 256
+
+JOB_METHODS = {
+    'start': 'StartUnit',
+    'stop': 'StopUnit',
+    'restart': 'RestartUnit',
+    'reload': 'ReloadUnit',
+}
+ACTIVE_STATES = ('active', 'reloading')
+UNIT_TYPES = ('service', 'socket', 'device', 'mount', 'automount', 'swap',
+              'target', 'path', 'timer', 'slice', 'scope')
+
+METHOD_CALL, METHOD_RETURN, ERROR, SIGNAL = 1, 2, 3, 4
+NO_REPLY_EXPECTED = 0x1
+PATH, INTERFACE, MEMBER, ERROR_NAME, REPLY_SERIAL = 1, 2, 3, 4, 5
+DESTINATION, SENDER, SIGNATURE = 6, 7, 8
+_FIELD_TYPES = {PATH: 'o', INTERFACE: 's', MEMBER: 's', ERROR_NAME: 's',
+                REPLY_SERIAL: 'u', DESTINATION: 's', SENDER: 's',
+                SIGNATURE: 'g'}
+_ALIGNMENT = {'y': 1, 'b': 4, 'n': 2, 'q': 2, 'i': 4, 'u': 4, 'x': 8,
+              't': 8, 'd': 8, 'h': 4, 's': 4, 'o': 4, 'g': 1, 'a': 4,
+              '(': 8, '{': 8, 'v': 1}
+_FIXED = {'y': 'B', 'b': 'I', 'n': 'h', 'q': 'H', 'i': 'i', 'u': 'I',
+          'x': 'q', 't': 'Q', 'd': 'd', 'h': 'I'}
+
+
+class DBusError(Exception):
+    """An error reply, or a violation of the protocol."""
+
+    def __init__(self, message, name=None):
+        super(DBusError, self).__init__(message)
+        self.name = name
+
+
+class ReplyLost(DBusError):
+    """The connection failed once a method call was sent.
+
+    The call may have been carried out, e.g. a job queued.
+    """
+
+
+def _type_end(signature, i):
+    """Index following the complete type starting at i in signature."""
+    c = signature[i]
+    if c == 'a':
+        return _type_end(signature, i + 1)
+    if c in '({':
+        close = ')' if c == '(' else '}'
+        i += 1
+        while signature[i] != close:
+            i = _type_end(signature, i)
+    return i + 1
+
+
+def split_signature(signature):
+    """Split a D-Bus signature into its complete types.
+
+    :param signature: e.g. 'sa(ss)'
+    :type signature: str
+    :returns: e.g. ['s', 'a(ss)']
+    :rtype: List[str]
+    """
+    types, i = [], 0
+    while i < len(signature):
+        end = _type_end(signature, i)
+        types.append(signature[i:end])
+        i = end
+    return types
+
+
+def _pad(buf, alignment):
+    buf.extend(b'\0' * (-len(buf) % alignment))
+
+
+def marshal(buf, signature, value):
+    """Append a value of a single complete type to buf.
+
+    Variants are passed as (signature, value) tuples, dicts for arrays of
+    dict entries.  buf must start at an 8 byte boundary of the message.
+    """
+    c = signature[0]
+    _pad(buf, _ALIGNMENT[c])
+    if c in _FIXED:
+        buf.extend(struct.pack('<' + _FIXED[c], value))
+    elif c in 'so':
+        data = value.encode('UTF-8')
+        buf.extend(struct.pack('<I', len(data)) + data + b'\0')
+    elif c == 'g':
+        data = value.encode('UTF-8')
+        buf.extend(struct.pack('<B', len(data)) + data + b'\0')
+    elif c == 'v':
+        marshal(buf, 'g', value[0])
+        marshal(buf, value[0], value[1])
+    elif c == 'a':
+        length_at = len(buf)
+        buf.extend(b'\0' * 4)
+        element = signature[1:]
+        _pad(buf, _ALIGNMENT[element[0]])
+        start = len(buf)
+        items = value.items() if element[0] == '{' else value
+        for item in items:
+            marshal(buf, element, item)
+        struct.pack_into('<I', buf, length_at, len(buf) - start)
+    elif c in '({':
+        for member, item in zip(split_signature(signature[1:-1]), value):
+            marshal(buf, member, item)
+    else:
+        raise DBusError('Unsupported type {}'.format(signature))
+
+
+def unmarshal(data, offset, signature, endian='<'):
+    """Read a value of a single complete type from data.
+
+    Variants are returned as their value, structs as tuples.
+
+    :returns: the value and the offset following it
+    :rtype: Tuple[Any, int]
+    """
+    c = signature[0]
+    offset += -offset % _ALIGNMENT[c]
+    if c in _FIXED:
+        fmt = endian + _FIXED[c]
+        value = struct.unpack_from(fmt, data, offset)[0]
+        offset += struct.calcsize(fmt)
+        return (bool(value) if c == 'b' else value), offset
+    if c in 'sog':
+        if c == 'g':
+            length, offset = data[offset], offset + 1
+        else:
+            length = struct.unpack_from(endian + 'I', data, offset)[0]
+            offset += 4
+        value = bytes(data[offset:offset + length]).decode('UTF-8')
+        return value, offset + length + 1
+    if c == 'v':
+        inner, offset = unmarshal(data, offset, 'g', endian)
+        return unmarshal(data, offset, inner, endian)
+    if c == 'a':
+        length = struct.unpack_from(endian + 'I', data, offset)[0]
+        offset += 4
+        element = signature[1:]
+        offset += -offset % _ALIGNMENT[element[0]]
+        end, items = offset + length, []
+        while offset < end:
+            item, offset = unmarshal(data, offset, element, endian)
+            items.append(item)
+        return (dict(items) if element[0] == '{' else items), offset
+    if c in '({':
+        items = []
+        for member in split_signature(signature[1:-1]):
+            item, offset = unmarshal(data, offset, member, endian)
+            items.append(item)
+        return tuple(items), offset
+    raise DBusError('Unsupported type {}'.format(signature))
+
+
+def encode_message(message_type, serial, fields, signature='', args=(),
+                   flags=0):
+    """Encode a D-Bus message.
+
+    :param fields: {header field code: value}
+    :type fields: Dict[int, Any]
+    :rtype: bytes
+    """
+    body = bytearray()
+    for member, arg in zip(split_signature(signature), args):
+        marshal(body, member, arg)
+    fields = dict(fields)
+    if signature:
+        fields[SIGNATURE] = signature
+    header = bytearray(b'l')
+    header.extend(struct.pack('<BBBII', message_type, flags, 1, len(body),
+                              serial))
+    marshal(header, 'a(yv)',
+            [(code, (_FIELD_TYPES[code], value))
+             for code, value in sorted(fields.items())])
+    _pad(header, 8)
+    return bytes(header + body)
+
+
+def _recv_exact(sock, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise EOFError('D-Bus connection closed')
+        data.extend(chunk)
+    return data
+
+
+def recv_message(sock):
+    """Read a D-Bus message from sock.
+
+    :returns: type, flags, serial, {header field code: value} and the body
+    :rtype: Tuple[int, int, int, Dict[int, Any], tuple]
+    """
+    data = _recv_exact(sock, 16)
+    if data[0:1] not in (b'l', b'B'):
+        raise DBusError('Invalid message endianness {!r}'.format(data[0:1]))
+    endian = '<' if data[0:1] == b'l' else '>'
+    message_type, flags, _, body_length, serial, fields_length = \
+        struct.unpack_from(endian + 'BBBIII', data, 1)
+    header_length = 16 + fields_length
+    header_length += -header_length % 8
+    data.extend(_recv_exact(sock, header_length - 16 + body_length))
+    fields, _ = unmarshal(data, 12, 'a(yv)', endian)
+    fields = dict(fields)
+    body, offset = [], header_length
+    for member in split_signature(fields.get(SIGNATURE, '')):
+        value, offset = unmarshal(data, offset, member, endian)
+        body.append(value)
+    return message_type, flags, serial, fields, tuple(body)
+
+
+class DBusConnection(object):
+    """Peer to peer D-Bus connection over a unix socket.
+
+    Safe for use by several threads; replies and signals are dispatched to
+    the waiting threads by whichever one is reading from the socket.  Only
+    signals watched with :meth:`watch` are kept.
+    """
+
+    def __init__(self, path, timeout=TIMEOUT):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(path)
+            self._authenticate()
+        except Exception:
+            self.sock.close()
+            raise
+        self._serial = 0
+        self._send_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._reading = False
+        self._replies = {}
+        self.signals = {}
+
+    def _authenticate(self):
+        uid = str(os.getuid()).encode('ascii')
+        self.sock.sendall(b'\0AUTH EXTERNAL ' + binascii.hexlify(uid) +
+                          b'\r\n')
+        line = bytearray()
+        while not line.endswith(b'\r\n'):
+            line.extend(_recv_exact(self.sock, 1))
+        if not line.startswith(b'OK '):
+            raise DBusError('D-Bus authentication failed: {}'.format(
+                line.decode('UTF-8', 'replace').strip()))
+        self.sock.sendall(b'BEGIN\r\n')
+
+    def close(self):
+        self.sock.close()
+
+    def watch(self, interface, member):
+        """Keep the bodies of the given signal for :meth:`wait` predicates.
+
+        Signals are received for the whole connection, e.g. for the jobs of
+        other clients, so only the last MAX_SIGNALS of them are kept;
+        predicates are to remove the signals they consume.
+
+        :returns: the signal bodies, oldest first
+        :rtype: collections.deque
+        """
+        with self._cond:
+            return self.signals.setdefault(
+                (interface, member), collections.deque(maxlen=MAX_SIGNALS))
+
+    def call(self, path, interface, member, signature='', *args):
+        """Call a method and wait for its reply.
+
+        :returns: the body of the reply
+        :rtype: tuple
+        :raises: DBusError for error replies, ReplyLost if the connection
+                 failed once the call was sent, OSError or EOFError if it
+                 failed before
+        """
+        with self._send_lock:
+            self._serial += 1
+            serial = self._serial
+            self.sock.sendall(encode_message(
+                METHOD_CALL, serial,
+                {PATH: path, INTERFACE: interface, MEMBER: member},
+                signature, args))
+        try:
+            message_type, fields, body = self.wait(
+                lambda: self._replies.pop(serial, None))
+        except (OSError, EOFError) as e:
+            raise ReplyLost('No reply to {}: {}'.format(member, e))
+        if message_type == ERROR:
+            raise DBusError('{}: {}'.format(fields.get(ERROR_NAME),
+                                            body[0] if body else ''),
+                            name=fields.get(ERROR_NAME))
+        return body
+
+    def wait(self, predicate):
+        """Read messages until predicate returns something other than None.
+
+        Watched signals are kept in :attr:`signals` by (interface, member)
+        for predicates to look at, see :meth:`watch`.
+        """
+        with self._cond:
+            while True:
+                result = predicate()
+                if result is not None:
+                    return result
+                if self._reading:
+                    self._cond.wait()
+                    continue
+                self._reading = True
+                self._cond.release()
+                try:
+                    message = recv_message(self.sock)
+                finally:
+                    self._cond.acquire()
+                    self._reading = False
+                    self._cond.notify_all()
+                self._dispatch(*message)
+
+    def _dispatch(self, message_type, flags, serial, fields, body):
+        if message_type in (METHOD_RETURN, ERROR):
+            self._replies[fields.get(REPLY_SERIAL)] = (
+                message_type, fields, body)
+        elif message_type == SIGNAL:
+            signals = self.signals.get(
+                (fields.get(INTERFACE), fields.get(MEMBER)))
+            if signals is not None:
+                signals.append(body)
+
+
+def unit_name(name):
+    """Full name of a unit, as systemctl assumes a service by default.
+
+    :param name: e.g. 'nova-compute' or 'iscsid.socket'
+    :type name: str
+    :rtype: str
+    """
+    if name.rsplit('.', 1)[-1] in UNIT_TYPES and '.' in name:
+        return name
+    return '{}.service'.format(name)
+
+
+class Systemd(object):
+    """Client for the systemd manager.
+
+    The client is shared by the threads of run_service_actions(); method
+    calls are made one at a time, waiting for jobs to complete is not.
+
+    :param path: the socket to connect to, systemd's private one by default
+    :type path: Optional[str]
+    """
+
+    def __init__(self, path=None, timeout=TIMEOUT):
+        self.connection = DBusConnection(path or SYSTEMD_PRIVATE_SOCKET,
+                                         timeout)
+        self._lock = threading.Lock()
+        self._job_removed = self.connection.watch(MANAGER_INTERFACE,
+                                                  'JobRemoved')
+        self._call('Subscribe')
+
+    def _call(self, method, signature='', *args):
+        with self._lock:
+            return self.connection.call(SYSTEMD_PATH, MANAGER_INTERFACE,
+                                        method, signature, *args)
+
+    def close(self):
+        self.connection.close()
+
+    def active_states(self, names):
+        """ActiveState of units, e.g. 'active', 'inactive' or 'failed'.
+
+        :param names: units, '.service' is assumed without a unit type
+        :type names: List[str]
+        :returns: {name: state}, 'inactive' for units which do not exist
+        :rtype: Dict[str, str]
+        """
+        units = {unit_name(name): name for name in names}
+        (listed,) = self._call('ListUnitsByNames', 'as', list(units))
+        by_id = {unit[0]: unit for unit in listed}
+        by_path = {unit[6]: unit for unit in listed}
+        states = {name: 'inactive' for name in names}
+        for unit, name in units.items():
+            listed_unit = by_id.get(unit)
+            if listed_unit is None:
+                # NOTE: units are listed by their id, which for an alias,
+                # e.g. libvirt-bin of libvirtd, is the name of the unit it
+                # is an alias of.
+                try:
+                    (path,) = self._call('GetUnit', 's', unit)
+                except DBusError as e:
+                    if e.name is None:
+                        raise
+                    continue
+                listed_unit = by_path.get(path)
+            if listed_unit is not None:
+                states[name] = listed_unit[3]
+        return states
+
+    def run_job(self, action, name):
+        """Start, stop, restart or reload a unit and wait for it.
+
+        :param action: one of JOB_METHODS
+        :type action: str
+        :param name: the unit, '.service' is assumed without a unit type
+        :type name: str
+        :returns: whether the job completed successfully
+        :rtype: bool
+        :raises: ReplyLost if the connection failed once the job may have
+                 been queued, OSError or EOFError if it failed before
+        """
+        try:
+            (job,) = self._call(JOB_METHODS[action], 'ss', unit_name(name),
+                                'replace')
+        except ReplyLost:
+            raise
+        except DBusError as e:
+            log('Unable to {} {}: {}'.format(action, name, e), level=DEBUG)
+            return False
+        removed = self._job_removed
+
+        def job_result():
+            for i, (_, path, _, result) in enumerate(removed):
+                if path == job:
+                    del removed[i]
+                    return result
+
+        try:
+            result = self.connection.wait(job_result)
+        except (OSError, EOFError) as e:
+            raise ReplyLost('{} {}: job {} not completed: {}'.format(
+                action, name, job, e))
+        if result != 'done':
+            log('{} {}: job {}'.format(action, name, result), level=DEBUG)
+        return result == 'done'
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def client():
+    """The systemd client of this process.
+
+    :returns: the client, None if systemd is not reachable over D-Bus
+    :rtype: Optional[Systemd]
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            try:
+                _client = Systemd()
+            except (OSError, EOFError, DBusError) as e:
+                log('systemd not reachable over D-Bus, using systemctl: '
+                    '{}'.format(e), level=DEBUG)
+                _client = False
+        return _client or None
+
+
+def set_client(systemd_client):
+    """Use the given client, e.g. for a :class:`LocalSystemd`.
+
+    :param systemd_client: the client, None to connect to systemd again
+                           on next use, False to always use systemctl
+    :type systemd_client: Optional[Union[Systemd, bool]]
+    """
+    global _client
+    with _client_lock:
+        _client = systemd_client
+
+
+def _disable(error):
+    log('systemd D-Bus connection failed, using systemctl: {}'.format(error),
+        level=DEBUG)
+    set_client(False)
+
+
+def active_states(names):
+    """ActiveState of units with a single round-trip.
+
+    :param names: units, '.service' is assumed without a unit type
+    :type names: List[str]
+    :returns: {name: state}, None if systemd is not reachable over D-Bus
+    :rtype: Optional[Dict[str, str]]
+    """
+    systemd = client()
+    if systemd is None:
+        return None
+    try:
+        return systemd.active_states(names)
+    except (OSError, EOFError, DBusError) as e:
+        _disable(e)
+        return None
+
+
+def run_job(action, name):
+    """Start, stop, restart or reload a unit and wait for it.
+
+    :param action: one of JOB_METHODS
+    :type action: str
+    :param name: the unit, '.service' is assumed without a unit type
+    :type name: str
+    :returns: whether the job completed successfully, None if systemd is not
+              reachable over D-Bus or the action is not a job.  Should the
+              connection fail once the job may have been queued, False
+              rather than None so that the action is not run twice.
+    :rtype: Optional[bool]
+    """
+    if action not in JOB_METHODS:
+        return None
+    systemd = client()
+    if systemd is None:
+        return None
+    try:
+        return systemd.run_job(action, name)
+    except ReplyLost as e:
+        log('Unable to {} {}: {}'.format(action, name, e), level=WARNING)
+        _disable(e)
+        return False
+    except (OSError, EOFError, DBusError) as e:
+        _disable(e)
+        return None
+
+
+class LocalSystemd(object):
+    """In-process stand-in for systemd, for tests.
+
+    Serves the manager methods used by :class:`Systemd` over a unix socket in
+    a temporary directory, completing jobs straight away.
+
+    :param units: {unit: ActiveState} of the existing units
+    :type units: Dict[str, str]
+    :param results: {unit: job result} for jobs not to be 'done', None for
+                    jobs never completing
+    :type results: Dict[str, Optional[str]]
+    :param aliases: {alias: unit}
+    :type aliases: Dict[str, str]
+    """
+
+    def __init__(self, units=None, results=None, aliases=None):
+        self.units = dict(units or {})
+        self.results = dict(results or {})
+        self.aliases = dict(aliases or {})
+        # method calls received, (method, args)
+        self.calls = []
+        self._dir = tempfile.mkdtemp()
+        self.path = os.path.join(self._dir, 'private')
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.path)
+        self._server.listen(8)
+        self._jobs = 0
+        self._lock = threading.Lock()
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._server.close()
+        try:
+            os.unlink(self.path)
+            os.rmdir(self._dir)
+        except OSError:
+            pass
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        try:
+            buf = bytearray()
+            while b'BEGIN\r\n' not in buf:
+                if buf.endswith(b'\r\n') and b'AUTH' in buf:
+                    conn.sendall(b'OK 0123456789abcdef0123456789abcdef\r\n')
+                    del buf[:]
+                buf.extend(_recv_exact(conn, 1))
+            serial = 0
+            while True:
+                message_type, flags, call_serial, fields, body = \
+                    recv_message(conn)
+                if message_type != METHOD_CALL:
+                    continue
+                for reply in self._handle(fields.get(MEMBER), body):
+                    serial += 1
+                    reply_type, reply_fields, signature, args = reply
+                    if reply_type != SIGNAL:
+                        reply_fields[REPLY_SERIAL] = call_serial
+                    conn.sendall(encode_message(reply_type, serial,
+                                                reply_fields, signature,
+                                                args))
+        except (OSError, EOFError):
+            pass
+        finally:
+            conn.close()
+
+    def _handle(self, method, args):
+        """Replies to a method call, (type, fields, signature, args)."""
+        with self._lock:
+            self.calls.append((method, args))
+            if method == 'Subscribe':
+                return [(METHOD_RETURN, {}, '', ())]
+            if method == 'ListUnitsByNames':
+                # NOTE: as systemd, units which do not exist are listed as
+                # not-found and aliases by the name of their unit.
+                names = [self.aliases.get(name, name) for name in args[0]]
+                listed = [(name, '',
+                           'loaded' if name in self.units else 'not-found',
+                           self.units.get(name, 'inactive'), '', '',
+                           self._unit_path(name), 0, '', '/')
+                          for name in names]
+                return [(METHOD_RETURN, {}, 'a(ssssssouso)', (listed,))]
+            action = {v: k for k, v in JOB_METHODS.items()}.get(method)
+            if action is None and method != 'GetUnit':
+                return [(ERROR, {ERROR_NAME:
+                                 'org.freedesktop.DBus.Error.UnknownMethod'},
+                         's', (method,))]
+            name = self.aliases.get(args[0], args[0])
+            if name not in self.units:
+                return [(ERROR,
+                         {ERROR_NAME: 'org.freedesktop.systemd1.NoSuchUnit'},
+                         's', ('Unit {} not found.'.format(args[0]),))]
+            if action is None:
+                return [(METHOD_RETURN, {}, 'o', (self._unit_path(name),))]
+            self._jobs += 1
+            job = '{}/job/{}'.format(SYSTEMD_PATH, self._jobs)
+            result = self.results.get(name, 'done')
+            if result == 'done':
+                self.units[name] = 'inactive' if action == 'stop' else 'active'
+            elif result == 'failed':
+                self.units[name] = 'failed'
+            elif result is None:
+                return [(METHOD_RETURN, {}, 'o', (job,))]
+            return [
+                (METHOD_RETURN, {}, 'o', (job,)),
+                (SIGNAL, {PATH: SYSTEMD_PATH, INTERFACE: MANAGER_INTERFACE,
+                          MEMBER: 'JobRemoved'},
+                 'uoss', (self._jobs, job, name, result)),
+            ]
+
+    @staticmethod
+    def _unit_path(name):
+        return '{}/unit/{}'.format(SYSTEMD_PATH, name)
@@ -147,6 +147,7 @@ associated to the hookname.
 """
 
 import collections
+import bisect
 import contextlib
 import datetime
 import itertools
@@ -159,6 +160,11 @@ import sys
 
 __author__ = 'Kapil Thangavelu <kapil.foss@gmail.com>'
 
+# UPSERT was added in sqlite 3.24
+HAVE_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+# marks keys removed within a hook transaction
+_DELETED = object()
+
 
 class Storage(object):
     """Simple key value database for local unit state within charms.
@@ -171,8 +177,19 @@ class Storage(object):
     Note: to facilitate unit testing, ':memory:' can be passed as the
     path parameter which causes sqlite3 to only build the db in memory.
     This should only be used for testing purposes.
+
+    Within :meth:`hook_transaction` modifications are kept in memory and
+    written to the database with a single commit at the end, see there.
+
+    With preload the whole kv table is read into memory with a single query
+    when the database is opened, and reads are served from memory.  Keys are
+    kept sorted, so :meth:`getrange` and :meth:`unsetrange` look up prefixes
+    by bisection.  Before each read sqlite's data_version is checked and the
+    table read again if another connection, e.g. an action, has committed
+    changes since.  Reads are therefore never staler than with one query per
+    key.
     """
-    def __init__(self, path=None, keep_revisions=False):
+    def __init__(self, path=None, keep_revisions=False, preload=False):
         self.db_path = path
         self.keep_revisions = keep_revisions
         if path is None:
@@ -186,26 +203,130 @@ class Storage(object):
                 os.fchmod(f.fileno(), 0o600)
         self.conn = sqlite3.connect('%s' % self.db_path)
         self.cursor = self.conn.cursor()
+        if self.db_path != ':memory:':
+            # readers, e.g. actions, do not block and are not blocked by
+            # the hook writing to the database
+            self.cursor.execute('pragma journal_mode=wal')
         self.revision = None
         self._closed = False
+        # modifications pending within a hook transaction, key -> serialized
+        # value or _DELETED.  _flushed holds those made before the last call
+        # to flush(), which are written out even if the hook fails.
+        self._pending = None
+        self._flushed = None
+        # key -> serialized value of the whole kv table and its sorted keys,
+        # as of the data_version of the database they were read at
+        self._cache = None
+        self._index = None
+        self._data_version = None
         self._init()
+        if preload:
+            self._load()
+
+    def _load(self):
+        """Read the whole kv table into memory."""
+        self._data_version = self._get_data_version()
+        self.cursor.execute('select key, data from kv')
+        self._cache = dict(self.cursor.fetchall())
+        self._index = sorted(self._cache)
+
+    def _get_data_version(self):
+        self.cursor.execute('pragma data_version')
+        return self.cursor.fetchone()[0]
+
+    def _cached(self):
+        """Whether reads can be served from memory.
+
+        The table is read again if another connection committed changes
+        since it was loaded.
+        """
+        if self._cache is None:
+            return False
+        if self._get_data_version() != self._data_version:
+            self._load()
+        return True
+
+    def _cache_set(self, key, data):
+        if self._cache is None:
+            return
+        if key not in self._cache:
+            bisect.insort(self._index, key)
+        self._cache[key] = data
+
+    def _cache_unset(self, keys):
+        if self._cache is None:
+            return
+        for key in keys:
+            if self._cache.pop(key, None) is not None:
+                del self._index[bisect.bisect_left(self._index, key)]
+
+    def _db_get(self, key):
+        """Serialized value of key in the database, None if not set."""
+        if self._cached():
+            return self._cache.get(key)
+        self.cursor.execute('select data from kv where key=?', [key])
+        result = self.cursor.fetchone()
+        return result[0] if result else None
+
+    def _db_range(self, key_prefix):
+        """Keys starting with key_prefix and their serialized values."""
+        if self._cached():
+            keys = []
+            for i in range(bisect.bisect_left(self._index, key_prefix),
+                           len(self._index)):
+                if not self._index[i].startswith(key_prefix):
+                    break
+                keys.append(self._index[i])
+            return [(k, self._cache[k]) for k in keys]
+        if not key_prefix:
+            self.cursor.execute('select key, data from kv')
+        else:
+            # a range scan of the primary key index, rather than LIKE which
+            # is case insensitive and treats _ and % as wildcards
+            self.cursor.execute(
+                'select key, data from kv where key >= ? and key < ?',
+                _prefix_bounds(key_prefix))
+        return self.cursor.fetchall()
 
     def close(self):
         if self._closed:
             return
+        self._cache = self._index = None
         self.flush(False)
         self.cursor.close()
         self.conn.close()
         self._closed = True
 
+    def _overlay(self, key):
+        """Serialized value of key modified in the hook transaction.
+
+        :returns: the value, _DELETED or None if key was not modified
+        """
+        if self._pending is None:
+            return None
+        value = self._pending.get(key)
+        if value is None:
+            value = self._flushed.get(key)
+        return value
+
+    def _overlay_range(self, key_prefix):
+        if self._pending is None:
+            return {}
+        overlay = {k: v for k, v in self._flushed.items()
+                   if k.startswith(key_prefix)}
+        overlay.update((k, v) for k, v in self._pending.items()
+                       if k.startswith(key_prefix))
+        return overlay
+
     def get(self, key, default=None, record=False):
-        self.cursor.execute('select data from kv where key=?', [key])
-        result = self.cursor.fetchone()
-        if not result:
+        data = self._overlay(key)
+        if data is None:
+            data = self._db_get(key)
+        if data is None or data is _DELETED:
             return default
         if record:
-            return Record(json.loads(result[0]))
-        return json.loads(result[0])
+            return Record(json.loads(data))
+        return json.loads(data)
 
     def getrange(self, key_prefix, strip=False):
         """
@@ -217,9 +338,12 @@ class Storage(object):
             names in the returned dict
         :return dict: A (possibly empty) dict of key-value mappings
         """
-        self.cursor.execute("select key, data from kv where key like ?",
-                            ['%s%%' % key_prefix])
-        result = self.cursor.fetchall()
+        result = self._db_range(key_prefix)
+        overlay = self._overlay_range(key_prefix)
+        if overlay:
+            result = dict(result)
+            result.update(overlay)
+            result = [(k, v) for k, v in result.items() if v is not _DELETED]
 
         if not result:
             return {}
@@ -243,7 +367,11 @@ class Storage(object):
         """
         Remove a key from the database entirely.
         """
+        if self._pending is not None:
+            self._pending[key] = _DELETED
+            return
         self.cursor.execute('delete from kv where key=?', [key])
+        self._cache_unset([key])
         if self.keep_revisions and self.revision and self.cursor.rowcount:
             self.cursor.execute(
                 'insert into kv_revisions values (?, ?, ?)',
@@ -258,16 +386,31 @@ class Storage(object):
         :param str prefix: Optional prefix to apply to all keys in ``keys``
             before removing.
         """
+        if self._pending is not None:
+            if keys is not None:
+                keys = ['%s%s' % (prefix, key) for key in keys]
+            else:
+                keys = list(self.getrange(prefix).keys())
+            for key in keys:
+                self._pending[key] = _DELETED
+            return
         if keys is not None:
             keys = ['%s%s' % (prefix, key) for key in keys]
+            self._cache_unset(keys)
             self.cursor.execute('delete from kv where key in (%s)' % ','.join(['?'] * len(keys)), keys)
             if self.keep_revisions and self.revision and self.cursor.rowcount:
                 self.cursor.execute(
                     'insert into kv_revisions values %s' % ','.join(['(?, ?, ?)'] * len(keys)),
                     list(itertools.chain.from_iterable((key, self.revision, json.dumps('DELETED')) for key in keys)))
         else:
-            self.cursor.execute('delete from kv where key like ?',
-                                ['%s%%' % prefix])
+            if self._cache is not None:
+                self._cache_unset([k for k, _ in self._db_range(prefix)])
+            if not prefix:
+                self.cursor.execute('delete from kv')
+            else:
+                self.cursor.execute(
+                    'delete from kv where key >= ? and key < ?',
+                    _prefix_bounds(prefix))
             if self.keep_revisions and self.revision and self.cursor.rowcount:
                 self.cursor.execute(
                     'insert into kv_revisions values (?, ?, ?)',
@@ -282,6 +425,24 @@ class Storage(object):
         """
         serialized = json.dumps(value)
 
+        if self._pending is not None:
+            self._pending[key] = serialized
+            return value
+
+        # Skip mutations to the same value
+        if self._cached() and self._cache.get(key) == serialized:
+            return value
+
+        if HAVE_UPSERT:
+            self.cursor.execute(
+                '''insert into kv (key, data) values (?, ?)
+                on conflict(key) do update set data = excluded.data
+                where data != excluded.data''', (key, serialized))
+            self._cache_set(key, serialized)
+            if not self.cursor.rowcount:
+                return value
+            return self._set_revision(key, serialized, value)
+
         self.cursor.execute('select data from kv where key=?', [key])
         exists = self.cursor.fetchone()
 
@@ -299,7 +460,11 @@ class Storage(object):
             update kv
             set data = ?
             where key = ?''', [serialized, key])
+        self._cache_set(key, serialized)
+
+        return self._set_revision(key, serialized, value)
 
+    def _set_revision(self, key, serialized, value):
         # Save
         if (not self.keep_revisions) or (not self.revision):
             return value
@@ -374,13 +539,73 @@ class Storage(object):
         else:
             self.flush()
 
+    @contextlib.contextmanager
+    def hook_transaction(self):
+        """Keep modifications in memory, writing them out once at the end.
+
+        Within the transaction :meth:`flush` does not commit; the
+        modifications are written out with upserts and a single commit when
+        the block exits.  Should the block raise, only the modifications made
+        before the last call to :meth:`flush` are written out, as they would
+        have been committed already outside the transaction.  A successful
+        ``sys.exit()``, with a status of 0 or None, is not an error.  Nested
+        transactions join the outer one.  Storage keeping revisions does not
+        support transactions, modifications are written through.
+        """
+        if self._pending is not None or self.keep_revisions:
+            yield self
+            return
+        self._pending, self._flushed = {}, {}
+        try:
+            yield self
+        except SystemExit as e:
+            if e.code not in (0, None):
+                self._pending.clear()
+            raise
+        except Exception:
+            self._pending.clear()
+            raise
+        finally:
+            pending = self._flushed
+            pending.update(self._pending)
+            self._pending = self._flushed = None
+            self._write(pending)
+            self.conn.commit()
+
+    def _write(self, pending):
+        """Write out modifications from a hook transaction."""
+        deleted = [k for k, v in pending.items() if v is _DELETED]
+        updated = [(k, v) for k, v in pending.items() if v is not _DELETED]
+        self._cache_unset(deleted)
+        for k, v in updated:
+            self._cache_set(k, v)
+        if deleted:
+            self.cursor.executemany('delete from kv where key=?',
+                                    [(k,) for k in deleted])
+        if updated and HAVE_UPSERT:
+            self.cursor.executemany(
+                '''insert into kv (key, data) values (?, ?)
+                on conflict(key) do update set data = excluded.data
+                where data != excluded.data''', updated)
+        elif updated:
+            self.cursor.executemany(
+                'insert or replace into kv (key, data) values (?, ?)',
+                updated)
+
     def flush(self, save=True):
+        if self._pending is not None:
+            if save:
+                self._flushed.update(self._pending)
+            self._pending.clear()
+            return
         if save:
             self.conn.commit()
         elif self._closed:
             return
         else:
             self.conn.rollback()
+            if self._cache is not None:
+                self._load()
 
     def _init(self):
         self.cursor.execute('''
@@ -424,6 +649,12 @@ class Storage(object):
         pprint.pprint(self.cursor.fetchall(), stream=fh)
 
 
+def _prefix_bounds(prefix):
+    """Bounds of the keys starting with a non-empty prefix, for a range
+    scan ``key >= lower and key < upper``."""
+    return [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+
+
 def _parse_history(d):
     return (d[0], d[1], json.loads(d[2]), d[3],
             datetime.datetime.strptime(d[-1], "%Y-%m-%dT%H:%M:%S.%f"))
@@ -554,9 +785,9 @@ def kv():
 
     if _KV is None:
         if in_memory_db:
-            _KV = Storage(":memory:")
+            _KV = Storage(":memory:", preload=True)
         else:
-            _KV = Storage()
+            _KV = Storage(preload=True)
     else:
         if in_memory_db and _KV.db_path != ":memory:":
             logging.warning("Running with in_memory_db and KV is not set to :memory:")
@@ -366,19 +366,44 @@ CMD_RETRY_DELAY = 10  # Wait 10 seconds between command retries.
 CMD_RETRY_COUNT = 10  # Retry a failing fatal command X times.
 
 
+# Per hook cache of package name -> whether it is installed, populated by
+# filter_installed_packages() and invalidated whenever apt-get is run.
+_installed_packages_cache = {}
+
+
+def reset_installed_packages_cache():
+    """Forget what is known about installed packages."""
+    _installed_packages_cache.clear()
+
+
 def filter_installed_packages(packages):
-    """Return a list of packages that require installation."""
-    cache = apt_cache()
-    _pkgs = []
-    for package in packages:
-        try:
-            p = cache[package]
-            p.current_ver or _pkgs.append(package)
-        except KeyError:
-            log('Package {} has no installation candidate.'.format(package),
-                level='WARNING')
-            _pkgs.append(package)
-    return _pkgs
+    """Return a list of packages that require installation.
+
+    The state of all packages not seen before in this hook is retrieved with
+    a single ``dpkg-query`` call, and ``apt-cache`` is only consulted for the
+    packages which are not installed, to warn about those that have no
+    installation candidate.
+
+    :param packages: list of packages to evaluate.
+    :type packages: List[str]
+    :returns: Packages that are not installed.
+    :rtype: List[str]
+    """
+    unknown = [p for p in OrderedDict.fromkeys(packages)
+               if p not in _installed_packages_cache]
+    if unknown:
+        cache = apt_cache()
+        installed = cache.dpkg_list(unknown)
+        missing = [p for p in unknown if p not in installed]
+        if missing:
+            candidates = cache._apt_cache_show(missing)
+            for package in missing:
+                if package not in candidates:
+                    log('Package {} has no installation candidate.'
+                        .format(package), level='WARNING')
+        for package in unknown:
+            _installed_packages_cache[package] = package in installed
+    return [p for p in packages if not _installed_packages_cache[p]]
 
 
 def filter_missing_packages(packages):
@@ -1041,16 +1066,21 @@ def _run_apt_command(cmd, fatal=False, quiet=False):
         stderr
     :type quiet: bool
     """
-    if fatal:
-        _run_with_retries(
-            cmd, retry_exitcodes=(1, APT_ERROR_CODE,),
-            quiet=quiet)
-    else:
-        kwargs = {}
-        if quiet:
-            kwargs['stdout'] = subprocess.DEVNULL
-            kwargs['stderr'] = subprocess.DEVNULL
-        subprocess.call(cmd, env=get_apt_dpkg_env(), **kwargs)
+    try:
+        if fatal:
+            _run_with_retries(
+                cmd, retry_exitcodes=(1, APT_ERROR_CODE,),
+                quiet=quiet)
+        else:
+            kwargs = {}
+            if quiet:
+                kwargs['stdout'] = subprocess.DEVNULL
+                kwargs['stderr'] = subprocess.DEVNULL
+            subprocess.call(cmd, env=get_apt_dpkg_env(), **kwargs)
+    finally:
+        # NOTE: reset once apt-get is done, so that packages looked up
+        # meanwhile are not kept with their state from before.
+        reset_installed_packages_cache()
 
 
 def get_upstream_version(package):
@@ -35,6 +35,8 @@ so with this we get rid of the dependency.
 2: https://bugs.debian.org/cgi-bin/bugreport.cgi?bug=845330#10
 """
 
+import fnmatch
+import json
 import locale
 import os
 import subprocess
@@ -58,10 +60,206 @@ class Version(_container):
     """Simple container for version attributes."""
 
 
+class _IndexedPackage(Package):
+    """Package built from the dpkg status index.
+
+    The fields provided by ``apt-cache show`` are only retrieved when first
+    accessed, as most consumers only look at ``current_ver``.
+    """
+
+    # NOTE: kept as an attribute rather than a key, attribute assignment on
+    # a _container sets a key, so that the record only holds package fields.
+    _apt_loaded = False
+
+    def __missing__(self, key):
+        if not self._apt_loaded:
+            object.__setattr__(self, '_apt_loaded', True)
+            apt_result = Cache()._apt_cache_show([self['name']]).get(
+                self['name'], {})
+            apt_result.pop('package', None)
+            for k, v in apt_result.items():
+                self.setdefault(k, v)
+            if key in self:
+                return self[key]
+        raise KeyError(key)
+
+
+DPKG_STATUS_FILE = '/var/lib/dpkg/status'
+
+
+class DpkgStatusIndex(object):
+    """Index of installed packages parsed from the dpkg status file.
+
+    The index is rebuilt whenever the mtime or size of the status file
+    changes.  When ``index_file`` is given the index is persisted there along
+    with the stat of the status file it was built from, so subsequent
+    processes do not need to parse the status file unless packages have been
+    installed or removed in the meantime.
+    """
+
+    def __init__(self, status_file=DPKG_STATUS_FILE, index_file=None):
+        self.status_file = status_file
+        self.index_file = index_file
+        self._key = None
+        self._packages = {}
+
+    def _stat_key(self):
+        st = os.stat(self.status_file)
+        return [st.st_mtime_ns, st.st_size]
+
+    def _load(self):
+        if not self.index_file:
+            return None
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save(self):
+        if not self.index_file:
+            return
+        tmp = '{}.{}.tmp'.format(self.index_file, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'key': self._key, 'packages': self._packages}, f)
+            os.rename(tmp, self.index_file)
+        except OSError as e:
+            log('Unable to persist dpkg status index to {}: {}'
+                .format(self.index_file, e), level='WARNING')
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def _parse(self):
+        """Parse installed packages from the status file.
+
+        :returns: Map of package name to a list of ``[architecture, version,
+                  summary]`` entries, one per installed architecture.
+        :rtype: Dict[str, List[List[str]]]
+        """
+        packages = {}
+        fields = {}
+        with open(self.status_file, encoding='UTF-8',
+                  errors='replace') as f:
+            for line in f:
+                if line.startswith((' ', '\t')):
+                    continue
+                line = line.rstrip('\n')
+                if line:
+                    key, _, value = line.partition(':')
+                    fields[key] = value.strip()
+                    continue
+                self._add(packages, fields)
+                fields = {}
+        self._add(packages, fields)
+        return packages
+
+    @staticmethod
+    def _add(packages, fields):
+        # only keep packages ``dpkg_list`` would report, i.e. those with
+        # an ``ii`` or ``hi`` status abbreviation
+        status = fields.get('Status', '').split()
+        if (len(status) != 3 or status[0] not in ('install', 'hold') or
+                status[1] != 'ok' or status[2] != 'installed'):
+            return
+        packages.setdefault(fields['Package'], []).append(
+            [fields.get('Architecture', ''), fields.get('Version', ''),
+             fields.get('Description', '')])
+
+    def packages(self):
+        """Get the index, refreshing it if the status file has changed.
+
+        :returns: Map of package name to installed ``[architecture, version,
+                  summary]`` entries.
+        :rtype: Dict[str, List[List[str]]]
+        :raises: OSError
+        """
+        key = self._stat_key()
+        if key == self._key:
+            return self._packages
+        persisted = self._load()
+        if persisted and persisted.get('key') == key:
+            self._packages = persisted['packages']
+            self._key = key
+            return self._packages
+        self._packages = self._parse()
+        self._key = key
+        self._save()
+        return self._packages
+
+    def dpkg_list(self, packages):
+        """Look up packages like ``Cache.dpkg_list`` does.
+
+        :param packages: Packages to get data from, may contain wildcards
+                         and an architecture qualifier.
+        :type packages: List[str]
+        :returns: Structured data about installed packages
+        :rtype: dict
+        :raises: OSError
+        """
+        index = self.packages()
+        pkgs = {}
+        for package in packages:
+            name, _, arch = package.partition(':')
+            if any(c in name for c in '*?['):
+                names = sorted(fnmatch.filter(index, name))
+            else:
+                names = [name] if name in index else []
+            for name in names:
+                for _arch, version, desc in index[name]:
+                    if arch and arch != _arch:
+                        continue
+                    pkgs[name] = {
+                        'name': name,
+                        'version': version,
+                        'architecture': _arch,
+                        'description': desc,
+                    }
+        return pkgs
+
+
+_dpkg_status_index = None
+
+
+def enable_dpkg_status_index(index_file=None):
+    """Resolve installed packages from the dpkg status file.
+
+    Once enabled ``Cache`` looks up installed packages in an index of
+    ``/var/lib/dpkg/status`` instead of calling out to ``dpkg-query``, and
+    only calls ``apt-cache`` when data about the package candidate is
+    needed.
+
+    :param index_file: Path to persist the index to across processes.
+    :type index_file: Optional[str]
+    :returns: The index in use.
+    :rtype: DpkgStatusIndex
+    """
+    global _dpkg_status_index
+    if (_dpkg_status_index is None or
+            _dpkg_status_index.index_file != index_file):
+        _dpkg_status_index = DpkgStatusIndex(index_file=index_file)
+    return _dpkg_status_index
+
+
+def disable_dpkg_status_index():
+    """Go back to querying ``dpkg-query`` for installed packages."""
+    global _dpkg_status_index
+    _dpkg_status_index = None
+
+
 class Cache(object):
     """Simulation of ``apt_pkg`` Cache object."""
-    def __init__(self, progress=None):
-        pass
+    def __init__(self, progress=None, dpkg_status_index=None):
+        """Create cache.
+
+        :param progress: Accepted for compatibility, not used.
+        :type progress: any
+        :param dpkg_status_index: Index to look up installed packages in,
+                                  defaults to the one enabled with
+                                  ``enable_dpkg_status_index()``, if any.
+        :type dpkg_status_index: Optional[DpkgStatusIndex]
+        """
+        self._index = dpkg_status_index or _dpkg_status_index
 
     def __contains__(self, package):
         try:
@@ -79,6 +277,13 @@ class Cache(object):
         :rtype: object
         :raises: KeyError, subprocess.CalledProcessError
         """
+        if self._index:
+            dpkg_result = self.dpkg_list([package]).get(package)
+            if dpkg_result:
+                return _IndexedPackage(
+                    name=package,
+                    current_ver=Version({'ver_str': dpkg_result['version']}),
+                    architecture=dpkg_result['architecture'])
         apt_result = self._apt_cache_show([package])[package]
         apt_result['name'] = apt_result.pop('package')
         pkg = Package(apt_result)
@@ -121,6 +326,12 @@ class Cache(object):
         :rtype: dict
         :raises: subprocess.CalledProcessError
         """
+        if self._index:
+            try:
+                return self._index.dpkg_list(packages)
+            except OSError as e:
+                log('Unable to read dpkg status index, falling back to '
+                    'dpkg-query: {}'.format(e), level='WARNING')
         pkgs = {}
         cmd = [
             'dpkg-query', '--show',
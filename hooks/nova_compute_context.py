@@ -20,11 +20,14 @@ import socket
 import subprocess
 import uuid
 
+from collections.abc import Mapping
 from typing import (
     Dict,
     Optional,
 )
 
+import yaml
+
 from charmhelpers.core.unitdata import kv
 from charmhelpers.contrib.openstack import context
 
@@ -47,6 +50,7 @@ from charmhelpers.core.hookenv import (
     DEBUG,
     ERROR,
     INFO,
+    WARNING,
 )
 from charmhelpers.contrib.openstack.utils import (
     get_os_version_package,
@@ -62,6 +66,24 @@ from charmhelpers.contrib.network.ip import (
     get_relation_ip,
 )
 
+from nova_compute_cpus import (
+    check_cpu_sets,
+    cpu_sets,
+)
+from nova_compute_hugepages import (
+    hugepage_reservations,
+    merge_reservations,
+)
+from nova_compute_ksm import (
+    is_ksm_profile,
+    ksm_enabled,
+    ksm_sleep_millisecs,
+)
+from nova_compute_memory import (
+    RBD_CACHE_SIZE,
+    RESERVED_HOST_MEMORY_KEY,
+)
+
 # This is just a label and it must be consistent across
 # nova-compute nodes to support live migration. It needs to
 # change whenever CEPH_SECRET_UUID also changes.
@@ -82,6 +104,148 @@ NOVA_COMPUTE_AA_PROFILE = 'usr.bin.nova-compute'
 NOVA_NETWORK_AA_PROFILE = 'usr.bin.nova-network'
 
 
+class ConfigSnapshot(Mapping):
+    """Read-only snapshot of the charm config.
+
+    Maps every option in config.yaml, or in the config the snapshot was
+    built from, to its value.  As with ``config(name)``, an unknown option
+    reads as None, e.g. when config.yaml could not be loaded and the option
+    has no default.  Options which need parsing are exposed as attributes,
+    parsed once on first use.  The parsed values are shared by all users of
+    the snapshot and must not be modified.
+    """
+
+    __slots__ = ('_values', '_derived')
+
+    def __init__(self, values):
+        object.__setattr__(self, '_values', dict(values))
+        object.__setattr__(self, '_derived', {})
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ConfigSnapshot is read-only')
+
+    def __delattr__(self, name):
+        raise AttributeError('ConfigSnapshot is read-only')
+
+    def __getitem__(self, key):
+        return self._values.get(key)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def _derive(self, name, parse):
+        try:
+            return self._derived[name]
+        except KeyError:
+            value = self._derived[name] = parse()
+            return value
+
+    @property
+    def cpu_model_extra_flags(self):
+        """cpu-model-extra-flags split into the individual flags.
+
+        :rtype: Tuple[str, ...]
+        """
+        return self._derive(
+            'cpu_model_extra_flags',
+            lambda: tuple((self.get('cpu-model-extra-flags') or '').split()))
+
+    @property
+    def reserved_huge_pages(self):
+        """reserved-huge-pages split into the per NUMA node reservations.
+
+        To bypass the juju limitation with list of strings the values of the
+        option are separated by semicolons.
+
+        :rtype: Tuple[str, ...]
+        """
+        return self._derive(
+            'reserved_huge_pages',
+            lambda: tuple(o.strip() for o in
+                          (self.get('reserved-huge-pages') or '').split(';')
+                          if o.strip()))
+
+    @property
+    def pci_aliases(self):
+        """pci-alias parsed from JSON, a dict or a list of dicts.
+
+        :rtype: Optional[Union[Dict[str, Any], List[Dict[str, Any]]]]
+        :raises: ValueError if the option is not valid JSON
+        """
+        return self._derive(
+            'pci_aliases',
+            lambda: (json.loads(self['pci-alias'])
+                     if self.get('pci-alias') else None))
+
+
+CONFIG_YAML = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'config.yaml')
+_config_defaults = None
+
+
+def config_defaults():
+    """Defaults of the options in config.yaml.
+
+    Options without a default are omitted by ``config-get --all``, they are
+    included here with a value of None.
+
+    :rtype: Dict[str, Any]
+    """
+    global _config_defaults
+    if _config_defaults is None:
+        try:
+            with open(CONFIG_YAML) as f:
+                options = yaml.safe_load(f).get('options') or {}
+        except (OSError, yaml.YAMLError, AttributeError) as e:
+            log('Unable to load config defaults: {}'.format(e),
+                level=ERROR)
+            options = {}
+        _config_defaults = {k: (v or {}).get('default')
+                            for k, v in options.items()}
+    return _config_defaults
+
+
+_config_snapshot = None
+_config_snapshot_source = None
+
+
+def config_snapshot():
+    """Get a snapshot of the charm config for the current hook.
+
+    The snapshot is built once from the config.yaml defaults and the config
+    loaded by ``config()``, and rebuilt only if ``config()`` starts returning
+    a different object, e.g. after ``reset_config_snapshot()``.
+
+    :returns: the charm config
+    :rtype: ConfigSnapshot
+    """
+    global _config_snapshot, _config_snapshot_source
+    source = config()
+    if _config_snapshot is None or source is not _config_snapshot_source:
+        values = dict(config_defaults())
+        values.update(source or {})
+        _config_snapshot = ConfigSnapshot(values)
+        _config_snapshot_source = source
+    return _config_snapshot
+
+
+def reset_config_snapshot():
+    """Discard the config snapshot, e.g. after the config has changed."""
+    global _config_snapshot, _config_snapshot_source
+    _config_snapshot = None
+    _config_snapshot_source = None
+
+
 def ceph_config_file():
     return CHARM_CEPH_CONF.format(service_name())
 
@@ -116,10 +280,11 @@ def is_local_fs(path):
 
 
 def get_availability_zone():
-    use_juju_az = config('customize-failure-domain')
+    cfg = config_snapshot()
+    use_juju_az = cfg['customize-failure-domain']
     juju_az = os.environ.get('JUJU_AVAILABILITY_ZONE')
     return (juju_az if use_juju_az and juju_az
-            else config('default-availability-zone'))
+            else cfg['default-availability-zone'])
 
 
 def sent_ceph_application_name():
@@ -200,6 +365,7 @@ class NovaComputeLibvirtContext(context.OSContextGenerator):
     interfaces = []
 
     def __call__(self):
+        cfg = config_snapshot()
         # distro defaults
         ctxt = {
             # /etc/libvirt/libvirtd.conf (
@@ -226,79 +392,83 @@ class NovaComputeLibvirtContext(context.OSContextGenerator):
         ctxt['arch'] = platform.machine()
 
         # enable tcp listening if configured for live migration.
-        if config('enable-live-migration'):
+        if cfg['enable-live-migration']:
             ctxt['libvirtd_opts'] += ' -l'
 
-        if config('enable-live-migration') and \
-                config('migration-auth-type') in ['none', 'None', 'ssh']:
+        if cfg['enable-live-migration'] and \
+                cfg['migration-auth-type'] in ['none', 'None', 'ssh']:
             ctxt['listen_tls'] = 0
 
-        if config('enable-live-migration') and \
-                config('migration-auth-type') == 'ssh':
+        if cfg['enable-live-migration'] and \
+                cfg['migration-auth-type'] == 'ssh':
             migration_address = get_relation_ip(
-                'migration', cidr_network=config('libvirt-migration-network'))
+                'migration', cidr_network=cfg['libvirt-migration-network'])
 
             if cmp_os_release >= 'ocata':
-                ctxt['live_migration_scheme'] = config('migration-auth-type')
+                ctxt['live_migration_scheme'] = cfg['migration-auth-type']
                 ctxt['live_migration_inbound_addr'] = migration_address
             else:
                 ctxt['live_migration_uri'] = 'qemu+ssh://%s/system'
 
-        if config('enable-live-migration'):
+        if cfg['enable-live-migration']:
             ctxt['live_migration_completion_timeout'] = \
-                config('live-migration-completion-timeout')
+                cfg['live-migration-completion-timeout']
             ctxt['live_migration_downtime'] = \
-                config('live-migration-downtime')
+                cfg['live-migration-downtime']
             ctxt['live_migration_downtime_steps'] = \
-                config('live-migration-downtime-steps')
+                cfg['live-migration-downtime-steps']
             ctxt['live_migration_downtime_delay'] = \
-                config('live-migration-downtime-delay')
+                cfg['live-migration-downtime-delay']
             ctxt['live_migration_permit_post_copy'] = \
-                config('live-migration-permit-post-copy')
+                cfg['live-migration-permit-post-copy']
             ctxt['live_migration_permit_auto_converge'] = \
-                config('live-migration-permit-auto-converge')
+                cfg['live-migration-permit-auto-converge']
             ctxt['skip_cpu_compare_at_startup'] = \
-                config('skip_cpu_compare_at_startup')
+                cfg['skip_cpu_compare_at_startup']
             ctxt['skip_cpu_compare_on_dest'] = \
-                config('skip_cpu_compare_on_dest')
+                cfg['skip_cpu_compare_on_dest']
 
-        if config('instances-path') is not None:
-            ctxt['instances_path'] = config('instances-path')
+        if cfg['instances-path'] is not None:
+            ctxt['instances_path'] = cfg['instances-path']
 
-        if config('disk-cachemodes'):
-            ctxt['disk_cachemodes'] = config('disk-cachemodes')
+        if cfg['disk-cachemodes']:
+            ctxt['disk_cachemodes'] = cfg['disk-cachemodes']
 
-        if config('use-multipath'):
-            ctxt['use_multipath'] = config('use-multipath')
+        if cfg['use-multipath']:
+            ctxt['use_multipath'] = cfg['use-multipath']
 
-        if config('default-ephemeral-format'):
+        if cfg['default-ephemeral-format']:
             ctxt['default_ephemeral_format'] = \
-                config('default-ephemeral-format')
+                cfg['default-ephemeral-format']
 
-        if config('cpu-mode'):
-            ctxt['cpu_mode'] = config('cpu-mode')
+        if cfg['cpu-mode']:
+            ctxt['cpu_mode'] = cfg['cpu-mode']
         elif ctxt['arch'] in ('ppc64el', 'ppc64le', 'aarch64'):
             ctxt['cpu_mode'] = 'host-passthrough'
         elif ctxt['arch'] == 's390x':
             ctxt['cpu_mode'] = 'none'
 
-        if config('cpu-models'):
-            ctxt['cpu_models'] = config('cpu-models')
-        elif config('cpu-model'):
-            ctxt['cpu_model'] = config('cpu-model')
+        if cfg['cpu-models']:
+            ctxt['cpu_models'] = cfg['cpu-models']
+        elif cfg['cpu-model']:
+            ctxt['cpu_model'] = cfg['cpu-model']
 
-        if config('cpu-model-extra-flags'):
+        if cfg.cpu_model_extra_flags:
             ctxt['cpu_model_extra_flags'] = ', '.join(
-                config('cpu-model-extra-flags').split(' '))
+                cfg.cpu_model_extra_flags)
 
-        if config('hugepages'):
+        if cfg['hugepages']:
             ctxt['hugepages'] = True
             ctxt['kvm_hugepages'] = 1
         else:
             ctxt['kvm_hugepages'] = 0
 
-        if config('ksm') in ("1", "0",):
-            ctxt['ksm'] = config('ksm')
+        if cfg['ksm'] in ("1", "0",):
+            ctxt['ksm'] = cfg['ksm']
+        elif is_ksm_profile(cfg['ksm']):
+            ctxt['ksm'] = ksm_enabled(cfg['ksm'])
+            if ksm_sleep_millisecs(cfg['ksm']):
+                ctxt['ksm_sleep_millisecs'] = ksm_sleep_millisecs(cfg['ksm'])
         else:
             if cmp_os_release < 'kilo':
                 log("KSM set to 1 by default on openstack releases < kilo",
@@ -307,18 +477,17 @@ class NovaComputeLibvirtContext(context.OSContextGenerator):
             else:
                 ctxt['ksm'] = "AUTO"
 
-        if config('reserved-huge-pages'):
-            # To bypass juju limitation with list of strings, we
-            # consider separate the option's values per semicolons.
-            ctxt['reserved_huge_pages'] = (
-                [o.strip() for o in config('reserved-huge-pages').split(";")])
+        reserved_huge_pages = merge_reservations(
+            cfg.reserved_huge_pages, hugepage_reservations(cfg['hugepages']))
+        if reserved_huge_pages:
+            ctxt['reserved_huge_pages'] = reserved_huge_pages
 
-        if config('pci-passthrough-whitelist'):
+        if cfg['pci-passthrough-whitelist']:
             ctxt['pci_passthrough_whitelist'] = \
-                config('pci-passthrough-whitelist')
+                cfg['pci-passthrough-whitelist']
 
-        if config('pci-alias'):
-            aliases = json.loads(config('pci-alias'))
+        if cfg['pci-alias']:
+            aliases = cfg.pci_aliases
             # Behavior previous to queens is maintained as it was
             if isinstance(aliases, list) and cmp_os_release >= 'queens':
                 ctxt['pci_aliases'] = [json.dumps(x, sort_keys=True)
@@ -326,26 +495,49 @@ class NovaComputeLibvirtContext(context.OSContextGenerator):
             else:
                 ctxt['pci_alias'] = json.dumps(aliases, sort_keys=True)
 
-        if config('cpu-dedicated-set'):
-            ctxt['cpu_dedicated_set'] = config('cpu-dedicated-set')
-        elif config('vcpu-pin-set'):
-            ctxt['vcpu_pin_set'] = config('vcpu-pin-set')
-
-        if config('cpu-shared-set'):
-            ctxt['cpu_shared_set'] = config('cpu-shared-set')
-
-        if config('virtio-net-tx-queue-size'):
+        try:
+            cpu_dedicated_set, cpu_shared_set = cpu_sets(
+                cfg['cpu-partitioning'], cfg['cpu-dedicated-set'],
+                cfg['cpu-shared-set'])
+        except (IOError, OSError, ValueError) as e:
+            log('Unable to partition CPUs: {}'.format(e), level=ERROR)
+            cpu_dedicated_set = cfg['cpu-dedicated-set']
+            cpu_shared_set = cfg['cpu-shared-set']
+
+        if cpu_dedicated_set:
+            try:
+                for warning in check_cpu_sets(cpu_dedicated_set,
+                                              cpu_shared_set):
+                    log(warning, level=WARNING)
+            except ValueError as e:
+                log('Invalid CPU sets, not using the planned ones: {}'
+                    .format(e), level=ERROR)
+                cpu_dedicated_set = cfg['cpu-dedicated-set']
+                cpu_shared_set = cfg['cpu-shared-set']
+
+        if cpu_dedicated_set:
+            ctxt['cpu_dedicated_set'] = cpu_dedicated_set
+        elif cfg['vcpu-pin-set']:
+            ctxt['vcpu_pin_set'] = cfg['vcpu-pin-set']
+
+        if cpu_shared_set:
+            ctxt['cpu_shared_set'] = cpu_shared_set
+
+        if cfg['virtio-net-tx-queue-size']:
             ctxt['virtio_net_tx_queue_size'] = (
-                config('virtio-net-tx-queue-size'))
-        if config('virtio-net-rx-queue-size'):
+                cfg['virtio-net-tx-queue-size'])
+        if cfg['virtio-net-rx-queue-size']:
             ctxt['virtio_net_rx_queue_size'] = (
-                config('virtio-net-rx-queue-size'))
+                cfg['virtio-net-rx-queue-size'])
 
-        if config('num-pcie-ports'):
-            ctxt['num_pcie_ports'] = config('num-pcie-ports')
+        if cfg['num-pcie-ports']:
+            ctxt['num_pcie_ports'] = cfg['num-pcie-ports']
 
-        ctxt['reserved_host_memory'] = config('reserved-host-memory')
-        ctxt['reserved_host_disk'] = config('reserved-host-disk')
+        ctxt['reserved_host_memory'] = cfg['reserved-host-memory']
+        if cfg['reserved-host-memory-auto']:
+            ctxt['reserved_host_memory'] = kv().get(
+                RESERVED_HOST_MEMORY_KEY, cfg['reserved-host-memory'])
+        ctxt['reserved_host_disk'] = cfg['reserved-host-disk']
 
         db = kv()
         if db.get('host_uuid'):
@@ -356,10 +548,10 @@ class NovaComputeLibvirtContext(context.OSContextGenerator):
             db.flush()
             ctxt['host_uuid'] = host_uuid
 
-        if config('libvirt-image-backend'):
-            ctxt['libvirt_images_type'] = config('libvirt-image-backend')
-            if config('libvirt-image-backend') == 'rbd':
-                instances_path = config('instances-path')
+        if cfg['libvirt-image-backend']:
+            ctxt['libvirt_images_type'] = cfg['libvirt-image-backend']
+            if cfg['libvirt-image-backend'] == 'rbd':
+                instances_path = cfg['instances-path']
                 if instances_path in ('', None):
                     instances_path = '/var/lib/nova/instances'
                 if is_local_fs(instances_path):
@@ -370,21 +562,19 @@ class NovaComputeLibvirtContext(context.OSContextGenerator):
                         " instances-path is not a local mount.",
                         level=INFO)
 
-        ctxt['force_raw_images'] = config('force-raw-images')
-        ctxt['inject_password'] = config('inject-password')
+        ctxt['force_raw_images'] = cfg['force-raw-images']
+        ctxt['inject_password'] = cfg['inject-password']
         # if allow the injection of an admin password it depends
         # on value greater or equal to -1 for inject_partition
         # -2 means disable the injection of data
-        ctxt['inject_partition'] = -1 if config('inject-password') else -2
+        ctxt['inject_partition'] = -1 if cfg['inject-password'] else -2
 
-        if config("block-device-allocate-retries"):
-            ctxt["block_device_allocate_retries"] = config(
-                "block-device-allocate-retries"
-            )
-        if config("block-device-allocate-retries-interval"):
-            ctxt["block_device_allocate_retries_interval"] = config(
-                "block-device-allocate-retries-interval"
-            )
+        if cfg["block-device-allocate-retries"]:
+            ctxt["block_device_allocate_retries"] = \
+                cfg["block-device-allocate-retries"]
+        if cfg["block-device-allocate-retries-interval"]:
+            ctxt["block_device_allocate_retries_interval"] = \
+                cfg["block-device-allocate-retries-interval"]
 
         return ctxt
 
@@ -415,13 +605,14 @@ class NovaComputeVirtContext(context.OSContextGenerator):
         return False
 
     def __call__(self):
+        cfg = config_snapshot()
         ctxt = {}
         _release = lsb_release()['DISTRIB_CODENAME'].lower()
         if CompareHostReleases(_release) >= "yakkety":
-            ctxt['virt_type'] = config('virt-type')
-            ctxt['enable_live_migration'] = config('enable-live-migration')
+            ctxt['virt_type'] = cfg['virt-type']
+            ctxt['enable_live_migration'] = cfg['enable-live-migration']
         ctxt['resume_guests_state_on_host_boot'] =\
-            config('resume-guests-state-on-host-boot')
+            cfg['resume-guests-state-on-host-boot']
         ctxt['allow_resize_to_same_host'] = self.allow_resize_to_same_host
         return ctxt
 
@@ -455,6 +646,7 @@ def assert_libvirt_rbd_imagebackend_allowed():
 class NovaComputeCephContext(context.CephContext):
 
     def __call__(self):
+        cfg = config_snapshot()
         ctxt = super(NovaComputeCephContext, self).__call__()
         if not ctxt:
             return {}
@@ -471,24 +663,24 @@ class NovaComputeCephContext(context.CephContext):
         ctxt['rbd_user'] = svc
         ctxt['rbd_secret_uuid'] = secret_uuid
 
-        if config('pool-type') == 'erasure-coded':
+        if cfg['pool-type'] == 'erasure-coded':
             ctxt['rbd_pool'] = (
-                config('ec-rbd-metadata-pool') or
-                "{}-metadata".format(config('rbd-pool'))
+                cfg['ec-rbd-metadata-pool'] or
+                "{}-metadata".format(cfg['rbd-pool'])
             )
         else:
-            ctxt['rbd_pool'] = config('rbd-pool')
+            ctxt['rbd_pool'] = cfg['rbd-pool']
 
-        if (config('libvirt-image-backend') == 'rbd' and
+        if (cfg['libvirt-image-backend'] == 'rbd' and
                 assert_libvirt_rbd_imagebackend_allowed()):
             ctxt['libvirt_rbd_images_ceph_conf'] = ceph_config_file()
 
-        rbd_cache = config('rbd-client-cache') or ""
+        rbd_cache = cfg['rbd-client-cache'] or ""
         if rbd_cache.lower() == "enabled":
             # We use write-though only to be safe for migration
             ctxt['rbd_client_cache_settings'] = \
                 {'rbd cache': 'true',
-                 'rbd cache size': '67108864',
+                 'rbd cache size': str(RBD_CACHE_SIZE),
                  'rbd cache max dirty': '0',
                  'rbd cache writethrough until flush': 'true',
                  'admin socket': '/var/run/ceph/rbd-client-$pid.asok'}
@@ -646,6 +838,7 @@ class CloudComputeContext(context.OSContextGenerator):
         return vdata_ctxt
 
     def flat_dhcp_context(self):
+        cfg = config_snapshot()
         ec2_host = None
         for rid in relation_ids('cloud-compute'):
             for unit in related_units(rid):
@@ -654,7 +847,7 @@ class CloudComputeContext(context.OSContextGenerator):
         if not ec2_host:
             return {}
 
-        if config('multi-host').lower() == 'yes':
+        if cfg['multi-host'].lower() == 'yes':
             cmp_os_release = CompareOpenStackReleases(
                 os_release('nova-common'))
             if cmp_os_release <= 'train':
@@ -664,7 +857,7 @@ class CloudComputeContext(context.OSContextGenerator):
                 self._ensure_packages(['nova-api'])
 
         return {
-            'flat_interface': config('flat-interface'),
+            'flat_interface': cfg['flat-interface'],
             'ec2_dmz_host': ec2_host,
         }
 
@@ -672,6 +865,7 @@ class CloudComputeContext(context.OSContextGenerator):
         # generate config context for neutron or quantum. these get converted
         # directly into flags in nova.conf
         # NOTE: Its up to release templates to set correct driver
+        cfg = config_snapshot()
         neutron_ctxt = {'neutron_url': None}
         for rid in relation_ids('cloud-compute'):
             for unit in related_units(rid):
@@ -728,12 +922,12 @@ class CloudComputeContext(context.OSContextGenerator):
                                      neutron_ctxt['api_version'])
         neutron_ctxt['neutron_admin_auth_url'] = ks_url
 
-        if config('neutron-physnets'):
-            physnets = config('neutron-physnets').split(';')
+        if cfg['neutron-physnets']:
+            physnets = cfg['neutron-physnets'].split(';')
             neutron_ctxt['neutron_physnets'] =\
                 dict(item.split(":") for item in physnets)
-        if config('neutron-tunnel'):
-            neutron_ctxt['neutron_tunnel'] = config('neutron-tunnel')
+        if cfg['neutron-tunnel']:
+            neutron_ctxt['neutron_tunnel'] = cfg['neutron-tunnel']
 
         return neutron_ctxt
 
@@ -801,6 +995,7 @@ class CloudComputeContext(context.OSContextGenerator):
                     return rt
 
     def __call__(self):
+        cfg = config_snapshot()
         rids = relation_ids('cloud-compute')
         if not rids:
             return {}
@@ -837,7 +1032,7 @@ class CloudComputeContext(context.OSContextGenerator):
                 ctxt['network_manager'] = self.network_manager
                 ctxt['network_manager_config'] = net_manager
 
-        net_dev_mtu = config('network-device-mtu')
+        net_dev_mtu = cfg.get('network-device-mtu')
         if net_dev_mtu:
             ctxt['network_device_mtu'] = net_dev_mtu
 
@@ -943,11 +1138,12 @@ class NeutronComputeContext(context.OSContextGenerator):
 
 class HostIPContext(context.OSContextGenerator):
     def __call__(self):
+        cfg = config_snapshot()
         ctxt = {}
         # Use the address used in the cloud-compute relation in templates for
         # this host
         host_ip = get_relation_ip('cloud-compute',
-                                  cidr_network=config('os-internal-network'))
+                                  cidr_network=cfg['os-internal-network'])
 
         if host_ip:
             # NOTE: do not format this even for ipv6 (see bug 1499656)
@@ -958,8 +1154,9 @@ class HostIPContext(context.OSContextGenerator):
 
 class VirtMkfsContext(context.OSContextGenerator):
     def __call__(self):
+        cfg = config_snapshot()
         ctxt = {}
-        virt_mkfs = config('virt-mkfs-cmds')
+        virt_mkfs = cfg['virt-mkfs-cmds']
         if virt_mkfs:
             # this is a "multi-value" option
             ctxt['virt_mkfs'] = '\n'.join(["virt_mkfs = {}".format(line)
@@ -989,10 +1186,11 @@ class NovaComputeAppArmorContext(context.AppArmorContext):
         self.aa_profile = NOVA_COMPUTE_AA_PROFILE
 
     def __call__(self):
+        cfg = config_snapshot()
         super(NovaComputeAppArmorContext, self).__call__()
         if not self.ctxt:
             return self.ctxt
-        self._ctxt.update({'virt_type': config('virt-type')})
+        self._ctxt.update({'virt_type': cfg['virt-type']})
         self._ctxt.update({'aa_profile': self.aa_profile})
         return self.ctxt
 
@@ -1040,19 +1238,20 @@ class NeutronPluginSubordinateConfigContext(context.SubordinateConfigContext):
 class NovaComputePlacementContext(context.OSContextGenerator):
 
     def __call__(self):
+        cfg = config_snapshot()
         ctxt = {}
         cmp_os_release = CompareOpenStackReleases(os_release('nova-common'))
 
         ctxt['initial_cpu_allocation_ratio'] =\
-            config('initial-cpu-allocation-ratio')
+            cfg['initial-cpu-allocation-ratio']
         ctxt['initial_ram_allocation_ratio'] =\
-            config('initial-ram-allocation-ratio')
+            cfg['initial-ram-allocation-ratio']
         ctxt['initial_disk_allocation_ratio'] =\
-            config('initial-disk-allocation-ratio')
+            cfg['initial-disk-allocation-ratio']
 
-        ctxt['cpu_allocation_ratio'] = config('cpu-allocation-ratio')
-        ctxt['ram_allocation_ratio'] = config('ram-allocation-ratio')
-        ctxt['disk_allocation_ratio'] = config('disk-allocation-ratio')
+        ctxt['cpu_allocation_ratio'] = cfg['cpu-allocation-ratio']
+        ctxt['ram_allocation_ratio'] = cfg['ram-allocation-ratio']
+        ctxt['disk_allocation_ratio'] = cfg['disk-allocation-ratio']
 
         if cmp_os_release >= 'stein':
             for ratio_config in ['initial_cpu_allocation_ratio',
@@ -1085,6 +1284,7 @@ class NovaComputePlacementContext(context.OSContextGenerator):
 class NovaComputeSWTPMContext(context.OSContextGenerator):
 
     def __call__(self):
+        cfg = config_snapshot()
         cmp_os_release = CompareOpenStackReleases(os_release('nova-common'))
         ctxt = {}
 
@@ -1092,7 +1292,7 @@ class NovaComputeSWTPMContext(context.OSContextGenerator):
         # Wallaby and newer releases.
         if cmp_os_release >= 'wallaby':
             ctxt = {
-                'swtpm_enabled': config('enable-vtpm'),
+                'swtpm_enabled': cfg['enable-vtpm'],
             }
 
         return ctxt
@@ -1101,7 +1301,8 @@ class NovaComputeSWTPMContext(context.OSContextGenerator):
 class NovaComputeDBUSContext(context.OSContextGenerator):
 
     def __call__(self):
-        reply_limit = config('dbus-max-replies-per-connection')
+        cfg = config_snapshot()
+        reply_limit = cfg['dbus-max-replies-per-connection']
         if reply_limit:
             return {'reply_limit': reply_limit}
 
@@ -0,0 +1,284 @@
+# Copyright 2024 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""CPU partitioning between the host, shared and dedicated guest vCPUs.
+
+The cpu-partitioning option is a policy applied to every NUMA node::
+
+    host:1,shared:2
+
+keeps the first core of each node for the host, gives the next two to
+cpu_shared_set and all the others to cpu_dedicated_set.  Cores are never
+split, all their SMT siblings go to the same set.  Cores isolated with
+isolcpus on the kernel command line are the last ones picked for the host
+and shared sets.
+"""
+
+import collections
+import glob
+import os
+
+SYSFS = '/sys'
+KERNELCMD = '/proc/cmdline'
+CPU_PATH = 'devices/system/cpu'
+NODE_PATH = 'devices/system/node'
+
+# cores per NUMA node for each set, in the order they are picked
+POLICY_DEFAULTS = collections.OrderedDict([
+    ('host', 1),
+    ('shared', 0),
+])
+
+
+def parse_cpu_spec(spec):
+    """CPUs of a CPU list such as '0-3,8' or of a nova set such as '^0,0-7'.
+
+    :param spec: the CPU list
+    :type spec: Optional[str]
+    :rtype: Set[int]
+    :raises: ValueError if the list is not valid
+    """
+    included, excluded = set(), set()
+    for item in (spec or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        cpus = excluded if item.startswith('^') else included
+        start, sep, end = item.lstrip('^').partition('-')
+        try:
+            start = int(start)
+            end = int(end) if sep else start
+        except ValueError:
+            raise ValueError("Invalid CPU list '{}'".format(spec))
+        if end < start:
+            raise ValueError("Invalid CPU range '{}'".format(item))
+        cpus.update(range(start, end + 1))
+    return included - excluded
+
+
+def format_cpu_spec(cpus):
+    """Format CPUs as a CPU list of ranges, e.g. '0-3,8'.
+
+    :param cpus: the CPUs
+    :type cpus: Iterable[int]
+    :rtype: str
+    """
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(start) if start == end else
+                    '{}-{}'.format(start, end) for start, end in ranges)
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read().strip()
+
+
+def isolated_cpus():
+    """CPUs isolated with isolcpus on the kernel command line.
+
+    :rtype: Set[int]
+    """
+    try:
+        cmdline = _read(KERNELCMD)
+    except (IOError, OSError):
+        return set()
+    cpus = set()
+    for param in cmdline.split():
+        name, _, value = param.partition('=')
+        if name == 'isolcpus':
+            # NOTE: flags such as managed_irq or domain may precede the list
+            spec = ','.join(v for v in value.split(',')
+                            if v[:1].isdigit() or v[:1] == '^')
+            try:
+                cpus |= parse_cpu_spec(spec)
+            except ValueError:
+                continue
+    return cpus
+
+
+def cpu_topology():
+    """Cores of each NUMA node.
+
+    :returns: {node: [cpus of each core, sorted]}
+    :rtype: Dict[int, List[Tuple[int, ...]]]
+    """
+    online = parse_cpu_spec(_read(os.path.join(SYSFS, CPU_PATH, 'online')))
+    node_of = {}
+    for path in glob.glob(os.path.join(SYSFS, NODE_PATH, 'node*',
+                                       'cpulist')):
+        node = os.path.basename(os.path.dirname(path))[len('node'):]
+        for cpu in parse_cpu_spec(_read(path)):
+            node_of[cpu] = int(node)
+    cores = set()
+    for cpu in online:
+        path = os.path.join(SYSFS, CPU_PATH, 'cpu{}'.format(cpu),
+                            'topology', 'thread_siblings_list')
+        try:
+            siblings = parse_cpu_spec(_read(path)) & online
+        except (IOError, OSError):
+            siblings = set()
+        cores.add(tuple(sorted(siblings | {cpu})))
+    topology = {}
+    for core in sorted(cores):
+        topology.setdefault(node_of.get(core[0], 0), []).append(core)
+    return topology
+
+
+def parse_policy(value):
+    """Parse a cpu-partitioning policy.
+
+    :param value: e.g. 'host:1,shared:2'
+    :type value: str
+    :returns: cores per NUMA node for each set
+    :rtype: Dict[str, int]
+    :raises: ValueError if the policy is not valid
+    """
+    policy = collections.OrderedDict(POLICY_DEFAULTS)
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        key, _, count = item.partition(':')
+        key = key.strip()
+        if key not in policy:
+            raise ValueError(
+                "Unknown cpu-partitioning setting '{}'".format(key))
+        try:
+            policy[key] = int(count)
+        except ValueError:
+            policy[key] = -1
+        if policy[key] < 0:
+            raise ValueError(
+                "Invalid number of cores '{}'".format(item.strip()))
+    return policy
+
+
+def plan_cpu_sets(value, topology=None, isolated=None, given=None):
+    """Partition the cores of each NUMA node according to a policy.
+
+    The CPUs of sets given explicitly are left out of the plan, and a given
+    shared set is not planned nor are dedicated cores then needed.
+
+    :param value: the cpu-partitioning option
+    :type value: str
+    :param topology: from cpu_topology, read from sysfs if not given
+    :type topology: Optional[Dict[int, List[Tuple[int, ...]]]]
+    :param isolated: from isolated_cpus, read if not given
+    :type isolated: Optional[Set[int]]
+    :param given: CPUs of the sets given explicitly, by 'dedicated' or
+                  'shared'
+    :type given: Optional[Dict[str, Set[int]]]
+    :returns: CPUs of the host, shared and dedicated sets
+    :rtype: Dict[str, Set[int]]
+    :raises: ValueError if the policy leaves a node without dedicated cores
+    """
+    policy = parse_policy(value)
+    given = given or {}
+    if 'shared' in given:
+        policy['shared'] = 0
+    excluded = set().union(*given.values())
+    if topology is None:
+        topology = cpu_topology()
+    if isolated is None:
+        isolated = isolated_cpus()
+    sets = dict((name, set()) for name in list(policy) + ['dedicated'])
+    for node, cores in sorted(topology.items()):
+        cores = [core for core in (
+            tuple(cpu for cpu in core if cpu not in excluded)
+            for core in cores) if core]
+        if not cores and excluded:
+            continue
+        needed = sum(policy.values()) + ('dedicated' not in given)
+        if needed > len(cores):
+            raise ValueError(
+                'NUMA node {} has {} cores, too few for {}'.format(
+                    node, len(cores), value))
+        # non isolated cores first, then in CPU order
+        cores = sorted(cores, key=lambda c: (bool(isolated & set(c)), c))
+        for name, count in policy.items():
+            for core in cores[:count]:
+                sets[name].update(core)
+            cores = cores[count:]
+        for core in cores:
+            sets['dedicated'].update(core)
+    return sets
+
+
+def check_cpu_sets(dedicated, shared, topology=None):
+    """Check cpu_dedicated_set and cpu_shared_set.
+
+    :param dedicated: the cpu_dedicated_set
+    :type dedicated: Optional[str]
+    :param shared: the cpu_shared_set
+    :type shared: Optional[str]
+    :param topology: from cpu_topology, read from sysfs if not given
+    :type topology: Optional[Dict[int, List[Tuple[int, ...]]]]
+    :returns: warnings, about cores split between sets
+    :rtype: List[str]
+    :raises: ValueError if a set is not valid or the sets overlap
+    """
+    dedicated, shared = parse_cpu_spec(dedicated), parse_cpu_spec(shared)
+    overlap = dedicated & shared
+    if overlap:
+        raise ValueError(
+            'CPUs {} are both dedicated and shared'.format(
+                format_cpu_spec(overlap)))
+    if not dedicated:
+        return []
+    if topology is None:
+        try:
+            topology = cpu_topology()
+        except (IOError, OSError):
+            return []
+    warnings = []
+    for cores in topology.values():
+        for core in cores:
+            pinned = dedicated & set(core)
+            if pinned and pinned != set(core):
+                warnings.append(
+                    'Dedicated CPUs {} share their core with CPUs {}'.format(
+                        format_cpu_spec(pinned),
+                        format_cpu_spec(set(core) - pinned)))
+    return warnings
+
+
+def cpu_sets(policy, dedicated=None, shared=None):
+    """cpu_dedicated_set and cpu_shared_set to configure.
+
+    The sets given explicitly take precedence over those planned, the
+    other set is planned from the CPUs they leave.
+
+    :param policy: the cpu-partitioning option
+    :type policy: Optional[str]
+    :param dedicated: the cpu-dedicated-set option
+    :type dedicated: Optional[str]
+    :param shared: the cpu-shared-set option
+    :type shared: Optional[str]
+    :rtype: Tuple[Optional[str], Optional[str]]
+    :raises: ValueError if the policy cannot be applied
+    """
+    if policy and not (dedicated and shared):
+        given = {}
+        if dedicated:
+            given['dedicated'] = parse_cpu_spec(dedicated)
+        if shared:
+            given['shared'] = parse_cpu_spec(shared)
+        planned = plan_cpu_sets(policy, given=given)
+        dedicated = dedicated or format_cpu_spec(planned['dedicated'])
+        shared = shared or format_cpu_spec(planned['shared']) or None
+    return dedicated, shared
@@ -15,6 +15,9 @@
 # limitations under the License.
 
 import base64
+import collections
+import contextlib
+import fnmatch
 import functools
 import json
 import platform
@@ -27,12 +30,19 @@ import shutil
 import yaml
 
 import charmhelpers.core.unitdata as unitdata
+from charmhelpers.core import profiler
 
 from charmhelpers.core.kernel import modprobe
 
 from charmhelpers.core.hookenv import (
     Hooks,
+    charm_dir,
     config,
+    hook_name,
+    enable_log_buffer,
+    enable_tool_trace,
+    log_tool_invocations,
+    tool_invocations,
     is_relation_made,
     local_unit,
     log,
@@ -53,7 +63,8 @@ from charmhelpers.core.templating import (
     render
 )
 from charmhelpers.core.host import (
-    service_restart,
+    deferred_restarts,
+    queue_restart,
     service_running,
     service_start,
     service_stop,
@@ -69,6 +80,7 @@ from charmhelpers.fetch import (
     apt_update,
     filter_installed_packages,
 )
+from charmhelpers.fetch.ubuntu_apt_pkg import enable_dpkg_status_index
 
 import charmhelpers.contrib.openstack.context as ch_context
 
@@ -106,9 +118,12 @@ from nova_compute_utils import (
     migration_enabled,
     do_openstack_upgrade,
     public_ssh_key,
+    reset_resource_map,
     restart_map,
     services,
+    service_dependencies,
     register_configs,
+    LazyConfigRenderer,
     NOVA_CONF,
     ceph_config_file,
     CEPH_SECRET,
@@ -152,6 +167,8 @@ from nova_compute_context import (
     NovaNetworkAppArmorContext,
     NovaComputeHostInfoContext,
 )
+from nova_compute_ksm import tune_ksm
+from nova_compute_memory import update_reserved_host_memory
 from charmhelpers.contrib.charmsupport import nrpe
 from charmhelpers.core.sysctl import create as create_sysctl
 from charmhelpers.contrib.hardening.harden import harden
@@ -161,7 +178,15 @@ from socket import gethostname
 import charmhelpers.contrib.openstack.vaultlocker as vaultlocker
 
 hooks = Hooks()
-CONFIGS = register_configs()
+# NOTE: the configs are only registered, and the restart maps passed to
+#       restart_on_change only evaluated, when a hook actually needs them so
+#       that importing this module is free of side effects.  update-status
+#       assesses the status from the complete contexts recorded by the
+#       previous hook, so it neither registers the configs nor evaluates
+#       the contexts, see LazyConfigRenderer.  Every hook still imports
+#       this module, and so all of the charm: there is no per-hook lazy
+#       dispatch.
+CONFIGS = LazyConfigRenderer(register_configs)
 MIGRATION_AUTH_TYPES = ["ssh"]
 LIBVIRTD_PID = '/var/run/libvirtd.pid'
 
@@ -218,8 +243,124 @@ def configure_extra_repositories(extra_repositories):
         add_source(source, key, fail_invalid=True)
 
 
+# NOTE: the steps of config_changed which have to be re-run when a config
+#       option changes, options may be given as fnmatch patterns.  Any change
+#       re-renders the configuration files, which are only written out when
+#       their content changed, so options only used by the templates need not
+#       be listed.  Steps not affected by any option only run in full mode,
+#       which is also used for the first run after the host rebooted so that
+#       the host state they set up, e.g. huge pages and SMT, is restored.
+CONFIG_CHANGED_STEPS = {
+    'ephemeral-unmount': ('ephemeral-unmount',),
+    'prefer-ipv6': ('ipv6',),
+    'extra-repositories': ('extra-repositories',),
+    'openstack-origin': ('openstack-upgrade',),
+    'action-managed-upgrade': ('openstack-upgrade',),
+    'sysctl': ('sysctl',),
+    'enable-live-migration': ('ssh-keys', 'relations'),
+    'migration-auth-type': ('ssh-keys', 'relations'),
+    'enable-resize': ('ssh-keys', 'relations'),
+    'instances-path': ('instances-path', 'ephemeral-storage'),
+    'libvirt-migration-network': ('relations',),
+    'default-availability-zone': ('relations',),
+    'customize-failure-domain': ('relations',),
+    'hugepages': ('hugepages', 'relations'),
+    'nagios_context': ('nrpe',),
+    'nagios_servicegroups': ('nrpe',),
+    # NOTE: options read by resource_map() change services(), and so the
+    # services monitored by nrpe.
+    'virt-type': ('ceph', 'nrpe'),
+    'multi-host': ('nrpe',),
+    'libvirt-image-backend': ('ceph',),
+    'rbd-pool': ('ceph',),
+    'restrict-ceph-pools': ('ceph',),
+    'pool-type': ('ceph',),
+    'ceph-*': ('ceph',),
+    'ec-*': ('ceph',),
+    'bluestore-compression-*': ('ceph',),
+    'encrypt': ('vaultlocker', 'ephemeral-storage'),
+    'ephemeral-device': ('ephemeral-storage',),
+    'use-multipath': ('multipath',),
+    'enable-vtpm': ('swtpm', 'nrpe'),
+    'ksm': ('ksm',),
+}
+CONFIG_APPLIED_KEY = 'config-changed-applied'
+CONFIG_APPLIED_BOOT_KEY = 'config-changed-applied-boot-id'
+BOOT_ID = '/proc/sys/kernel/random/boot_id'
+
+
+def boot_id():
+    """Identifier of the current boot of the host.
+
+    :returns: the boot id, None if it cannot be read
+    :rtype: Optional[str]
+    """
+    try:
+        with open(BOOT_ID) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def request_full_config_changed():
+    """Make the next run of config_changed run all of its steps.
+
+    Charm, series and OpenStack upgrades may change what the steps do for an
+    unchanged config, so they have to be re-run in full afterwards.
+    """
+    db = kv()
+    db.unset(CONFIG_APPLIED_KEY)
+    db.flush()
+
+
+def config_changed_steps():
+    """Determine the steps of config_changed affected by changed options.
+
+    Options are compared with the config last applied by config_changed,
+    rather than with Config.previous() which is saved by every hook reading
+    the config and so may already hold the new values when config-changed
+    runs.  All steps are run, full mode, on the first run, on the first run
+    after the host rebooted and when requested by
+    request_full_config_changed().
+
+    :returns: names of the steps to run, None for full mode
+    :rtype: Optional[Set[str]]
+    """
+    db = kv()
+    applied = db.get(CONFIG_APPLIED_KEY)
+    if applied is None:
+        log('Running all config-changed steps', level=DEBUG)
+        return None
+    if boot_id() != db.get(CONFIG_APPLIED_BOOT_KEY):
+        log('Host rebooted since config-changed last ran, running all '
+            'config-changed steps', level=INFO)
+        return None
+    cfg = config()
+    changed = sorted(k for k in set(cfg) | set(applied)
+                     if cfg.get(k) != applied.get(k))
+    steps = set()
+    if changed:
+        steps.add('configs')
+    for key in changed:
+        for pattern, key_steps in CONFIG_CHANGED_STEPS.items():
+            if fnmatch.fnmatchcase(key, pattern):
+                steps.update(key_steps)
+    log('Changed config options: {}, running config-changed steps: {}'
+        .format(', '.join(changed) or 'none', ', '.join(sorted(steps))),
+        level=DEBUG)
+    return steps
+
+
+def save_applied_config():
+    """Record the config applied by config_changed."""
+    db = kv()
+    db.set(CONFIG_APPLIED_KEY, dict(config()))
+    db.set(CONFIG_APPLIED_BOOT_KEY, boot_id())
+    db.flush()
+
+
 @hooks.hook('config-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 @harden()
 def config_changed():
 
@@ -227,14 +368,19 @@ def config_changed():
         log("Do not run config_changed when paused", "WARNING")
         return
 
-    if config('ephemeral-unmount'):
+    steps = config_changed_steps()
+
+    def run(step):
+        return steps is None or step in steps
+
+    if run('ephemeral-unmount') and config('ephemeral-unmount'):
         umount(config('ephemeral-unmount'), persist=True)
 
-    if config('prefer-ipv6'):
+    if run('ipv6') and config('prefer-ipv6'):
         status_set('maintenance', 'configuring ipv6')
         assert_charm_supports_ipv6()
 
-    if config('extra-repositories'):
+    if run('extra-repositories') and config('extra-repositories'):
         log('Configuring extra repositories', level=INFO)
         configure_extra_repositories(config('extra-repositories'))
         apt_update()
@@ -246,92 +392,114 @@ def config_changed():
         raise Exception(message)
     global CONFIGS
     send_remote_restart = False
-    if not config('action-managed-upgrade'):
+    if run('openstack-upgrade') and not config('action-managed-upgrade'):
         if openstack_upgrade_available('nova-common'):
             status_set('maintenance', 'Running openstack upgrade')
             do_openstack_upgrade(CONFIGS)
             send_remote_restart = True
+            steps = None
+
+    if run('sysctl'):
+        sysctl_settings = config('sysctl')
+        ensure_nf_conntrack_module_loaded(sysctl_settings)
+        if sysctl_settings and not is_container():
+            create_sysctl(
+                sysctl_settings,
+                '/etc/sysctl.d/50-nova-compute.conf',
+                # Some keys in the config may not exist in /proc/sys/net/.
+                # For example, the conntrack module may not be loaded when
+                # using lxd drivers insteam of kvm. In these cases, we
+                # simply ignore the missing keys, rather than making time
+                # consuming calls out to the filesystem to check for their
+                # existence.
+                ignore=True)
+
+    if run('libvirt-network'):
+        remove_libvirt_network('default')
+
+    if run('ssh-keys'):
+        if migration_enabled() and config('migration-auth-type') == 'ssh':
+            # Check-in with nova-c-c and register new ssh key, if it has just
+            # been generated.
+            status_set('maintenance', 'SSH key exchange')
+            initialize_ssh_keys()
+            import_authorized_keys()
+
+        if config('enable-resize') is True:
+            enable_shell(user='nova')
+            status_set('maintenance', 'SSH key exchange')
+            initialize_ssh_keys(user='nova')
+            import_authorized_keys(user='nova', prefix='nova')
+        else:
+            disable_shell(user='nova')
 
-    sysctl_settings = config('sysctl')
-    ensure_nf_conntrack_module_loaded(sysctl_settings)
-    if sysctl_settings and not is_container():
-        create_sysctl(
-            sysctl_settings,
-            '/etc/sysctl.d/50-nova-compute.conf',
-            # Some keys in the config may not exist in /proc/sys/net/.
-            # For example, the conntrack module may not be loaded when
-            # using lxd drivers insteam of kvm. In these cases, we
-            # simply ignore the missing keys, rather than making time
-            # consuming calls out to the filesystem to check for their
-            # existence.
-            ignore=True)
-
-    remove_libvirt_network('default')
-
-    if migration_enabled() and config('migration-auth-type') == 'ssh':
-        # Check-in with nova-c-c and register new ssh key, if it has just been
-        # generated.
-        status_set('maintenance', 'SSH key exchange')
-        initialize_ssh_keys()
-        import_authorized_keys()
-
-    if config('enable-resize') is True:
-        enable_shell(user='nova')
-        status_set('maintenance', 'SSH key exchange')
-        initialize_ssh_keys(user='nova')
-        import_authorized_keys(user='nova', prefix='nova')
-    else:
-        disable_shell(user='nova')
-
-    if config('instances-path') is not None:
+    if run('instances-path') and config('instances-path') is not None:
         fp = config('instances-path')
         if not os.path.exists(fp):
             mkdir(path=fp, owner='nova', group='nova', perms=0o775)
         fix_path_ownership(fp, user='nova')
 
-    for rid in relation_ids('cloud-compute'):
-        compute_joined(rid)
+    if run('relations'):
+        for rid in relation_ids('cloud-compute'):
+            compute_joined(rid)
 
-    for rid in relation_ids('neutron-plugin'):
-        neutron_plugin_joined(rid, remote_restart=send_remote_restart)
+        for rid in relation_ids('neutron-plugin'):
+            neutron_plugin_joined(rid, remote_restart=send_remote_restart)
 
-    for rid in relation_ids('nova-ceilometer'):
-        nova_ceilometer_joined(rid, remote_restart=send_remote_restart)
+        for rid in relation_ids('nova-ceilometer'):
+            nova_ceilometer_joined(rid, remote_restart=send_remote_restart)
 
-    for rid in relation_ids('nova-vgpu'):
-        nova_vgpu_joined(rid, remote_restart=send_remote_restart)
+        for rid in relation_ids('nova-vgpu'):
+            nova_vgpu_joined(rid, remote_restart=send_remote_restart)
 
-    if is_relation_made("nrpe-external-master"):
+    if run('nrpe') and is_relation_made("nrpe-external-master"):
         update_nrpe_config()
 
-    if config('hugepages'):
+    if run('hugepages'):
         install_hugepages()
 
-    # Disable smt for ppc64, required for nova/libvirt/kvm
-    arch = platform.machine()
-    log('CPU architecture: {}'.format(arch))
-    if arch in ['ppc64el', 'ppc64le']:
-        set_ppc64_cpu_smt_state('off')
+    if run('ppc64-smt'):
+        # Disable smt for ppc64, required for nova/libvirt/kvm
+        arch = platform.machine()
+        log('CPU architecture: {}'.format(arch))
+        if arch in ['ppc64el', 'ppc64le']:
+            set_ppc64_cpu_smt_state('off')
+
+    if run('ceph'):
+        # NOTE(jamespage): trigger any configuration related changes
+        #                  for cephx permissions restrictions and
+        #                  keys on disk for ceph-access backends
+        with coalesce_relation_work():
+            for rid in relation_ids('ceph'):
+                for unit in related_units(rid):
+                    ceph_changed(rid=rid, unit=unit)
+            for rid in relation_ids('ceph-access'):
+                for unit in related_units(rid):
+                    ceph_access(rid=rid, unit=unit)
 
-    # NOTE(jamespage): trigger any configuration related changes
-    #                  for cephx permissions restrictions and
-    #                  keys on disk for ceph-access backends
-    for rid in relation_ids('ceph'):
-        for unit in related_units(rid):
-            ceph_changed(rid=rid, unit=unit)
-    for rid in relation_ids('ceph-access'):
-        for unit in related_units(rid):
-            ceph_access(rid=rid, unit=unit)
+    if update_reserved_host_memory() and steps is not None:
+        steps.add('configs')
 
-    update_all_configs()
+    if run('configs'):
+        update_all_configs()
 
-    install_vaultlocker()
-    install_multipath()
-    install_swtpm()
+    if run('vaultlocker'):
+        install_vaultlocker()
+    if run('multipath'):
+        install_multipath()
+    if run('swtpm'):
+        install_swtpm()
 
-    configure_local_ephemeral_storage()
+    if run('ephemeral-storage'):
+        configure_local_ephemeral_storage()
+
+    if run('ksm'):
+        tune_ksm(config('ksm'))
+
+    if run('iscsid'):
+        check_and_start_iscsid()
 
-    check_and_start_iscsid()
+    save_applied_config()
 
 
 def ensure_nf_conntrack_module_loaded(sysctl_str):
@@ -374,6 +542,9 @@ def install_vaultlocker():
         installed = len(filter_installed_packages(['vaultlocker'])) == 0
         if not installed:
             apt_install('vaultlocker', fatal=True)
+            # NOTE: the vault context is only part of the resource map once
+            #       vaultlocker is installed.
+            reset_resource_map()
 
 
 def install_multipath():
@@ -405,7 +576,7 @@ def amqp_joined(relation_id=None):
 
 @hooks.hook('amqp-relation-changed')
 @hooks.hook('amqp-relation-departed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 def amqp_changed():
     if 'amqp' not in CONFIGS.complete_contexts():
         log('amqp relation incomplete. Peer not ready?')
@@ -414,7 +585,7 @@ def amqp_changed():
 
 
 @hooks.hook('image-service-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 def image_service_changed():
     if 'image-service' not in CONFIGS.complete_contexts():
         log('image-service relation incomplete. Peer not ready?')
@@ -424,7 +595,7 @@ def image_service_changed():
 
 @hooks.hook('ephemeral-backend-relation-changed',
             'ephemeral-backend-relation-broken')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 def ephemeral_backend_hook():
     if 'ephemeral-backend' not in CONFIGS.complete_contexts():
         log('ephemeral-backend relation incomplete. Peer not ready?')
@@ -459,7 +630,7 @@ def compute_joined(rid=None):
 
 
 @hooks.hook('cloud-compute-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 def compute_changed():
     # rewriting all configs to pick up possible net or vol manager
     # config advertised from controller.
@@ -470,14 +641,14 @@ def compute_changed():
 
 
 @hooks.hook('ironic-api-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 def ironic_api_changed():
     CONFIGS.write(NOVA_CONF)
 
 
 @hooks.hook('ceph-access-relation-joined')
 @hooks.hook('ceph-relation-joined')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 def ceph_joined():
     pkgs = filter_installed_packages(['ceph-common'])
     if pkgs:
@@ -485,7 +656,7 @@ def ceph_joined():
         apt_install(pkgs, fatal=True)
         # Bug 1427660
         if not is_unit_paused_set() and config('virt-type') in LIBVIRT_TYPES:
-            service_restart(libvirt_daemon())
+            queue_restart(libvirt_daemon())
     # install old credentials first for backwards compatibility
     send_application_name()
 
@@ -592,8 +763,73 @@ def get_ceph_request():
     return rq
 
 
+_deferred_work = None
+
+
+@contextlib.contextmanager
+def coalesce_relation_work():
+    """Coalesce the work of relation handlers run for every related unit.
+
+    Within the block handlers record their work with defer_work() instead of
+    doing it.  Work recorded under the same id by several units is done
+    once, in the order it was first recorded, when the outermost block
+    exits.  Should the block raise, the recorded work is discarded.
+    """
+    global _deferred_work
+    if _deferred_work is not None:
+        yield
+        return
+    _deferred_work = work = collections.OrderedDict()
+    try:
+        yield
+    finally:
+        _deferred_work = None
+    if work:
+        log('Running {} coalesced relation tasks'.format(len(work)),
+            level=DEBUG)
+    for func, args, kwargs in work.values():
+        func(*args, **kwargs)
+
+
+def defer_work(work_id, func, *args, **kwargs):
+    """Run func, or record it when relation work is being coalesced.
+
+    :param work_id: identifies the work, including anything its outcome
+                    depends on, for work recorded more than once to be done
+                    once
+    :type work_id: Hashable
+    :param func: the work
+    :type func: Callable
+    """
+    if _deferred_work is None:
+        func(*args, **kwargs)
+    elif work_id not in _deferred_work:
+        _deferred_work[work_id] = (func, args, kwargs)
+
+
+def write_ceph_configs():
+    """Write out the configuration files using the ceph relation."""
+    CONFIGS.write(ceph_config_file())
+    CONFIGS.write(CEPH_SECRET)
+    CONFIGS.write(NOVA_CONF)
+
+
+def send_ceph_request():
+    """Send the ceph broker request, unless an equivalent one was sent."""
+    try:
+        _handle_ceph_request()
+    except ValueError as e:
+        # The end user has most likely provided a invalid value for a
+        # configuration option. Just log the traceback here, the end
+        # user will be notified by assess_status() called at the end of
+        # the hook execution.
+        log('Caught ValueError, invalid value provided for '
+            'configuration?: "{}"'.format(str(e)),
+            level=WARNING)
+
+
 @hooks.hook('ceph-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 def ceph_changed(rid=None, unit=None):
     if 'ceph' not in CONFIGS.complete_contexts():
         log('ceph relation incomplete. Peer not ready?')
@@ -611,32 +847,25 @@ def ceph_changed(rid=None, unit=None):
             'for {}: peer not ready?'.format(sent_app_name))
         return
 
-    CONFIGS.write(ceph_config_file())
-    CONFIGS.write(CEPH_SECRET)
-    CONFIGS.write(NOVA_CONF)
+    # NOTE: when run for every unit of the relation, e.g. by config_changed,
+    #       configs are written and the broker request sent once.
+    defer_work('ceph-configs', write_ceph_configs)
 
     # With some refactoring, this can move into NovaComputeCephContext
     # and allow easily extended to support other compute flavors.
     key = relation_get(attribute='key', rid=rid, unit=unit)
     if config('virt-type') in ['kvm', 'qemu', 'lxc'] and key:
-        create_libvirt_secret(secret_file=CEPH_SECRET,
-                              secret_uuid=secret_uuid, key=key)
+        defer_work(('libvirt-secret', secret_uuid, key),
+                   create_libvirt_secret, secret_file=CEPH_SECRET,
+                   secret_uuid=secret_uuid, key=key)
 
     if sent_app_name != CEPH_AUTH_CRED_NAME:
         log('Sending application name for new ceph credentials after '
             'setting up the old credentials')
-        send_application_name(relid=rid, app_name=CEPH_AUTH_CRED_NAME)
+        defer_work(('application-name', rid), send_application_name,
+                   relid=rid, app_name=CEPH_AUTH_CRED_NAME)
 
-    try:
-        _handle_ceph_request()
-    except ValueError as e:
-        # The end user has most likely provided a invalid value for a
-        # configuration option. Just log the traceback here, the end
-        # user will be notified by assess_status() called at the end of
-        # the hook execution.
-        log('Caught ValueError, invalid value provided for '
-            'configuration?: "{}"'.format(str(e)),
-            level=WARNING)
+    defer_work('ceph-request', send_ceph_request)
 
 
 # TODO: Refactor this method moving part of this logic to charmhelpers,
@@ -696,9 +925,10 @@ def _handle_ceph_request():
                                           broker_unit)):
             log('Restarting Nova Compute as per request '
                 '{}.'.format(request.request_id), level=DEBUG)
-            service_restart('nova-compute')
-            mark_broker_action_done('nova_compute_restart',
-                                    broker_rid, broker_unit)
+            queue_restart(
+                'nova-compute',
+                post_restart_f=lambda _: mark_broker_action_done(
+                    'nova_compute_restart', broker_rid, broker_unit))
     else:
         if sent:
             log("Request {} already sent, not sending "
@@ -745,7 +975,7 @@ def ceph_broken():
 
 
 @hooks.hook('amqp-relation-broken', 'image-service-relation-broken')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 def relation_broken():
     update_all_configs()
 
@@ -762,7 +992,7 @@ def upgrade_charm():
     if packages_removed and not is_unit_paused_set():
         log("Package purge detected, restarting services", "INFO")
         for s in services():
-            service_restart(s)
+            queue_restart(s)
 
     for r_id in relation_ids('amqp'):
         amqp_joined(relation_id=r_id)
@@ -774,6 +1004,8 @@ def upgrade_charm():
     if is_relation_made('nrpe-external-master'):
         update_nrpe_config()
 
+    request_full_config_changed()
+
     # Fix previously wrongly created path permissions
     # LP: https://bugs.launchpad.net/charm-cinder-ceph/+bug/1779676
     asok_path = '/var/run/ceph/'
@@ -793,7 +1025,7 @@ def nova_ceilometer_joined(relid=None, remote_restart=False):
 
 
 @hooks.hook('nova-ceilometer-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 def nova_ceilometer_relation_changed():
     update_all_configs()
     trigger_ceilometer_service_restart()
@@ -808,7 +1040,7 @@ def nova_vgpu_joined(relid=None, remote_restart=False):
 
 
 @hooks.hook('nova-vgpu-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 def nova_vgpu_relation_changed():
     update_all_configs()
     trigger_nova_vgpu_service_restart()
@@ -845,7 +1077,7 @@ def neutron_plugin_joined(relid=None, remote_restart=False):
 
 
 @hooks.hook('neutron-plugin-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 def neutron_plugin_changed():
     enable_nova_metadata, _ = nova_metadata_requirement()
     if enable_nova_metadata:
@@ -876,7 +1108,7 @@ def service_restart_handler(relation_id=None, unit=None,
                                    unit=unit,
                                    rid=relation_id) or default_service
             if service:
-                service_restart(service)
+                queue_restart(service)
         db.set(nonce_key, restart_nonce)
         db.flush()
 
@@ -888,7 +1120,7 @@ def lxd_joined(relid=None):
 
 
 @hooks.hook('lxd-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 def lxc_changed():
     nonce = relation_get('nonce')
     db = kv()
@@ -919,14 +1151,17 @@ def ceph_access(rid=None, unit=None):
     ceph_keyrings = relation_get('keyrings')
     if ceph_keyrings:
         for keyring in json.loads(ceph_keyrings):
-            _configure_keyring(
-                keyring['name'], keyring['key'], keyring['secret-uuid'])
+            keyring = (keyring['name'], keyring['key'], keyring['secret-uuid'])
+            defer_work(('ceph-access',) + keyring,
+                       _configure_keyring, *keyring)
     else:
         # NOTE: keep backwards compatibility with previous relation data
         key = relation_get('key', unit, rid)
         uuid = relation_get('secret-uuid', unit, rid)
         if key and uuid:
-            _configure_keyring(remote_service_name(rid), key, uuid)
+            keyring = (remote_service_name(rid), key, uuid)
+            defer_work(('ceph-access',) + keyring,
+                       _configure_keyring, *keyring)
 
 
 @hooks.hook('secrets-storage-relation-joined')
@@ -961,7 +1196,7 @@ def cloud_credentials_joined():
 
 
 @hooks.hook('cloud-credentials-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map)
 def cloud_credentials_changed():
     CONFIGS.write(NOVA_CONF)
 
@@ -975,6 +1210,9 @@ def check_and_start_iscsid():
 @harden()
 def update_status():
     log('Updating status.')
+    # NOTE: KSM is left alone while paused, as the services are.
+    if not is_unit_paused_set():
+        tune_ksm(config('ksm'))
 
 
 @hooks.hook('pre-series-upgrade')
@@ -996,6 +1234,7 @@ def post_series_upgrade():
         os.unlink(LIBVIRTD_PID)
     series_upgrade_complete(
         resume_unit_helper, CONFIGS)
+    request_full_config_changed()
 
 
 @hooks.hook('shared-db-relation-joined')
@@ -1037,12 +1276,52 @@ trigger_nova_vgpu_service_restart = functools.partial(
     nova_vgpu_joined)
 
 
-def main():
+DPKG_STATUS_INDEX = '.dpkg-status-index.json'
+
+
+def save_hook_profile():
+    """Write the profile of this hook execution and add it to the history."""
     try:
-        hooks.execute(sys.argv)
-    except UnregisteredHookError as e:
-        log('Unknown hook {} - skipping.'.format(e))
-    assess_status(CONFIGS)
+        report = profiler.save(hook_name(), charm_dir(), kv(),
+                               extra={'juju_tools': tool_invocations()})
+    except OSError as e:
+        log('Unable to save hook profile: {}'.format(e), level=WARNING)
+        return
+    kv().flush()
+    log('Hook {} took {:.3f}s, see {}'.format(
+        report['hook'], report['wall_time'], profiler.REPORT_FILE),
+        level=DEBUG)
+
+
+def main():
+    # NOTE: write log messages out in batches rather than forking juju-log
+    # for every message, errors are still written out immediately.
+    enable_log_buffer()
+    if config('hook-profiling'):
+        profiler.enable()
+        enable_tool_trace()
+    # NOTE: resolve installed package versions from /var/lib/dpkg/status,
+    # persisting the parsed index in the charm dir so that hooks run while
+    # no packages have changed do not need to fork dpkg-query.
+    enable_dpkg_status_index(
+        os.path.join(charm_dir(), DPKG_STATUS_INDEX) if charm_dir() else None)
+    # NOTE: unit kv writes are committed once, when the hook is done.
+    with kv().hook_transaction():
+        try:
+            # NOTE: services are restarted once, when the hook is done,
+            # however many handlers changed their configuration, and
+            # concurrently where they do not depend on each other.  Should
+            # the hook fail, the restarts are done by the next hook.
+            with deferred_restarts(
+                    dependencies=service_dependencies,
+                    pending_restarts=not is_unit_paused_set()):
+                hooks.execute(sys.argv)
+        except UnregisteredHookError as e:
+            log('Unknown hook {} - skipping.'.format(e))
+        assess_status(CONFIGS)
+        if profiler.enabled():
+            save_hook_profile()
+    log_tool_invocations()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,408 @@
+# Copyright 2024 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""NUMA aware huge page planning.
+
+The hugepages option either holds a number or percentage of 2M pages, which
+the kernel spreads over the NUMA nodes itself, or a plan of pages per size
+and per node::
+
+    1G:16@node0,16@node1;2M:10%
+
+Each size is followed by allocations separated by commas.  An allocation is
+a number of pages or a percentage of the node memory, for one node when
+followed by @nodeN or for every node otherwise (numbers of pages are then
+split evenly).  /R after an allocation keeps R of its pages for the host,
+e.g. for OVS-DPDK, and these are added to reserved_huge_pages in nova.conf::
+
+    1G:16@node0/2,16@node1;2M:10%
+"""
+
+import collections
+import glob
+import os
+import re
+
+from charmhelpers.core.hookenv import (
+    log,
+    DEBUG,
+    WARNING,
+)
+from charmhelpers.core.strutils import bytes_from_string
+
+SYSFS = '/sys'
+PROC_MEMINFO = '/proc/meminfo'
+NODE_PATH = 'devices/system/node'
+# per page size pools, the only ones counting reserved pages
+GLOBAL_POOL_PATH = 'kernel/mm/hugepages'
+DEFAULT_PAGE_SIZE = '2M'
+
+# pool attributes as read by hugepage_pools and node_hugepage_pools
+POOL_ATTRIBUTES = {
+    'total': 'nr_hugepages',
+    'free': 'free_hugepages',
+    'surplus': 'surplus_hugepages',
+    'reserved': 'resv_hugepages',
+}
+
+# pages of size_kb on a NUMA node, reserved of which are kept for the host
+Allocation = collections.namedtuple(
+    'Allocation', ['node', 'size_kb', 'count', 'reserved'])
+
+_ALLOCATION_RE = re.compile(
+    r'^(?P<amount>\d+(\.\d+)?)(?P<percent>%)?'
+    r'(@node(?P<node>\d+))?(/(?P<reserved>\d+))?$')
+
+
+def is_hugepage_plan(value):
+    """Whether a hugepages option value is a plan rather than a 2M count.
+
+    :param value: the hugepages option
+    :type value: Optional[str]
+    :rtype: bool
+    """
+    return bool(value) and ':' in value
+
+
+def page_size_kb(size):
+    """Page size in KiB from a human readable size, e.g. 2M or 1GB.
+
+    :param size: the page size
+    :type size: str
+    :rtype: int
+    :raises: ValueError if the size cannot be interpreted
+    """
+    try:
+        size_kb = bytes_from_string(size.strip().upper()) // 1024
+    except (KeyError, ValueError):
+        size_kb = 0
+    if size_kb <= 0:
+        raise ValueError("Invalid huge page size '{}'".format(size))
+    return size_kb
+
+
+def node_path(node, *path):
+    """Path under the sysfs directory of a NUMA node."""
+    return os.path.join(SYSFS, NODE_PATH, 'node{}'.format(node), *path)
+
+
+def pool_path(node, size_kb, name):
+    """Path of a per node huge page pool attribute, e.g. nr_hugepages."""
+    return node_path(node, 'hugepages', 'hugepages-{}kB'.format(size_kb),
+                     name)
+
+
+def _read_int(path):
+    with open(path) as f:
+        return int(f.read().strip())
+
+
+def numa_nodes():
+    """NUMA nodes and their memory.
+
+    :returns: {node: MemTotal in KiB}
+    :rtype: Dict[int, int]
+    """
+    nodes = {}
+    for path in glob.glob(node_path('*', 'meminfo')):
+        node = int(os.path.basename(os.path.dirname(path))[len('node'):])
+        with open(path) as f:
+            for line in f:
+                # Node 0 MemTotal:       32849164 kB
+                fields = line.split()
+                if len(fields) >= 4 and fields[2] == 'MemTotal:':
+                    nodes[node] = int(fields[3])
+                    break
+    return nodes
+
+
+def _read_pools(pattern):
+    """Read the attributes of the hugepages-<size>kB pools matching pattern.
+
+    :returns: {size_kb: {attribute: value}}
+    :rtype: Dict[int, Dict[str, int]]
+    """
+    pools = {}
+    for path in glob.glob(pattern):
+        size_kb = int(os.path.basename(path)[len('hugepages-'):-len('kB')])
+        pool = pools[size_kb] = {}
+        for attribute, name in POOL_ATTRIBUTES.items():
+            try:
+                pool[attribute] = _read_int(os.path.join(path, name))
+            except (IOError, OSError, ValueError):
+                # NOTE: node pools have no resv_hugepages
+                continue
+    return pools
+
+
+def hugepage_pools():
+    """Huge page pools of the system, one per page size.
+
+    :returns: {size_kb: {'total': n, 'free': n, 'surplus': n,
+                         'reserved': n}}
+    :rtype: Dict[int, Dict[str, int]]
+    """
+    return _read_pools(os.path.join(SYSFS, GLOBAL_POOL_PATH,
+                                    'hugepages-*kB'))
+
+
+def node_hugepage_pools():
+    """Huge page pools of each NUMA node.
+
+    :returns: {node: {size_kb: {'total': n, 'free': n, 'surplus': n}}}
+    :rtype: Dict[int, Dict[int, Dict[str, int]]]
+    """
+    pools = {}
+    for path in glob.glob(node_path('*')):
+        name = os.path.basename(path)
+        if name[len('node'):].isdigit():
+            pools[int(name[len('node'):])] = _read_pools(
+                os.path.join(path, 'hugepages', 'hugepages-*kB'))
+    return pools
+
+
+def default_page_size_kb():
+    """Size of the default huge pages, those of vm.nr_hugepages.
+
+    :rtype: int
+    """
+    try:
+        with open(PROC_MEMINFO) as f:
+            for line in f:
+                if line.startswith('Hugepagesize:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return page_size_kb(DEFAULT_PAGE_SIZE)
+
+
+def parse_hugepage_plan(value):
+    """Parse a hugepages plan into its allocations per page size.
+
+    :param value: e.g. '1G:16@node0,16@node1;2M:10%'
+    :type value: str
+    :returns: [(size_kb, [(amount, percent, node, reserved)])]
+    :rtype: List[Tuple[int, List[Tuple[float, bool, Optional[int], int]]]]
+    :raises: ValueError if the plan is not valid
+    """
+    sizes = []
+    for size_spec in value.split(';'):
+        if not size_spec.strip():
+            continue
+        size, sep, allocations = size_spec.partition(':')
+        if not sep:
+            raise ValueError("Missing page size in '{}'".format(size_spec))
+        parsed = []
+        for allocation in allocations.split(','):
+            match = _ALLOCATION_RE.match(allocation.strip())
+            if not match:
+                raise ValueError(
+                    "Invalid huge page allocation '{}'".format(allocation))
+            percent = bool(match.group('percent'))
+            amount = float(match.group('amount'))
+            if not percent and amount != int(amount):
+                raise ValueError(
+                    "Invalid number of huge pages '{}'".format(allocation))
+            node = match.group('node')
+            parsed.append((amount, percent,
+                           int(node) if node is not None else None,
+                           int(match.group('reserved') or 0)))
+        sizes.append((page_size_kb(size), parsed))
+    return sizes
+
+
+def _split(total, parts):
+    """Split total into parts differing by at most one."""
+    return [total // parts + (1 if i < total % parts else 0)
+            for i in range(parts)]
+
+
+def plan_hugepages(value, nodes=None):
+    """Compute the huge pages to allocate on each NUMA node.
+
+    :param value: the hugepages option
+    :type value: str
+    :param nodes: {node: MemTotal in KiB}, read from sysfs if not given
+    :type nodes: Optional[Dict[int, int]]
+    :returns: allocations sorted by node and page size
+    :rtype: List[Allocation]
+    :raises: ValueError if the plan is not valid or does not fit the nodes
+    """
+    if nodes is None:
+        nodes = numa_nodes()
+    if not nodes:
+        raise ValueError('No NUMA nodes found in {}'.format(
+            os.path.join(SYSFS, NODE_PATH)))
+    node_ids = sorted(nodes)
+    plan = {}
+    for size_kb, allocations in parse_hugepage_plan(value):
+        for amount, percent, node, reserved in allocations:
+            if node is not None and node not in nodes:
+                raise ValueError('Unknown NUMA node {}'.format(node))
+            targets = [node] if node is not None else node_ids
+            if percent:
+                counts = [int(nodes[n] * amount / 100 // size_kb)
+                          for n in targets]
+            else:
+                counts = _split(int(amount), len(targets))
+            for n, count, node_reserved in zip(
+                    targets, counts, _split(reserved, len(targets))):
+                if (n, size_kb) in plan:
+                    raise ValueError(
+                        'Huge pages of {}kB allocated twice on node {}'
+                        .format(size_kb, n))
+                if node_reserved > count:
+                    raise ValueError(
+                        'More huge pages reserved than allocated on node {}'
+                        .format(n))
+                plan[(n, size_kb)] = Allocation(n, size_kb, count,
+                                                node_reserved)
+    for n in node_ids:
+        planned = sum(a.count * a.size_kb for a in plan.values()
+                      if a.node == n)
+        if planned > nodes[n]:
+            raise ValueError(
+                'Huge pages planned on node {} exceed its memory ({}kB > '
+                '{}kB)'.format(n, planned, nodes[n]))
+    return [plan[k] for k in sorted(plan)]
+
+
+def allocated_hugepages(node, size_kb):
+    """Number of huge pages the kernel holds in a node pool.
+
+    :rtype: Optional[int]
+    :returns: None when the page size is not supported on the node
+    """
+    try:
+        return _read_int(pool_path(node, size_kb, 'nr_hugepages'))
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def apply_hugepage_plan(plan):
+    """Resize the node pools to the plan and check what the kernel did.
+
+    The kernel allocates what it can, 1G pages in particular may not be
+    available anymore once memory is fragmented and are better allocated
+    on the kernel command line, so each pool is read back.
+
+    :param plan: allocations from plan_hugepages
+    :type plan: List[Allocation]
+    :returns: allocations actually made by the kernel, short of the plan
+    :rtype: List[Allocation]
+    """
+    shortfalls = []
+    for allocation in plan:
+        path = pool_path(allocation.node, allocation.size_kb, 'nr_hugepages')
+        if not os.path.exists(path):
+            log('Huge pages of {}kB are not supported on node {}'
+                .format(allocation.size_kb, allocation.node), level=WARNING)
+            shortfalls.append(allocation._replace(count=0, reserved=0))
+            continue
+        if allocated_hugepages(allocation.node,
+                               allocation.size_kb) != allocation.count:
+            log('Allocating {} huge pages of {}kB on node {}'.format(
+                allocation.count, allocation.size_kb, allocation.node),
+                level=DEBUG)
+            try:
+                with open(path, 'w') as f:
+                    f.write(str(allocation.count))
+            except (IOError, OSError) as e:
+                log('Could not resize {}: {}'.format(path, e), level=WARNING)
+        allocated = allocated_hugepages(allocation.node,
+                                        allocation.size_kb) or 0
+        if allocated < allocation.count:
+            log('Only {} of {} huge pages of {}kB allocated on node {}'
+                .format(allocated, allocation.count, allocation.size_kb,
+                        allocation.node), level=WARNING)
+            shortfalls.append(allocation._replace(
+                count=allocated,
+                reserved=min(allocation.reserved, allocated)))
+    return shortfalls
+
+
+def hugepage_reservations(value):
+    """reserved_huge_pages entries for the pages a plan keeps for the host.
+
+    Reservations are capped to the pages the kernel actually allocated.
+
+    :param value: the hugepages option
+    :type value: Optional[str]
+    :returns: e.g. ['node:0,size:1048576,count:2']
+    :rtype: List[str]
+    """
+    if not is_hugepage_plan(value):
+        return []
+    try:
+        plan = plan_hugepages(value)
+    except ValueError as e:
+        log('Invalid hugepages plan: {}'.format(e), level=WARNING)
+        return []
+    reservations = []
+    for allocation in plan:
+        if not allocation.reserved:
+            continue
+        count = min(allocation.reserved,
+                    allocated_hugepages(allocation.node,
+                                        allocation.size_kb) or 0)
+        if count:
+            reservations.append('node:{},size:{},count:{}'.format(
+                allocation.node, allocation.size_kb, count))
+    return reservations
+
+
+def _reservation_key(reservation):
+    fields = dict(f.partition(':')[::2] for f in reservation.split(','))
+    try:
+        size = fields.get('size', '').strip()
+        return (int(fields.get('node')),
+                int(size) if size.isdigit() else page_size_kb(size))
+    except (TypeError, ValueError):
+        return None
+
+
+def merge_reservations(configured, planned):
+    """Add the reservations of a plan to the reserved-huge-pages ones.
+
+    The configured reservation wins for a node and page size in both.
+
+    :param configured: entries of the reserved-huge-pages option
+    :type configured: Iterable[str]
+    :param planned: entries from hugepage_reservations
+    :type planned: Iterable[str]
+    :rtype: List[str]
+    """
+    merged = list(configured)
+    keys = set(_reservation_key(r) for r in merged)
+    merged.extend(r for r in planned if _reservation_key(r) not in keys)
+    return merged
+
+
+def reservations_kb(reservations):
+    """Memory of the huge pages in reserved_huge_pages entries.
+
+    :param reservations: e.g. ['node:0,size:1GB,count:2']
+    :type reservations: Iterable[str]
+    :rtype: int
+    """
+    total = 0
+    for reservation in reservations:
+        key = _reservation_key(reservation)
+        fields = dict(f.partition(':')[::2] for f in reservation.split(','))
+        try:
+            total += key[1] * int(fields.get('count'))
+        except (TypeError, ValueError):
+            log('Ignoring invalid huge pages reservation {}'.format(
+                reservation), level=WARNING)
+    return total
@@ -0,0 +1,242 @@
+# Copyright 2024 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""KSM tuning profiles.
+
+The ksm option either toggles KSM through /etc/default/qemu-kvm (1, 0 or
+AUTO) or names a profile whose tunables are written to /sys/kernel/mm/ksm:
+
+- off: ksmd stopped, pages already merged stay merged;
+- conservative: a slow scan, for hosts where memory is not scarce;
+- aggressive: a fast scan, for dense hosts relying on KSM;
+- memory-pressure-adaptive: the scan rate is adjusted on every
+  update-status, in the manner of ksmtuned, from the free memory and how
+  effective the scan is.  ksmd is stopped while memory is plentiful, the
+  scan is sped up under memory pressure and slowed down when it mostly
+  finds pages that cannot be merged.  The decisions are kept in the unit
+  kv store.
+
+The tunables are set back to the kernel defaults when the ksm option goes
+from a profile back to 1, 0 or AUTO.
+"""
+
+import time
+
+from charmhelpers.core.hookenv import (
+    log,
+    DEBUG,
+    INFO,
+    WARNING,
+)
+from charmhelpers.core.unitdata import kv
+
+SYSFS = '/sys'
+PROC_MEMINFO = '/proc/meminfo'
+KSM_PATH = 'kernel/mm/ksm'
+
+PROFILES = {
+    'off': {'run': 0},
+    'conservative': {'run': 1, 'pages_to_scan': 100,
+                     'sleep_millisecs': 200},
+    'aggressive': {'run': 1, 'pages_to_scan': 1250,
+                   'sleep_millisecs': 20},
+    'memory-pressure-adaptive': None,
+}
+ADAPTIVE = 'memory-pressure-adaptive'
+# tunables written by profiles, as the kernel sets them
+KERNEL_DEFAULTS = {'pages_to_scan': 100, 'sleep_millisecs': 20}
+PROFILE_KEY = 'ksm-profile'
+
+# memory-pressure-adaptive settings, as the ksmtuned defaults
+ADAPTIVE_FREE_PERCENT = 20
+ADAPTIVE_PAGES_MIN = 64
+ADAPTIVE_PAGES_MAX = 1250
+ADAPTIVE_PAGES_BOOST = 300
+ADAPTIVE_PAGES_DECAY = 50
+# scan slowed down when fewer pages are shared than 1 in 10 unshared
+ADAPTIVE_MIN_SHARING_RATIO = 0.1
+# sleep between scans of 10ms for 16GiB of memory, longer for less
+ADAPTIVE_SLEEP_MSEC = 10
+ADAPTIVE_SLEEP_MEMORY_KB = 16 * 1024 * 1024
+ADAPTIVE_HISTORY_KEY = 'ksm-adaptive-history'
+ADAPTIVE_HISTORY_SIZE = 48
+
+
+def is_ksm_profile(value):
+    """Whether a ksm option value names a profile.
+
+    :param value: the ksm option
+    :type value: Optional[str]
+    :rtype: bool
+    """
+    return value in PROFILES
+
+
+def _path(name):
+    return '{}/{}/{}'.format(SYSFS, KSM_PATH, name)
+
+
+def read_ksm():
+    """Tunables and counters of KSM.
+
+    :returns: {name: value}, empty when KSM is not available
+    :rtype: Dict[str, int]
+    """
+    values = {}
+    for name in ('run', 'pages_to_scan', 'sleep_millisecs', 'pages_shared',
+                 'pages_sharing', 'pages_unshared'):
+        try:
+            with open(_path(name)) as f:
+                values[name] = int(f.read().strip())
+        except (IOError, OSError, ValueError):
+            continue
+    return values
+
+
+def write_ksm(tunables, current=None):
+    """Write KSM tunables differing from their current value.
+
+    :param tunables: {name: value}
+    :type tunables: Dict[str, int]
+    :param current: from read_ksm, read if not given
+    :type current: Optional[Dict[str, int]]
+    """
+    if current is None:
+        current = read_ksm()
+    # NOTE: run is written last so that ksmd starts with the new rate
+    for name in sorted(tunables, key=lambda n: n == 'run'):
+        if current.get(name) == tunables[name]:
+            continue
+        log('Setting KSM {} to {}'.format(name, tunables[name]), level=DEBUG)
+        try:
+            with open(_path(name), 'w') as f:
+                f.write(str(tunables[name]))
+        except (IOError, OSError) as e:
+            log('Unable to set KSM {}: {}'.format(name, e), level=WARNING)
+
+
+def _meminfo():
+    meminfo = {}
+    try:
+        with open(PROC_MEMINFO) as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in ('MemTotal', 'MemAvailable'):
+                    meminfo[name] = int(value.split()[0])
+    except (IOError, OSError, ValueError):
+        pass
+    return meminfo
+
+
+def adaptive_decision(current, meminfo):
+    """Next KSM tunables of the memory-pressure-adaptive profile.
+
+    :param current: from read_ksm
+    :type current: Dict[str, int]
+    :param meminfo: MemTotal and MemAvailable in kB
+    :type meminfo: Dict[str, int]
+    :returns: the tunables and the reason for them
+    :rtype: Tuple[Dict[str, int], str]
+    """
+    total = meminfo.get('MemTotal') or 1
+    free_percent = 100.0 * meminfo.get('MemAvailable', total) / total
+    sleep = max(ADAPTIVE_SLEEP_MSEC,
+                ADAPTIVE_SLEEP_MSEC * ADAPTIVE_SLEEP_MEMORY_KB // total)
+    pages = current.get('pages_to_scan', ADAPTIVE_PAGES_MIN)
+    if free_percent >= ADAPTIVE_FREE_PERCENT:
+        return ({'run': 0}, 'free memory {:.1f}%'.format(free_percent))
+    if not current.get('run'):
+        pages = ADAPTIVE_PAGES_MIN
+        reason = 'memory pressure, starting'
+    elif (current.get('pages_sharing', 0) <
+            ADAPTIVE_MIN_SHARING_RATIO * current.get('pages_unshared', 0)):
+        pages -= ADAPTIVE_PAGES_DECAY
+        reason = 'memory pressure, few pages shared'
+    else:
+        pages += ADAPTIVE_PAGES_BOOST
+        reason = 'memory pressure'
+    pages = min(max(pages, ADAPTIVE_PAGES_MIN), ADAPTIVE_PAGES_MAX)
+    return ({'run': 1, 'pages_to_scan': pages, 'sleep_millisecs': sleep},
+            '{}, free memory {:.1f}%'.format(reason, free_percent))
+
+
+def record_decision(tunables, reason, current):
+    """Add a decision of the adaptive profile to its history."""
+    db = kv()
+    history = db.get(ADAPTIVE_HISTORY_KEY) or []
+    history.append({
+        'time': int(time.time()),
+        'reason': reason,
+        'tunables': tunables,
+        'pages_sharing': current.get('pages_sharing'),
+        'pages_unshared': current.get('pages_unshared'),
+    })
+    db.set(ADAPTIVE_HISTORY_KEY, history[-ADAPTIVE_HISTORY_SIZE:])
+    db.flush()
+
+
+def tune_ksm(value):
+    """Apply a KSM profile.
+
+    Profiles are reapplied on each call as restarting qemu-kvm resets some
+    tunables; the memory-pressure-adaptive profile takes a new decision.
+    Once the value is no longer a profile the kernel defaults are restored.
+
+    :param value: the ksm option
+    :type value: Optional[str]
+    """
+    db = kv()
+    if not is_ksm_profile(value):
+        if db.get(PROFILE_KEY) is not None:
+            log('Restoring the default KSM tunables', level=INFO)
+            write_ksm(KERNEL_DEFAULTS)
+            db.unset(PROFILE_KEY)
+            db.flush()
+        return
+    current = read_ksm()
+    if not current:
+        log('KSM is not available', level=WARNING)
+        return
+    if db.get(PROFILE_KEY) != value:
+        db.set(PROFILE_KEY, value)
+        db.flush()
+    if value != ADAPTIVE:
+        write_ksm(PROFILES[value], current)
+        return
+    tunables, reason = adaptive_decision(current, _meminfo())
+    if any(current.get(k) != v for k, v in tunables.items()):
+        log('Adjusting KSM: {} ({})'.format(
+            ', '.join('{} {}'.format(k, v)
+                      for k, v in sorted(tunables.items())), reason),
+            level=INFO)
+    write_ksm(tunables, current)
+    record_decision(tunables, reason, current)
+
+
+def ksm_enabled(value):
+    """KSM_ENABLED of /etc/default/qemu-kvm for a profile.
+
+    :rtype: str
+    """
+    return '0' if value == 'off' else '1'
+
+
+def ksm_sleep_millisecs(value):
+    """SLEEP_MILLISECS of /etc/default/qemu-kvm for a profile.
+
+    qemu-kvm sets it when it starts, it must not undo the profile.
+
+    :rtype: Optional[int]
+    """
+    return (PROFILES[value] or {}).get('sleep_millisecs')
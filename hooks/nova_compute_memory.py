@@ -0,0 +1,208 @@
+# Copyright 2024 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Memory to reserve for the host, computed from what it actually uses.
+
+With reserved-host-memory-auto the reserved_host_memory_mb of nova.conf is
+the sum of:
+
+- base: reserved-host-memory, for the operating system;
+- ovs_dpdk: the OVS-DPDK socket memory not in the huge pages kept for the
+  host with reserved-huge-pages or a hugepages plan;
+- rbd_cache: the rbd client cache of reserved-host-memory-rbd-disks disks,
+  when rbd-client-cache is enabled;
+- services: the resident memory of nova-compute and libvirtd;
+- ksm: the memory KSM currently saves, which is needed again as soon as
+  the merged pages are written to.
+
+The huge pages kept for the host are not counted, nova already leaves them
+out with reserved_huge_pages.  The rbd cache is that of the disks the host
+is expected to hold rather than of the instances running when it is
+computed, but the services and ksm terms are sampled: the reservation is
+only computed on config-changed.
+
+The total is rounded up to GRANULE_MB and only lowered when it falls more
+than a granule below the value in use, so that nova-compute is not
+restarted for small variations of the memory its services use.
+"""
+
+import collections
+import glob
+import math
+import os
+import signal
+import subprocess
+
+from charmhelpers.core.hookenv import (
+    config,
+    log,
+    DEBUG,
+    INFO,
+    WARNING,
+)
+from charmhelpers.core.unitdata import kv
+
+from nova_compute_hugepages import (
+    hugepage_reservations,
+    merge_reservations,
+    reservations_kb,
+)
+from nova_compute_ksm import read_ksm
+
+PROC = '/proc'
+# seconds ovs-vsctl may take, e.g. waiting for an unresponsive ovsdb-server
+OVS_VSCTL_TIMEOUT = 10
+
+# rbd cache size configured when rbd-client-cache is enabled
+RBD_CACHE_SIZE = 67108864
+SERVICE_PROCESSES = ('nova-compute', 'libvirtd')
+GRANULE_MB = 256
+RESERVED_HOST_MEMORY_KEY = 'reserved-host-memory-auto'
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read().strip()
+
+
+def process_rss_kb(names=SERVICE_PROCESSES):
+    """Resident memory of the processes with the given names.
+
+    :param names: process names, as in /proc/<pid>/comm
+    :type names: Iterable[str]
+    :rtype: int
+    """
+    total = 0
+    for path in glob.glob(os.path.join(PROC, '[0-9]*', 'comm')):
+        try:
+            if _read(path) not in names:
+                continue
+            with open(os.path.join(os.path.dirname(path), 'status')) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+                        break
+        except (IOError, OSError, ValueError):
+            # NOTE: the process exited meanwhile
+            continue
+    return total
+
+
+def ovs_dpdk_socket_mem_mb():
+    """Memory OVS-DPDK allocates on the NUMA nodes, from dpdk-socket-mem.
+
+    :rtype: int
+    """
+    try:
+        value = subprocess.check_output(
+            ['ovs-vsctl', '--no-wait',
+             '--timeout={}'.format(OVS_VSCTL_TIMEOUT), 'get', 'Open_vSwitch',
+             '.', 'other_config:dpdk-socket-mem'],
+            stderr=subprocess.DEVNULL,
+            timeout=OVS_VSCTL_TIMEOUT + 5).decode('UTF-8')
+    except subprocess.TimeoutExpired:
+        log('ovs-vsctl timed out, not reserving OVS-DPDK memory',
+            level=WARNING)
+        return 0
+    except subprocess.CalledProcessError as e:
+        # NOTE: ovs-vsctl is killed by SIGALRM once its timeout expires
+        if e.returncode == -signal.SIGALRM:
+            log('ovs-vsctl timed out, not reserving OVS-DPDK memory',
+                level=WARNING)
+        return 0
+    except OSError:
+        return 0
+    try:
+        return sum(int(mb) for mb in value.strip().strip('"').split(',')
+                   if mb.strip())
+    except ValueError:
+        return 0
+
+
+def ksm_shared_kb():
+    """Memory KSM currently saves by merging pages.
+
+    :rtype: int
+    """
+    values = read_ksm()
+    if values.get('run') != 1:
+        return 0
+    return values.get('pages_sharing', 0) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def _mb(kb):
+    return int(math.ceil(kb / 1024.0))
+
+
+def memory_breakdown():
+    """Memory to reserve for the host, by use.
+
+    :returns: {use: MB}
+    :rtype: collections.OrderedDict
+    """
+    reservations = merge_reservations(
+        [r.strip() for r in (config('reserved-huge-pages') or '').split(';')
+         if r.strip()],
+        hugepage_reservations(config('hugepages')))
+    hugepages_mb = _mb(reservations_kb(reservations))
+    rbd_cache = (config('rbd-client-cache') or '').lower() == 'enabled'
+    breakdown = collections.OrderedDict()
+    breakdown['base'] = config('reserved-host-memory') or 0
+    breakdown['ovs_dpdk'] = max(ovs_dpdk_socket_mem_mb() - hugepages_mb, 0)
+    breakdown['rbd_cache'] = (
+        (config('reserved-host-memory-rbd-disks') or 0) *
+        RBD_CACHE_SIZE // 1048576 if rbd_cache else 0)
+    breakdown['services'] = _mb(process_rss_kb())
+    breakdown['ksm'] = _mb(ksm_shared_kb())
+    return breakdown
+
+
+def recommended_reserved_host_memory(breakdown):
+    """Total of a breakdown rounded up to GRANULE_MB.
+
+    :param breakdown: from memory_breakdown
+    :type breakdown: Dict[str, int]
+    :rtype: int
+    """
+    total = sum(breakdown.values())
+    return int(math.ceil(total / float(GRANULE_MB))) * GRANULE_MB
+
+
+def update_reserved_host_memory():
+    """Compute and record the memory to reserve for the host.
+
+    :returns: whether the recorded reservation changed
+    :rtype: bool
+    """
+    db = kv()
+    current = db.get(RESERVED_HOST_MEMORY_KEY)
+    if not config('reserved-host-memory-auto'):
+        if current is None:
+            return False
+        db.unset(RESERVED_HOST_MEMORY_KEY)
+        db.flush()
+        return True
+    breakdown = memory_breakdown()
+    recommended = recommended_reserved_host_memory(breakdown)
+    log('Memory to reserve for the host: {}MB ({})'.format(
+        recommended, ', '.join('{} {}MB'.format(k, v)
+                               for k, v in breakdown.items())),
+        level=DEBUG)
+    if current is not None and current - GRANULE_MB <= recommended <= current:
+        return False
+    log('Reserving {}MB of memory for the host'.format(recommended),
+        level=INFO)
+    db.set(RESERVED_HOST_MEMORY_KEY, recommended)
+    db.flush()
+    return True
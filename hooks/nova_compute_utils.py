@@ -59,6 +59,7 @@ from charmhelpers.core.hookenv import (
     relation_get,
     status_set,
     DEBUG,
+    ERROR,
     INFO,
     WARNING,
     storage_list,
@@ -87,6 +88,18 @@ from charmhelpers.contrib.openstack.utils import (
 
 from charmhelpers.core.hugepage import hugepage_support
 
+from nova_compute_cpus import (
+    check_cpu_sets,
+    cpu_sets,
+)
+from nova_compute_hugepages import (
+    apply_hugepage_plan,
+    default_page_size_kb,
+    is_hugepage_plan,
+    plan_hugepages,
+    pool_path,
+)
+
 from nova_compute_context import (
     nova_metadata_requirement,
     CloudComputeContext,
@@ -205,6 +218,11 @@ NOVA_NETWORK_AA_PROFILE_PATH = ('/etc/apparmor.d/{}'
 
 NOVA_COMPUTE_OVERRIDE_DIR = '/etc/systemd/system/nova-compute.service.d'
 MOUNT_DEPENDENCY_OVERRIDE = '99-mount.conf'
+# interfaces with complete contexts, as of the last hook assessing them
+COMPLETE_CONTEXTS_KEY = 'complete-contexts'
+HUGEPAGES_SERVICE = 'nova-compute-hugepages.service'
+HUGEPAGES_SERVICE_PATH = os.path.join('/etc/systemd/system',
+                                      HUGEPAGES_SERVICE)
 
 LIBVIRT_TYPES = ['kvm', 'qemu', 'lxc']
 
@@ -361,12 +379,36 @@ def vaultlocker_installed():
     return len(filter_installed_packages(['vaultlocker'])) == 0
 
 
+# Resource map, restart map and principal service list for the current hook
+# execution; see resource_map() and reset_resource_map().
+_resource_map_cache = {}
+
+
+def reset_resource_map():
+    '''Unset the cached resource map and the maps derived from it.
+
+    Must be called whenever something that resource_map() depends on changes
+    during a hook execution, e.g. after an OpenStack upgrade or after
+    installing packages that alter the set of managed resources.
+    '''
+    _resource_map_cache.clear()
+
+
 def resource_map():
     '''
     Dynamically generate a map of resources that will be managed for a single
     hook execution.
+
+    The map is generated on first call and cached for the rest of the hook;
+    the returned dict is shared between callers and must not be modified.
+    Use reset_resource_map() to force it to be regenerated.
     '''
-    # TODO: Cache this on first call?
+    if 'resource_map' not in _resource_map_cache:
+        _resource_map_cache['resource_map'] = _generate_resource_map()
+    return _resource_map_cache['resource_map']
+
+
+def _generate_resource_map():
     virt_type = config('virt-type').lower()
     if virt_type in ('lxd', 'ironic'):
         resource_map = deepcopy(BASE_RESOURCE_MAP)
@@ -455,7 +497,10 @@ def restart_map():
     Constructs a restart map based on charm config settings and relation
     state.
     '''
-    return {k: v['services'] for k, v in resource_map().items()}
+    if 'restart_map' not in _resource_map_cache:
+        _resource_map_cache['restart_map'] = {
+            k: v['services'] for k, v in resource_map().items()}
+    return _resource_map_cache['restart_map']
 
 
 def services():
@@ -468,17 +513,42 @@ def services():
     # service. Attempting to start the ceilometer-agent-compute service first
     # will then fail. Thus we return the services here in a resume-friendly
     # order, i.e. the principal services first, then the subordinate ones.
-    return (list(set(chain(*restart_map().values()))) +
+    if 'services' not in _resource_map_cache:
+        _resource_map_cache['services'] = list(
+            set(chain(*restart_map().values())))
+    return (list(_resource_map_cache['services']) +
             list(get_subordinate_services()))
 
 
+def service_dependencies():
+    '''
+    Returns the dependencies between the services associated with this charm
+    and its subordinates, as {service: [services it depends on, ...]}.
+
+    nova-compute depends on the libvirt daemon, and the subordinate services
+    depend on all principal services, see services().  Services without
+    dependencies between them are restarted, stopped and started
+    concurrently; all principal services are listed, so that they are not
+    run in order as services with unknown dependencies are.
+    '''
+    principal = set(chain(*restart_map().values()))
+    dependencies = {service: [] for service in principal}
+    if 'nova-compute' in principal:
+        dependencies['nova-compute'] = sorted(
+            principal & {LIBVIRTD_DAEMON, LIBVIRT_BIN_DAEMON})
+    for service in get_subordinate_services() - principal:
+        dependencies[service] = sorted(principal)
+    return dependencies
+
+
 def register_configs():
     '''
     Returns an OSTemplateRenderer object with all required configs registered.
     '''
     release = os_release('nova-common')
     configs = templating.OSConfigRenderer(templates_dir=TEMPLATES,
-                                          openstack_release=release)
+                                          openstack_release=release,
+                                          prefetch_relations=True)
 
     if relation_ids('ceph'):
         # Add charm ceph configuration to resources and
@@ -499,6 +569,50 @@ def register_configs():
     return configs
 
 
+class LazyConfigRenderer(object):
+    '''
+    Proxy for the OSConfigRenderer returned by register_configs() which defers
+    registering the configs until the renderer is first used.
+
+    Every hook assesses the status of the unit, which needs the interfaces
+    whose contexts are complete.  Config and relation data only change in the
+    hooks reporting the change, so update-status reuses the complete contexts
+    recorded by the previous hook, and only registers the configs and
+    evaluates the contexts when there is no record or an interface is
+    incomplete.
+    '''
+
+    def __init__(self, factory=None):
+        self._factory = factory or register_configs
+        self._configs = None
+
+    def __getattr__(self, name):
+        if name in ('_factory', '_configs'):
+            raise AttributeError(name)
+        return getattr(self._renderer(), name)
+
+    def _renderer(self):
+        if self._configs is None:
+            self._configs = self._factory()
+        return self._configs
+
+    def complete_contexts(self):
+        '''
+        Interfaces whose contexts are complete, see
+        OSConfigRenderer.complete_contexts().
+
+        @returns [interface, ...]
+        '''
+        db = kv()
+        if self._configs is None and hook_name() == 'update-status':
+            recorded = db.get(COMPLETE_CONTEXTS_KEY)
+            if recorded is not None:
+                return recorded
+        complete = self._renderer().complete_contexts()
+        db.set(COMPLETE_CONTEXTS_KEY, complete)
+        return complete
+
+
 def determine_packages_arch():
     '''Generate list of architecture-specific packages'''
     packages = []
@@ -781,6 +895,7 @@ def do_openstack_upgrade(configs):
 
     apt_upgrade(options=dpkg_opts, fatal=True, dist=True)
     reset_os_release()
+    reset_resource_map()
     apt_install(determine_packages(), fatal=True)
 
     remove_old_packages()
@@ -904,13 +1019,26 @@ def assert_charm_supports_ipv6():
 
 
 def get_hugepage_number():
-    # TODO: defaults to 2M - this should probably be configurable
-    #       and support multiple pool sizes - e.g. 2M and 1G.
+    """Number of default size huge pages to allocate.
+
+    For a plan of pages per size and NUMA node (see nova_compute_hugepages)
+    this is the total of its pages of the default size, usually 2M.
+
+    :rtype: Optional[int]
+    """
     # NOTE(jamespage): 2M in bytes
     hugepage_size = 2048 * 1024
     hugepage_config = config('hugepages')
     hugepages = None
-    if hugepage_config:
+    if is_hugepage_plan(hugepage_config):
+        try:
+            plan = plan_hugepages(hugepage_config)
+        except ValueError as e:
+            log('Invalid hugepages plan: {}'.format(e), level=ERROR)
+            return None
+        size_kb = default_page_size_kb()
+        hugepages = sum(a.count for a in plan if a.size_kb == size_kb)
+    elif hugepage_config:
         if hugepage_config.endswith('%'):
             # NOTE(jamespage): return units of virtual_memory is
             #                  bytes
@@ -927,16 +1055,27 @@ def get_hugepage_number():
 def install_hugepages():
     """ Configure hugepages """
     hugepage_config = config('hugepages')
+    if not is_hugepage_plan(hugepage_config):
+        persist_hugepage_plan([])
     if hugepage_config:
+        nr_hugepages = get_hugepage_number()
+        if nr_hugepages is None:
+            return
         mnt_point = '/run/hugepages/kvm'
         hugepage_support(
             'nova',
             mnt_point=mnt_point,
             group='root',
-            nr_hugepages=get_hugepage_number(),
+            nr_hugepages=nr_hugepages,
             mount=False,
             set_shmmax=True,
         )
+        if is_hugepage_plan(hugepage_config):
+            # NOTE: vm.nr_hugepages spreads the default size pages over the
+            #       nodes, the pools of each node are then resized as planned
+            plan = plan_hugepages(hugepage_config)
+            apply_hugepage_plan(plan)
+            persist_hugepage_plan(plan)
         # Remove hugepages entry if present due to Bug #1518771
         Fstab.remove_by_mountpoint(mnt_point)
         if subprocess.call(['mountpoint', mnt_point]):
@@ -949,6 +1088,32 @@ def install_hugepages():
         subprocess.check_call(['update-rc.d', 'qemu-hugefsdir', 'defaults'])
 
 
+def persist_hugepage_plan(plan):
+    """Allocate the huge pages of a plan again when the host boots.
+
+    The node pools are only resized at runtime, a oneshot unit resizes them
+    again at boot, before libvirt and nova-compute start.
+
+    :param plan: allocations from plan_hugepages, none to remove the unit
+    :type plan: List[Allocation]
+    """
+    if not plan:
+        if os.path.exists(HUGEPAGES_SERVICE_PATH):
+            subprocess.call(['systemctl', 'disable', HUGEPAGES_SERVICE])
+            os.remove(HUGEPAGES_SERVICE_PATH)
+            subprocess.check_call(['systemctl', 'daemon-reload'])
+        return
+    render(
+        HUGEPAGES_SERVICE,
+        HUGEPAGES_SERVICE_PATH,
+        {'pools': [(pool_path(a.node, a.size_kb, 'nr_hugepages'), a.count)
+                   for a in plan]},
+        perms=0o644,
+    )
+    subprocess.check_call(['systemctl', 'daemon-reload'])
+    subprocess.check_call(['systemctl', 'enable', HUGEPAGES_SERVICE])
+
+
 def get_optional_relations():
     """Return a dictionary of optional relations.
 
@@ -1011,6 +1176,19 @@ def check_optional_config_and_relations(configs):
     if len(relation_ids('storage-backend')) > 1:
         return 'blocked', "Multiple storage backends are not supported"
 
+    try:
+        check_cpu_sets(*cpu_sets(config('cpu-partitioning'),
+                                 config('cpu-dedicated-set'),
+                                 config('cpu-shared-set')))
+    except (IOError, OSError, ValueError) as e:
+        return 'blocked', 'Invalid CPU partitioning: {}'.format(e)
+
+    if is_hugepage_plan(config('hugepages')):
+        try:
+            plan_hugepages(config('hugepages'))
+        except ValueError as e:
+            return 'blocked', 'Invalid hugepages plan: {}'.format(e)
+
     # return 'unknown' as the lowest priority to not clobber an existing
     # status.
     return "unknown", ""
@@ -1097,7 +1275,8 @@ def _pause_resume_helper(f, configs):
 
     f(assess_status_func(configs, services_to_pause_or_resume()),
       services=services_to_pause_or_resume(),
-      ports=None)
+      ports=None,
+      dependencies=service_dependencies())
 
 
 def determine_block_device():
@@ -35,3 +35,8 @@ patch(
     return_value={
         'DISTRIB_CODENAME': 'jammy'
     }).start()
+
+# Nor should they talk to the systemd of the host over D-Bus; use systemctl,
+# which is mocked where needed, unless a test provides a LocalSystemd.
+import charmhelpers.core.systemd  # noqa: E402
+charmhelpers.core.systemd.set_client(False)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit kv store benchmark, preloaded table against per key queries.
+
+A database populated like the one of a long running unit (config, relation
+and hook profile data) is opened and accessed the way a hook does: repeated
+single key reads, prefix reads and a few writes in a hook transaction.  The
+wall time, including opening the database, is recorded for storage serving
+reads with one SELECT per key and for storage preloading the table.
+
+Usage:
+    python3 unit_tests/benchmark_unitdata.py [--runs N] [--keys N] [--json]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+CHARM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(CHARM_DIR, 'hooks'))
+
+from charmhelpers.core import unitdata  # noqa: E402
+
+PREFIXES = ('config.', 'rel.', 'unit.', 'reactive.')
+# single key reads and prefix reads per simulated hook
+READS = 500
+RANGE_READS = 20
+WRITES = 20
+
+
+def populate(path, keys):
+    """Create a kv database with keys spread over a few prefixes.
+
+    :param path: database file
+    :type path: str
+    :param keys: number of keys
+    :type keys: int
+    """
+    storage = unitdata.Storage(path)
+    for i in range(keys):
+        storage.set('{}{}'.format(PREFIXES[i % len(PREFIXES)], i),
+                    {'value': i, 'data': 'x' * 64})
+    storage.flush()
+    storage.close()
+
+
+def hook(path, keys, preload):
+    """Open the database and access it the way a hook does.
+
+    :param path: database file
+    :type path: str
+    :param keys: number of keys in the database
+    :type keys: int
+    :param preload: whether to preload the kv table
+    :type preload: bool
+    :returns: wall time in seconds
+    :rtype: float
+    """
+    start = time.monotonic()
+    storage = unitdata.Storage(path, preload=preload)
+    with storage.hook_transaction():
+        for i in range(READS):
+            storage.get('{}{}'.format(PREFIXES[i % len(PREFIXES)],
+                                      (i * 7) % keys))
+        for i in range(RANGE_READS):
+            storage.getrange(PREFIXES[i % len(PREFIXES)])
+        for i in range(WRITES):
+            storage.set('unit.{}'.format(i), i)
+        storage.flush()
+    storage.close()
+    return time.monotonic() - start
+
+
+def benchmark(keys, runs):
+    """Time simulated hooks with and without preloading.
+
+    :param keys: number of keys in the database
+    :type keys: int
+    :param runs: number of simulated hooks per mode
+    :type runs: int
+    :returns: per mode median wall time (ms)
+    :rtype: Dict[str, float]
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'unit-state.db')
+        populate(path, keys)
+        results = {}
+        for mode, preload in (('select', False), ('preload', True)):
+            samples = [hook(path, keys, preload) for _ in range(runs)]
+            results[mode] = round(statistics.median(samples) * 1000, 2)
+        return results
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=20,
+                        help='simulated hooks per mode (default: 20)')
+    parser.add_argument('--keys', type=int, default=2000,
+                        help='keys in the database (default: 2000)')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args()
+
+    results = benchmark(args.keys, args.runs)
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    print('{:<10} {:>10}'.format('mode', 'hook ms'))
+    for mode in ('select', 'preload'):
+        print('{:<10} {:>10}'.format(mode, results[mode]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of complete update-status hook runs.
+
+The update-status hook is run in a fresh interpreter, as juju does, against
+stand-in juju tools serving the config.yaml defaults and related amqp,
+image-service and cloud-compute units.  Each run is timed, and the juju tool
+invocations counted, with and without the complete contexts recorded by the
+previous hook, see LazyConfigRenderer.
+
+Everything else, e.g. the installed packages, the release and the services,
+is that of the host running the benchmark, which must be an Ubuntu host.
+
+Usage:
+    python3 unit_tests/benchmark_update_status.py [--runs N] [--json]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+CHARM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOOK = os.path.join(CHARM_DIR, 'hooks', 'update-status')
+COMPLETE_CONTEXTS_KEY = 'complete-contexts'
+
+TOOLS = ('config-get', 'relation-ids', 'relation-list', 'relation-get',
+         'relation-set', 'juju-log', 'status-set', 'status-get',
+         'application-version-set', 'is-leader', 'unit-get', 'network-get',
+         'storage-list', 'leader-get', 'open-port', 'opened-ports')
+
+RELATIONS = {
+    'amqp': ('amqp:1', 'rabbitmq-server/0', {
+        'private-address': '10.0.0.10', 'password': 'secret'}),
+    'image-service': ('image-service:2', 'glance/0', {
+        'private-address': '10.0.0.11',
+        'glance-api-server': 'http://10.0.0.11:9292'}),
+    'cloud-compute': ('cloud-compute:3', 'nova-cloud-controller/0', {
+        'private-address': '10.0.0.12', 'region': 'RegionOne'}),
+}
+
+TOOL = """#!{python}
+import json, os, sys
+name = os.path.basename(sys.argv[0])
+with open(os.path.join(os.path.dirname(sys.argv[0]), 'calls'), 'a') as f:
+    f.write(name + '\\n')
+with open(os.path.join(os.path.dirname(sys.argv[0]), 'state.json')) as f:
+    state = json.load(f)
+args = [a for a in sys.argv[1:] if not a.startswith('--format')]
+out = None
+if name == 'config-get':
+    out = state['config'] if '--all' in args or not args else \\
+        state['config'].get(args[0])
+elif name == 'relation-ids':
+    out = [r[0] for n, r in state['relations'].items() if n == args[0]]
+elif name in ('relation-list', 'relation-get'):
+    rid = args[args.index('-r') + 1] if '-r' in args else None
+    relation = [r for r in state['relations'].values() if r[0] == rid]
+    if name == 'relation-list':
+        out = [r[1] for r in relation]
+    else:
+        data = relation[0][2] if relation and relation[0][1] == args[-1] \\
+            else {{}}
+        out = data if args[-2] == '-' else data.get(args[-2])
+elif name == 'unit-get':
+    out = '10.0.0.2'
+elif name == 'is-leader':
+    out = True
+elif name == 'status-get':
+    out = {{'status': 'active', 'message': ''}}
+if out is not None:
+    print(json.dumps(out))
+"""
+
+
+def setup(root):
+    """Charm dir, tools and unit state of a benchmark in root.
+
+    :returns: environment of the hook
+    :rtype: Dict[str, str]
+    """
+    charm = os.path.join(root, 'charm')
+    os.mkdir(charm)
+    for name in ('hooks', 'templates', 'files', 'config.yaml',
+                 'metadata.yaml', 'actions.yaml'):
+        os.symlink(os.path.join(CHARM_DIR, name), os.path.join(charm, name))
+    tools = os.path.join(root, 'tools')
+    os.mkdir(tools)
+    with open(os.path.join(CHARM_DIR, 'config.yaml')) as f:
+        options = yaml.safe_load(f)['options']
+    with open(os.path.join(tools, 'state.json'), 'w') as f:
+        json.dump({'config': {k: v.get('default')
+                              for k, v in options.items()},
+                   'relations': RELATIONS}, f)
+    script = os.path.join(tools, 'tool')
+    with open(script, 'w') as f:
+        f.write(TOOL.format(python=sys.executable))
+    os.chmod(script, 0o755)
+    for name in TOOLS:
+        os.symlink(script, os.path.join(tools, name))
+    return dict(os.environ,
+                PATH='{}:{}'.format(tools, os.environ.get('PATH', '')),
+                CHARM_DIR=charm,
+                JUJU_CHARM_DIR=charm,
+                JUJU_UNIT_NAME='nova-compute/0',
+                JUJU_HOOK_NAME='update-status',
+                UNIT_STATE_DB=os.path.join(root, 'unit-state.db'))
+
+
+def run(env, recorded):
+    """Run update-status once.
+
+    :param recorded: whether to keep the complete contexts recorded by the
+                     previous run
+    :type recorded: bool
+    :returns: wall time and juju tool invocations
+    :rtype: Tuple[float, int]
+    :raises: RuntimeError if the hook fails
+    """
+    if not recorded and os.path.exists(env['UNIT_STATE_DB']):
+        with sqlite3.connect(env['UNIT_STATE_DB']) as db:
+            db.execute('DELETE FROM kv WHERE key = ?',
+                       (COMPLETE_CONTEXTS_KEY,))
+    calls = os.path.join(env['PATH'].split(':')[0], 'calls')
+    if os.path.exists(calls):
+        os.remove(calls)
+    start = time.monotonic()
+    proc = subprocess.Popen([HOOK], cwd=env['CHARM_DIR'], env=env,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE)
+    _, stderr = proc.communicate()
+    elapsed = time.monotonic() - start
+    if proc.returncode:
+        raise RuntimeError('update-status failed:\n{}'.format(
+            stderr.decode('UTF-8', 'replace')))
+    with open(calls) as f:
+        return elapsed, len(f.read().split())
+
+
+def benchmark(runs):
+    """Median wall time and tool invocations of update-status runs.
+
+    :rtype: Dict[str, Dict[str, Union[float, int]]]
+    """
+    root = tempfile.mkdtemp()
+    try:
+        env = setup(root)
+        # the first run records the complete contexts
+        run(env, False)
+        results = {}
+        for mode, recorded in (('evaluated', False), ('recorded', True)):
+            samples = [run(env, recorded) for _ in range(runs)]
+            results[mode] = {
+                'time_ms': round(statistics.median(
+                    s[0] for s in samples) * 1000, 1),
+                'tool_calls': max(s[1] for s in samples),
+            }
+        return results
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5,
+                        help='runs per mode (default: 5)')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args()
+
+    results = benchmark(args.runs)
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    print('{:<20} {:>10} {:>12}'.format('complete contexts', 'ms',
+                                        'tool calls'))
+    for mode, result in sorted(results.items()):
+        print('{:<20} {:>10} {:>12}'.format(mode, result['time_ms'],
+                                            result['tool_calls']))
+
+
+if __name__ == '__main__':
+    main()
@@ -12,34 +12,105 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from unittest import mock
+import json
 import os
 import shutil
 from tempfile import mkdtemp
+from unittest import mock
+
 from test_utils import CharmTestCase
 
 import hugepagereport as actions
 
 tmpdir = 'hugepagestats-test.'
 
-test_stats = {'free_hugepages': '224',
-              'nr_hugepages': '12'}
+MEMINFO = """MemTotal:       67108864 kB
+MemFree:        30000000 kB
+HugePages_Total:    1024
+HugePages_Free:      512
+HugePages_Rsvd:       16
+HugePages_Surp:        0
+Hugepagesize:       2048 kB
+Hugetlb:        35651584 kB
+"""
+
+CMDLINE = ('BOOT_IMAGE=/vmlinuz root=/dev/sda1 default_hugepagesz=2M '
+           'hugepagesz=1G hugepages=0:16,1:16')
+
+
+def write_pool(path, **attributes):
+    os.makedirs(path)
+    for name, value in attributes.items():
+        with open(os.path.join(path, name), 'w') as f:
+            f.write('{}\n'.format(value))
 
 
 class MainTestCase(CharmTestCase):
 
     def setUp(self):
+        super(MainTestCase, self).setUp(actions.hookenv, ['config', 'log'])
         self.sysfs = sysfs = mkdtemp(prefix=tmpdir)
         self.addCleanup(shutil.rmtree, sysfs)
-        p = mock.patch('hugepagereport.SYSFS', new=sysfs)
-        p.start()
-        self.addCleanup(p.stop)
-        hpath = "{}/devices/system/node/node0/hugepages/hugepages-1048576kB"
-        self.hugepagestats = hpath.format(sysfs)
-        os.makedirs(self.hugepagestats)
-        for fn, val in test_stats.items():
-            with open(os.path.join(self.hugepagestats, fn), 'w') as f:
-                f.write(val)
+        for target, value in (('nova_compute_hugepages.SYSFS', sysfs),
+                              ('hugepagereport.MEMINFO',
+                               os.path.join(sysfs, 'meminfo')),
+                              ('hugepagereport.KERNELCMD',
+                               os.path.join(sysfs, 'cmdline'))):
+            p = mock.patch(target, new=value)
+            p.start()
+            self.addCleanup(p.stop)
+        with open(os.path.join(sysfs, 'meminfo'), 'w') as f:
+            f.write(MEMINFO)
+        with open(os.path.join(sysfs, 'cmdline'), 'w') as f:
+            f.write(CMDLINE)
+        pools = '{}/kernel/mm/hugepages/hugepages-{}kB'
+        write_pool(pools.format(sysfs, 2048), nr_hugepages=1024,
+                   free_hugepages=512, resv_hugepages=16,
+                   surplus_hugepages=0)
+        write_pool(pools.format(sysfs, 1048576), nr_hugepages=32,
+                   free_hugepages=8, resv_hugepages=0, surplus_hugepages=0)
+        hpath = '{}/devices/system/node/node{}/hugepages/hugepages-{}kB'
+        for node, pages_1g in ((0, 16), (1, 16)):
+            write_pool(hpath.format(sysfs, node, 2048), nr_hugepages=512,
+                       free_hugepages=256, surplus_hugepages=0)
+            write_pool(hpath.format(sysfs, node, 1048576),
+                       nr_hugepages=pages_1g, free_hugepages=4,
+                       surplus_hugepages=0)
+        self.config.return_value = None
+
+    def test_parse_cmdline(self):
+        self.assertEqual(
+            actions.parse_cmdline(CMDLINE),
+            (2048, {1048576: {'total': 32, 'nodes': {0: 16, 1: 16}}}))
+        self.assertEqual(
+            actions.parse_cmdline('default_hugepagesz=1G hugepages=4 '
+                                  'hugepagesz=2M hugepages=64'),
+            (1048576, {1048576: {'total': 4, 'nodes': {}},
+                       2048: {'total': 64, 'nodes': {}}}))
+        self.assertEqual(
+            actions.parse_cmdline('hugepages=64 hugepagesz=1G hugepages=x'),
+            (None, {2048: {'total': 64, 'nodes': {}}}))
+
+    def test_planned_hugepages(self):
+        meminfo = {'MemTotal': 67108864}
+        self.assertEqual(actions.planned_hugepages('1024', meminfo),
+                         {2048: {'total': 1024, 'nodes': {}}})
+        self.assertEqual(actions.planned_hugepages('10 %', meminfo),
+                         {2048: {'total': 3276, 'nodes': {}}})
+        self.assertEqual(actions.planned_hugepages(None, meminfo), {})
+        for value in ('abc', 'abc%', '10 pages'):
+            self.log.reset_mock()
+            self.assertEqual(actions.planned_hugepages(value, meminfo), {})
+            self.log.assert_called_once_with(
+                'Invalid hugepages option: {}'.format(value),
+                level=actions.hookenv.WARNING)
+
+    @mock.patch('charmhelpers.core.hookenv.action_set')
+    def test_hugepagesreport_invalid_option(self, mock_action_set):
+        self.config.return_value = 'abc'
+        actions.hugepages_report()
+        report = json.loads(mock_action_set.call_args[0][0]['report'])
+        self.assertEqual(report['sizes']['2048kB']['expected'], None)
 
     @mock.patch('charmhelpers.core.hookenv.action_get')
     @mock.patch('charmhelpers.core.hookenv.action_set')
@@ -50,5 +121,45 @@ class MainTestCase(CharmTestCase):
         self.assertEqual(len(dummy_action), 1)
         d = dummy_action[0]
         self.assertIsInstance(d, dict)
-        self.assertIn('hugepagestats', d)
-        self.assertNotEqual(d['hugepagestats'].find('/free_hugepages'), -1)
+        self.assertEqual(d['kernelcmd'], CMDLINE)
+        report = json.loads(d['report'])
+        self.assertEqual(report['sizes']['1048576kB'], {
+            'total': 32, 'free': 8, 'reserved': 0, 'surplus': 0,
+            'used': 24, 'used_percent': 75.0, 'expected': 32, 'gap': 0})
+        self.assertEqual(report['sizes']['2048kB']['expected'], None)
+        self.assertEqual(report['nodes']['0']['1048576kB'], {
+            'total': 16, 'free': 4, 'surplus': 0, 'used': 12,
+            'used_percent': 75.0, 'expected': 16, 'gap': 0})
+        self.assertEqual(report['meminfo']['total'], 1024)
+        self.assertTrue(report['consistent'])
+        self.assertEqual(report['mismatches'], [])
+
+    @mock.patch('charmhelpers.core.hookenv.action_set')
+    def test_hugepagesreport_gap(self, mock_action_set):
+        self.config.return_value = '1G:20@node0,16@node1;2M:1024'
+        with open(os.path.join(self.sysfs, 'meminfo'), 'w') as f:
+            f.write(MEMINFO.replace('HugePages_Free:      512',
+                                    'HugePages_Free:      500'))
+        with mock.patch('nova_compute_hugepages.numa_nodes',
+                        return_value={0: 33554432, 1: 33554432}):
+            actions.hugepages_report()
+        report = json.loads(mock_action_set.call_args[0][0]['report'])
+        self.assertEqual(report['sizes']['1048576kB']['expected'], 36)
+        self.assertEqual(report['sizes']['1048576kB']['gap'], 4)
+        self.assertEqual(report['nodes']['0']['1048576kB']['gap'], 4)
+        self.assertEqual(report['nodes']['1']['1048576kB']['gap'], 0)
+        self.assertEqual(report['nodes']['0']['2048kB']['expected'], 512)
+        self.assertFalse(report['consistent'])
+        self.assertEqual(
+            report['mismatches'],
+            ['2048kB free pages: 512 in sysfs, 500 in {}'.format(
+                actions.MEMINFO)])
+
+    @mock.patch('charmhelpers.core.hookenv.action_fail')
+    @mock.patch('charmhelpers.core.hookenv.action_set')
+    def test_hugepagesreport_failure(self, mock_action_set,
+                                     mock_action_fail):
+        os.remove(os.path.join(self.sysfs, 'cmdline'))
+        actions.hugepages_report()
+        self.assertFalse(mock_action_set.called)
+        self.assertTrue(mock_action_fail.called)
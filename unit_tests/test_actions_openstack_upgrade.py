@@ -28,7 +28,8 @@ from test_utils import (
 openstack_upgrade = None  # placeholder for module loaded in setUpModule
 TO_PATCH = [
     'config_changed',
-    'do_openstack_upgrade'
+    'do_openstack_upgrade',
+    'request_full_config_changed',
 ]
 
 
@@ -87,6 +88,7 @@ class TestNovaComputeUpgradeActions(CharmTestCase):
         openstack_upgrade.openstack_upgrade()
 
         self.assertTrue(self.do_openstack_upgrade.called)
+        self.request_full_config_changed.assert_called_once_with()
         self.assertTrue(self.config_changed.called)
         neutron_plugin_joined.assert_called_once_with("1", remote_restart=True)
         nova_ceilometer_joined.assert_called_once_with(
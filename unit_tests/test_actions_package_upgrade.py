@@ -26,7 +26,8 @@ from test_utils import (
 package_upgrade = None  # placeholder for module loaded in setUpModule
 TO_PATCH = [
     'config_changed',
-    'do_openstack_upgrade'
+    'do_openstack_upgrade',
+    'request_full_config_changed',
 ]
 
 
@@ -0,0 +1,55 @@
+# Copyright 2024 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import json
+
+from unittest import mock
+
+from test_utils import (
+    CharmTestCase,
+    TestKV,
+)
+
+import reserved_memory_report as actions
+
+
+class ReservedMemoryReportTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(ReservedMemoryReportTestCase, self).setUp(
+            actions, ['kv', 'memory'])
+        self.test_kv = TestKV()
+        self.kv.return_value = self.test_kv
+        self.memory.RESERVED_HOST_MEMORY_KEY = 'reserved-host-memory-auto'
+        self.memory.memory_breakdown.return_value = collections.OrderedDict(
+            [('base', 512), ('services', 300)])
+        self.memory.recommended_reserved_host_memory.return_value = 1024
+
+    @mock.patch('charmhelpers.core.hookenv.config')
+    @mock.patch('charmhelpers.core.hookenv.action_set')
+    def test_reserved_memory_report(self, action_set, config):
+        config.side_effect = self.test_config.get
+        actions.reserved_memory_report()
+        action_set.assert_called_once_with({
+            'breakdown': json.dumps({'base': 512, 'services': 300}),
+            'recommended': 1024,
+            'configured': 512,
+        })
+
+        action_set.reset_mock()
+        self.test_config.set('reserved-host-memory-auto', True)
+        self.test_kv.set('reserved-host-memory-auto', 768)
+        actions.reserved_memory_report()
+        self.assertEqual(action_set.call_args[0][0]['configured'], 768)
@@ -0,0 +1,195 @@
+# Copyright 2024 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from charmhelpers.fetch import ubuntu, ubuntu_apt_pkg
+
+DPKG_STATUS = """Package: nova-compute
+Status: install ok installed
+Architecture: all
+Version: 3:25.0.0-0ubuntu1
+Description: OpenStack Compute - compute node
+ The compute node.
+
+Package: libvirt0
+Status: hold ok installed
+Architecture: amd64
+Version: 8.0.0-1ubuntu7
+Description: library for interfacing with different virtualization systems
+
+Package: libvirt0
+Status: install ok installed
+Architecture: i386
+Version: 8.0.0-1ubuntu7
+Description: library for interfacing with different virtualization systems
+
+Package: qemu-kvm
+Status: deinstall ok config-files
+Architecture: amd64
+Version: 1:6.2+dfsg-2ubuntu6
+Description: QEMU Full virtualization
+"""
+
+
+class FilterInstalledPackagesTests(unittest.TestCase):
+
+    def setUp(self):
+        ubuntu.reset_installed_packages_cache()
+        self.addCleanup(ubuntu.reset_installed_packages_cache)
+        self.cache = MagicMock()
+        self.cache.dpkg_list.side_effect = lambda packages: {
+            p: {} for p in packages if p in ('nova-compute', 'libvirt0')}
+        self.cache._apt_cache_show.side_effect = lambda packages: {
+            p: {} for p in packages if p != 'no-such-package'}
+        for target, kwargs in (('apt_cache', {'return_value': self.cache}),
+                               ('log', {})):
+            p = patch.object(ubuntu, target, **kwargs)
+            setattr(self, target, p.start())
+            self.addCleanup(p.stop)
+
+    def test_single_query(self):
+        self.assertEqual(
+            ubuntu.filter_installed_packages(
+                ['nova-compute', 'qemu-kvm', 'libvirt0', 'qemu-kvm']),
+            ['qemu-kvm', 'qemu-kvm'])
+        self.cache.dpkg_list.assert_called_once_with(
+            ['nova-compute', 'qemu-kvm', 'libvirt0'])
+        self.cache._apt_cache_show.assert_called_once_with(['qemu-kvm'])
+        self.assertFalse(self.log.called)
+
+    def test_cached_for_the_hook(self):
+        ubuntu.filter_installed_packages(['nova-compute', 'qemu-kvm'])
+        self.assertEqual(
+            ubuntu.filter_installed_packages(['qemu-kvm', 'libvirt0']),
+            ['qemu-kvm'])
+        self.assertEqual(self.cache.dpkg_list.call_args_list[1][0][0],
+                         ['libvirt0'])
+        ubuntu.filter_installed_packages(['nova-compute', 'libvirt0'])
+        self.assertEqual(self.cache.dpkg_list.call_count, 2)
+
+    def test_no_installation_candidate(self):
+        self.assertEqual(
+            ubuntu.filter_installed_packages(['no-such-package']),
+            ['no-such-package'])
+        self.log.assert_called_once_with(
+            'Package no-such-package has no installation candidate.',
+            level='WARNING')
+
+    @patch.object(ubuntu.subprocess, 'call')
+    def test_reset_by_apt_get(self, _call):
+        ubuntu.filter_installed_packages(['qemu-kvm'])
+        self.cache.dpkg_list.side_effect = lambda packages: {
+            p: {} for p in packages}
+        ubuntu._run_apt_command(['apt-get', 'install', 'qemu-kvm'])
+        self.assertEqual(ubuntu.filter_installed_packages(['qemu-kvm']), [])
+        self.assertEqual(self.cache.dpkg_list.call_count, 2)
+
+    @patch.object(ubuntu.subprocess, 'call')
+    def test_reset_after_apt_get(self, _call):
+        # a lookup made while apt-get runs is not kept
+        _call.side_effect = lambda *args, **kwargs: (
+            ubuntu.filter_installed_packages(['qemu-kvm']))
+        ubuntu._run_apt_command(['apt-get', 'install', 'qemu-kvm'])
+        ubuntu.filter_installed_packages(['qemu-kvm'])
+        self.assertEqual(self.cache.dpkg_list.call_count, 2)
+
+
+class DpkgStatusIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.status_file = os.path.join(self.tmp, 'status')
+        self.index_file = os.path.join(self.tmp, 'index.json')
+        with open(self.status_file, 'w') as f:
+            f.write(DPKG_STATUS)
+
+    def index(self):
+        return ubuntu_apt_pkg.DpkgStatusIndex(self.status_file,
+                                              self.index_file)
+
+    def test_packages(self):
+        self.assertEqual(self.index().packages(), {
+            'nova-compute': [['all', '3:25.0.0-0ubuntu1',
+                              'OpenStack Compute - compute node']],
+            'libvirt0': [
+                ['amd64', '8.0.0-1ubuntu7', 'library for interfacing with '
+                 'different virtualization systems'],
+                ['i386', '8.0.0-1ubuntu7', 'library for interfacing with '
+                 'different virtualization systems']],
+        })
+
+    def test_dpkg_list(self):
+        index = self.index()
+        self.assertEqual(index.dpkg_list(['nova-compute', 'qemu-kvm']), {
+            'nova-compute': {
+                'name': 'nova-compute',
+                'version': '3:25.0.0-0ubuntu1',
+                'architecture': 'all',
+                'description': 'OpenStack Compute - compute node'}})
+        self.assertEqual(
+            index.dpkg_list(['libvirt0:amd64'])['libvirt0']['architecture'],
+            'amd64')
+        self.assertEqual(sorted(index.dpkg_list(['*t*'])),
+                         ['libvirt0', 'nova-compute'])
+
+    def test_persisted(self):
+        packages = self.index().packages()
+        with open(self.index_file) as f:
+            self.assertEqual(json.load(f)['packages'], packages)
+        index = self.index()
+        with patch.object(index, '_parse') as _parse:
+            self.assertEqual(index.packages(), packages)
+        self.assertFalse(_parse.called)
+
+    def test_refreshed_when_status_changes(self):
+        index = self.index()
+        index.packages()
+        with open(self.status_file, 'a') as f:
+            f.write('\nPackage: qemu-system-x86\n'
+                    'Status: install ok installed\n'
+                    'Architecture: amd64\n'
+                    'Version: 1:6.2+dfsg-2ubuntu6\n')
+        self.assertIn('qemu-system-x86', index.packages())
+        self.assertIn('qemu-system-x86', self.index().packages())
+
+    def test_unreadable_index_file(self):
+        with open(self.index_file, 'w') as f:
+            f.write('not json')
+        self.assertIn('nova-compute', self.index().packages())
+
+    @patch.object(ubuntu_apt_pkg.Cache, '_apt_cache_show')
+    def test_cache_lookup(self, _apt_cache_show):
+        _apt_cache_show.return_value = {
+            'nova-compute': {'package': 'nova-compute',
+                             'section': 'universe/net'}}
+        cache = ubuntu_apt_pkg.Cache(dpkg_status_index=self.index())
+        pkg = cache['nova-compute']
+        self.assertEqual(pkg.current_ver.ver_str, '3:25.0.0-0ubuntu1')
+        self.assertFalse(_apt_cache_show.called)
+        self.assertEqual(pkg['section'], 'universe/net')
+        self.assertEqual(pkg.section, 'universe/net')
+        _apt_cache_show.assert_called_once_with(['nova-compute'])
+        with self.assertRaises(KeyError):
+            pkg['missing']
+        self.assertEqual(_apt_cache_show.call_count, 1)
+        self.assertEqual(
+            sorted(pkg),
+            ['architecture', 'current_ver', 'name', 'section'])
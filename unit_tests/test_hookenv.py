@@ -0,0 +1,307 @@
+# Copyright 2024 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from charmhelpers.core import hookenv
+
+
+class RelationSnapshotTests(unittest.TestCase):
+
+    def setUp(self):
+        hookenv.cache.clear()
+        self.addCleanup(hookenv.cache.clear)
+        self.settings = {
+            ('cloud-compute:1', 'nova-cloud-controller/0'): {
+                'auth_host': '10.0.0.1', 'region': 'RegionOne'},
+            ('cloud-compute:1', 'nova-compute/0'): {'hostname': 'host1'},
+            ('cloud-compute:1', 'nova-compute'): {'app-key': 'a'},
+        }
+        self.gets = []
+        self.sets = []
+        for target, value in (('local_unit', 'nova-compute/0'),
+                              ('application_name', 'nova-compute')):
+            p = patch.object(hookenv, target, return_value=value)
+            p.start()
+            self.addCleanup(p.stop)
+        p = patch.object(hookenv, '_check_output',
+                         side_effect=self._check_output)
+        p.start()
+        self.addCleanup(p.stop)
+        p = patch.object(hookenv, '_check_call', side_effect=self.sets.append)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def _check_output(self, cmd, **kwargs):
+        if cmd == ['relation-set', '--help']:
+            return 'usage: relation-set [--file]'
+        self.gets.append(cmd)
+        key = (cmd[cmd.index('-r') + 1], cmd[-1])
+        if key not in self.settings:
+            raise subprocess.CalledProcessError(2, cmd)
+        return json.dumps(self.settings[key]).encode('UTF-8')
+
+    def test_relation_get_single_call(self):
+        for attribute in ('auth_host', 'region', 'missing'):
+            hookenv.relation_get(attribute, unit='nova-cloud-controller/0',
+                                 rid='cloud-compute:1')
+        self.assertEqual(
+            self.gets,
+            [['relation-get', '--format=json', '-r', 'cloud-compute:1', '-',
+              'nova-cloud-controller/0']])
+        self.assertEqual(
+            hookenv.relation_get('auth_host', unit='nova-cloud-controller/0',
+                                 rid='cloud-compute:1'),
+            '10.0.0.1')
+
+    def test_relation_get_all_is_a_copy(self):
+        settings = hookenv.relation_get(unit='nova-cloud-controller/0',
+                                        rid='cloud-compute:1')
+        settings['region'] = 'changed'
+        self.assertEqual(
+            hookenv.relation_get('region', unit='nova-cloud-controller/0',
+                                 rid='cloud-compute:1'),
+            'RegionOne')
+
+    def test_relation_get_missing_unit(self):
+        self.assertIsNone(hookenv.relation_get(
+            'auth_host', unit='nova-cloud-controller/1',
+            rid='cloud-compute:1'))
+
+    def test_relation_get_app(self):
+        self.assertEqual(
+            hookenv.relation_get('app-key', app='nova-compute',
+                                 rid='cloud-compute:1'),
+            'a')
+        self.assertIn('--app', self.gets[0])
+        with self.assertRaises(ValueError):
+            hookenv.relation_snapshot(unit='nova-compute/0',
+                                      app='nova-compute')
+
+    def test_relation_set_flushes_local_unit(self):
+        hookenv.relation_get('hostname', unit='nova-compute/0',
+                             rid='cloud-compute:1')
+        hookenv.relation_get('auth_host', unit='nova-cloud-controller/0',
+                             rid='cloud-compute:1')
+        self.settings[('cloud-compute:1', 'nova-compute/0')] = {
+            'hostname': 'host2'}
+        hookenv.relation_set(relation_id='cloud-compute:1', hostname='host2')
+        self.assertEqual(
+            hookenv.relation_get('hostname', unit='nova-compute/0',
+                                 rid='cloud-compute:1'),
+            'host2')
+        hookenv.relation_get('auth_host', unit='nova-cloud-controller/0',
+                             rid='cloud-compute:1')
+        # the remote unit snapshot is kept
+        self.assertEqual([cmd[-1] for cmd in self.gets],
+                         ['nova-compute/0', 'nova-cloud-controller/0',
+                          'nova-compute/0'])
+
+    def test_relation_set_app_flushes_application(self):
+        hookenv.relation_get('app-key', app='nova-compute',
+                             rid='cloud-compute:1')
+        self.settings[('cloud-compute:1', 'nova-compute')] = {'app-key': 'b'}
+        hookenv.relation_set(relation_id='cloud-compute:1', app=True,
+                             **{'app-key': 'b'})
+        self.assertEqual(
+            hookenv.relation_get('app-key', app='nova-compute',
+                                 rid='cloud-compute:1'),
+            'b')
+        self.assertEqual(len(self.gets), 2)
+
+
+class PrefetchRelationsTests(unittest.TestCase):
+
+    def setUp(self):
+        hookenv.cache.clear()
+        self.addCleanup(hookenv.cache.clear)
+        p = patch.object(hookenv, '_cache_config', None)
+        p.start()
+        self.addCleanup(p.stop)
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        p = patch.object(hookenv, 'charm_dir', return_value=tmp)
+        p.start()
+        self.addCleanup(p.stop)
+        self.outputs = {
+            ('relation-ids', 'amqp'): ['amqp:1'],
+            ('relation-ids', 'ceph'): [],
+            ('config-get', '--all'): {'debug': True},
+            ('relation-list', 'amqp:1'): ['rabbitmq/0', 'rabbitmq/1'],
+            ('relation-get', 'rabbitmq/0'): {'password': 'x'},
+        }
+        self.batches = []
+        p = patch.object(hookenv, '_check_outputs',
+                         side_effect=self._check_outputs)
+        p.start()
+        self.addCleanup(p.stop)
+        p = patch.object(hookenv, '_check_output')
+        self.check_output = p.start()
+        self.addCleanup(p.stop)
+
+    def _check_outputs(self, cmds):
+        self.batches.append(cmds)
+        results = []
+        for cmd in cmds:
+            key = (cmd[0], cmd[-1] if cmd[-1] != '--format=json' else cmd[1])
+            if key in self.outputs:
+                results.append(
+                    (json.dumps(self.outputs[key]).encode('UTF-8'), 0))
+            elif cmd[0] == 'relation-get':
+                results.append((b'', 1))
+            else:
+                results.append((None, -1))
+        return results
+
+    def test_prefetch(self):
+        hookenv.prefetch_relations(['ceph', 'amqp', 'amqp'])
+        self.assertEqual(self.batches, [
+            [['relation-ids', '--format=json', 'amqp'],
+             ['relation-ids', '--format=json', 'ceph'],
+             ['config-get', '--all', '--format=json']],
+            [['relation-list', '--format=json', '-r', 'amqp:1']],
+            [['relation-get', '--format=json', '-r', 'amqp:1', '-',
+              'rabbitmq/0'],
+             ['relation-get', '--format=json', '-r', 'amqp:1', '-',
+              'rabbitmq/1']],
+        ])
+        self.assertEqual(hookenv.relation_ids('amqp'), ['amqp:1'])
+        self.assertEqual(hookenv.relation_ids('ceph'), [])
+        self.assertEqual(hookenv.related_units('amqp:1'),
+                         ['rabbitmq/0', 'rabbitmq/1'])
+        self.assertEqual(hookenv.relation_get('password', rid='amqp:1',
+                                              unit='rabbitmq/0'), 'x')
+        self.assertTrue(hookenv.config('debug'))
+        self.check_output.assert_not_called()
+
+    def test_prefetch_failure_left_uncached(self):
+        hookenv.prefetch_relations(['amqp'])
+        self.check_output.return_value = b'{"password": "y"}'
+        self.assertEqual(hookenv.relation_get('password', rid='amqp:1',
+                                              unit='rabbitmq/1'), 'y')
+        self.check_output.assert_called_once_with(
+            ['relation-get', '--format=json', '-r', 'amqp:1', '-',
+             'rabbitmq/1'])
+
+    def test_prefetch_skips_cached(self):
+        hookenv.prefetch_relations(['amqp'])
+        self.batches = []
+        hookenv.prefetch_relations(['amqp'])
+        self.assertEqual(self.batches, [
+            [], [], [['relation-get', '--format=json', '-r', 'amqp:1', '-',
+                      'rabbitmq/1']]])
+
+
+class CheckOutputsTests(unittest.TestCase):
+
+    def test_side_by_side(self):
+        cmds = [['sh', '-c', 'sleep 0.3; echo {}'.format(i)]
+                for i in range(3)]
+        cmds.append(['/nonexistent/tool'])
+        start = time.monotonic()
+        results = hookenv._check_outputs(cmds)
+        self.assertLess(time.monotonic() - start, 0.8)
+        self.assertEqual(results, [(b'0\n', 0), (b'1\n', 0), (b'2\n', 0),
+                                   (None, -1)])
+
+
+class LogBufferTests(unittest.TestCase):
+
+    def setUp(self):
+        p = patch.object(hookenv, '_juju_log')
+        self.juju_log = p.start()
+        self.addCleanup(p.stop)
+        p = patch.object(hookenv, '_interpreter_atexit')
+        self.atexit = p.start()
+        self.addCleanup(p.stop)
+        self.addCleanup(hookenv.disable_log_buffer)
+
+    def test_unbuffered(self):
+        hookenv.log('message', hookenv.DEBUG)
+        self.juju_log.assert_called_once_with('message', hookenv.DEBUG)
+
+    def test_batches_by_level(self):
+        hookenv.enable_log_buffer()
+        for message, level in (('one', hookenv.DEBUG), ('two', hookenv.DEBUG),
+                               ('three', None), ('four', hookenv.DEBUG)):
+            hookenv.log(message, level)
+        self.assertFalse(self.juju_log.called)
+        hookenv.flush_log_buffer()
+        self.assertEqual(self.juju_log.call_args_list,
+                         [(('one\ntwo', hookenv.DEBUG),),
+                          (('three', None),),
+                          (('four', hookenv.DEBUG),)])
+        hookenv.flush_log_buffer()
+        self.assertEqual(self.juju_log.call_count, 3)
+
+    def test_flush_level(self):
+        hookenv.enable_log_buffer(flush_level=hookenv.WARNING)
+        hookenv.log('one', hookenv.INFO)
+        hookenv.log('two', 'warning')
+        self.assertEqual(self.juju_log.call_args_list,
+                         [(('one', hookenv.INFO),), (('two', 'warning'),)])
+        hookenv.log('three', hookenv.INFO)
+        self.assertEqual(self.juju_log.call_count, 2)
+
+    def test_size_limit(self):
+        hookenv.enable_log_buffer(max_bytes=10)
+        hookenv.log('12345')
+        self.assertFalse(self.juju_log.called)
+        # 'abcd' and a newline take the buffer to its limit
+        hookenv.log('abcd')
+        self.juju_log.assert_called_once_with('12345\nabcd', None)
+
+    @patch.object(hookenv, 'SH_MAX_ARG', 8)
+    def test_batch_argument_limit(self):
+        hookenv.enable_log_buffer()
+        for message in ('abc', 'def', 'ghi'):
+            hookenv.log(message)
+        hookenv.flush_log_buffer()
+        self.assertEqual(self.juju_log.call_args_list,
+                         [(('abc\ndef', None),), (('ghi', None),)])
+
+    def test_enable_twice(self):
+        hookenv.enable_log_buffer()
+        hookenv.log('one')
+        hookenv.enable_log_buffer()
+        self.juju_log.assert_called_once_with('one', None)
+        self.atexit.register.assert_called_once_with(
+            hookenv.flush_log_buffer)
+
+    def test_disable(self):
+        hookenv.enable_log_buffer()
+        hookenv.log('one')
+        hookenv.disable_log_buffer()
+        hookenv.log('two')
+        self.assertEqual(self.juju_log.call_args_list,
+                         [(('one', None),), (('two', None),)])
+
+    def test_flushed_by_hooks_execute(self):
+        hooks = hookenv.Hooks()
+
+        @hooks.hook('update-status')
+        def update_status():
+            hookenv.log('one')
+            raise ValueError()
+
+        hookenv.enable_log_buffer()
+        with self.assertRaises(ValueError):
+            hooks.execute(['hooks/update-status'])
+        self.juju_log.assert_called_once_with('one', None)
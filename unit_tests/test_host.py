@@ -0,0 +1,341 @@
+# Copyright 2024 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from charmhelpers.core import host
+
+
+class RestartQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.actions = []
+        p = patch.object(host, 'service',
+                         side_effect=lambda action, name: self.actions.append(
+                             (action, name)))
+        p.start()
+        self.addCleanup(p.stop)
+        p = patch.object(host, 'log')
+        self.log = p.start()
+        self.addCleanup(p.stop)
+
+    def test_order_merges_lists(self):
+        queue = host.RestartQueue()
+        queue.add(['libvirtd', 'nova-compute'])
+        queue.add(['ovs-vswitchd', 'libvirtd'])
+        self.assertEqual(queue.order(),
+                         ['ovs-vswitchd', 'libvirtd', 'nova-compute'])
+
+    def test_order_disagreement(self):
+        queue = host.RestartQueue()
+        queue.add(['a', 'b'])
+        queue.add(['b', 'a'])
+        self.assertEqual(queue.order(), ['a', 'b'])
+
+    def test_run_once(self):
+        queue = host.RestartQueue()
+        queue.add(['libvirtd', 'nova-compute'])
+        queue.add(['nova-compute'], stopstart=True)
+        self.assertTrue(queue)
+        queue.run()
+        self.assertEqual(self.actions,
+                         [('restart', 'libvirtd'),
+                          ('stop', 'nova-compute'),
+                          ('start', 'nova-compute')])
+        self.assertFalse(queue)
+        queue.run()
+        self.assertEqual(len(self.actions), 3)
+
+    def test_run_options(self):
+        calls = []
+        queue = host.RestartQueue()
+        queue.add(['a', 'b'], changed_files={'a': ['/etc/a.conf']},
+                  restart_functions={'b': lambda s: calls.append(('f', s))},
+                  can_restart_now_f=lambda s, files: (
+                      calls.append(('can', s, files)) or s != 'a'),
+                  post_svc_restart_f=lambda s: calls.append(('post', s)),
+                  pre_restarts_wait_f=lambda: calls.append(('wait',)))
+        queue.add(['a'], changed_files={'a': ['/etc/a.conf', '/etc/b.conf']})
+        queue.run()
+        self.assertEqual(calls,
+                         [('wait',),
+                          ('can', 'a', ['/etc/a.conf', '/etc/b.conf']),
+                          ('can', 'b', []),
+                          ('f', 'b'),
+                          ('post', 'b')])
+        self.assertEqual(self.actions, [])
+
+    def test_run_callbacks_on_calling_thread(self):
+        # sqlite connections raise when used from another thread
+        db = host.unitdata.Storage(':memory:')
+        db.set('allowed', ['a', 'b', 'c'])
+        threads = set()
+
+        def service(action, name):
+            threads.add(threading.current_thread())
+            self.actions.append((action, name))
+
+        def can_restart_now(name, files):
+            return name in db.get('allowed')
+
+        def post_restart(name):
+            db.set('restarted', (db.get('restarted') or []) + [name])
+
+        queue = host.RestartQueue({'a': [], 'b': [], 'c': [], 'd': []})
+        queue.add(['a', 'b', 'c', 'd'], can_restart_now_f=can_restart_now,
+                  post_svc_restart_f=post_restart)
+        with patch.object(host, 'service', side_effect=service):
+            queue.run()
+        self.assertEqual(sorted(db.get('restarted')), ['a', 'b', 'c'])
+        self.assertEqual(sorted(self.actions), [('restart', 'a'),
+                                                ('restart', 'b'),
+                                                ('restart', 'c')])
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_run_restart_functions_serially(self):
+        db = host.unitdata.Storage(':memory:')
+        queue = host.RestartQueue({'a': [], 'b': []})
+        queue.add(['a', 'b'], restart_functions={
+            'a': lambda s: db.set(s, threading.current_thread().name)})
+        queue.run()
+        self.assertEqual(db.get('a'), threading.current_thread().name)
+        self.assertEqual(self.actions, [('restart', 'b')])
+
+
+class DeferredRestartsTests(RestartQueueTests):
+
+    def test_queue_restart_immediate(self):
+        host.queue_restart('nova-compute')
+        self.assertEqual(self.actions, [('restart', 'nova-compute')])
+
+    def test_nested(self):
+        with host.deferred_restarts() as queue:
+            host.queue_restart('nova-compute')
+            with host.deferred_restarts() as inner:
+                self.assertIs(inner, queue)
+                host.queue_restart('libvirtd')
+                host.queue_restart('nova-compute')
+            self.assertEqual(self.actions, [])
+        self.assertEqual(self.actions, [('restart', 'nova-compute'),
+                                        ('restart', 'libvirtd')])
+        self.assertIsNone(host._restart_queue)
+
+    def test_restart_on_change_scopes(self):
+        checksums = {'/etc/a.conf': 'a', '/etc/b.conf': 'b'}
+        with patch.object(host, 'path_hash', side_effect=checksums.get):
+            @host.restart_on_change({'/etc/a.conf': ['a']})
+            def inner():
+                checksums['/etc/a.conf'] = 'a2'
+
+            @host.restart_on_change({'/etc/b.conf': ['b', 'a']})
+            def outer():
+                inner()
+                self.assertEqual(self.actions, [])
+                checksums['/etc/b.conf'] = 'b2'
+
+            outer()
+        # a is restarted once, after b as the outer scope lists it
+        self.assertEqual(self.actions, [('restart', 'b'), ('restart', 'a')])
+
+    def test_not_run_on_error(self):
+        with self.assertRaises(ValueError):
+            with host.deferred_restarts():
+                host.queue_restart('nova-compute')
+                raise ValueError()
+        self.assertEqual(self.actions, [])
+        self.assertIsNone(host._restart_queue)
+        self.assertEqual(self.log.call_args[1]['level'], host.WARNING)
+        host.queue_restart('libvirtd')
+        self.assertEqual(self.actions, [('restart', 'libvirtd')])
+
+    def test_pending_restarts(self):
+        db = host.unitdata.Storage(':memory:')
+        with patch.object(host.unitdata, 'kv', return_value=db):
+            with self.assertRaises(ValueError):
+                with host.deferred_restarts(pending_restarts=True):
+                    host.queue_restart('libvirtd')
+                    host.queue_restart('nova-compute')
+                    with host.deferred_restarts() as queue:
+                        queue.add(['nova-compute'], stopstart=True,
+                                  changed_files={
+                                      'nova-compute': ['/etc/nova.conf']})
+                        queue.add(['ovs-vswitchd'],
+                                  can_restart_now_f=lambda s, f: True)
+                    raise ValueError()
+            self.assertEqual(self.actions, [])
+            self.assertEqual(db.get(host.PENDING_RESTARTS_KEY), [
+                {'service': 'libvirtd', 'stopstart': False,
+                 'changed_files': []},
+                {'service': 'nova-compute', 'stopstart': True,
+                 'changed_files': ['/etc/nova.conf']},
+            ])
+            # not replayed by blocks not using pending restarts
+            with host.deferred_restarts():
+                pass
+            self.assertEqual(self.actions, [])
+            with host.deferred_restarts(pending_restarts=True):
+                pass
+            self.assertEqual(self.actions, [('restart', 'libvirtd'),
+                                            ('stop', 'nova-compute'),
+                                            ('start', 'nova-compute')])
+            self.assertIsNone(db.get(host.PENDING_RESTARTS_KEY))
+
+    def test_pending_restarts_kept_in_transaction(self):
+        db = host.unitdata.Storage(':memory:')
+        with patch.object(host.unitdata, 'kv', return_value=db):
+            with self.assertRaises(ValueError):
+                with db.hook_transaction():
+                    with host.deferred_restarts(pending_restarts=True):
+                        host.queue_restart('nova-compute')
+                        raise ValueError()
+            with self.assertRaises(ValueError):
+                with db.hook_transaction():
+                    with host.deferred_restarts(pending_restarts=True):
+                        raise ValueError()
+            self.assertEqual(self.actions, [])
+            with db.hook_transaction():
+                with host.deferred_restarts(pending_restarts=True):
+                    pass
+            self.assertEqual(self.actions, [('restart', 'nova-compute')])
+            self.assertIsNone(db.get(host.PENDING_RESTARTS_KEY))
+
+    def test_queue_restart_post_restart(self):
+        calls = []
+        with host.deferred_restarts():
+            host.queue_restart('nova-compute', post_restart_f=calls.append)
+            self.assertEqual(calls, [])
+        self.assertEqual(calls, ['nova-compute'])
+
+    def test_sys_exit(self):
+        with self.assertRaises(SystemExit):
+            with host.deferred_restarts():
+                host.queue_restart('nova-compute')
+                raise SystemExit(0)
+        self.assertEqual(self.actions, [('restart', 'nova-compute')])
+        with self.assertRaises(SystemExit):
+            with host.deferred_restarts():
+                host.queue_restart('libvirtd')
+                raise SystemExit(1)
+        self.assertEqual(self.actions, [('restart', 'nova-compute')])
+
+    def test_dependencies_callable(self):
+        calls = []
+
+        def dependencies():
+            calls.append(True)
+            return {'nova-compute': ['libvirtd']}
+
+        with host.deferred_restarts(dependencies=dependencies):
+            host.queue_restart('nova-compute')
+            host.queue_restart('libvirtd')
+            self.assertEqual(calls, [])
+        self.assertEqual(calls, [True])
+        self.assertEqual(self.actions, [('restart', 'libvirtd'),
+                                        ('restart', 'nova-compute')])
+
+
+class RunServiceActionsTests(unittest.TestCase):
+
+    def setUp(self):
+        p = patch.object(host, 'log')
+        self.log = p.start()
+        self.addCleanup(p.stop)
+        self.lock = threading.Lock()
+        self.events = []
+        self.running = 0
+        self.max_running = 0
+
+    def action(self, service_name):
+        with self.lock:
+            self.events.append(('start', service_name))
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.01)
+        with self.lock:
+            self.events.append(('end', service_name))
+            self.running -= 1
+        return service_name.upper()
+
+    def assertBefore(self, first, second):
+        self.assertLess(self.events.index(('end', first)),
+                        self.events.index(('start', second)))
+
+    def test_in_order_without_dependencies(self):
+        results = host.run_service_actions(['b', 'a', 'c'], self.action)
+        self.assertEqual(list(results.items()),
+                         [('b', 'B'), ('a', 'A'), ('c', 'C')])
+        self.assertEqual([e for e in self.events if e[0] == 'start'],
+                         [('start', 'b'), ('start', 'a'), ('start', 'c')])
+        self.assertEqual(self.max_running, 1)
+
+    def test_dependencies(self):
+        dependencies = {'nova-compute': ['libvirtd'], 'libvirtd': [],
+                        'ovs-vswitchd': [], 'ceilometer': ['nova-compute']}
+        results = host.run_service_actions(
+            ['nova-compute', 'libvirtd', 'ovs-vswitchd', 'ceilometer'],
+            self.action, dependencies=dependencies)
+        self.assertEqual(set(results), set(dependencies))
+        self.assertBefore('libvirtd', 'nova-compute')
+        self.assertBefore('nova-compute', 'ceilometer')
+        self.assertEqual(self.max_running, 2)
+
+    def test_reverse(self):
+        dependencies = {'nova-compute': ['libvirtd'], 'libvirtd': [],
+                        'ceilometer': ['nova-compute']}
+        host.run_service_actions(['libvirtd', 'nova-compute', 'ceilometer'],
+                                 self.action, dependencies=dependencies,
+                                 reverse=True)
+        self.assertBefore('ceilometer', 'nova-compute')
+        self.assertBefore('nova-compute', 'libvirtd')
+
+    def test_unknown_services_keep_order(self):
+        host.run_service_actions(['a', 'unknown', 'b', 'c'], self.action,
+                                 dependencies={'a': [], 'b': [], 'c': []})
+        self.assertBefore('a', 'unknown')
+        self.assertBefore('unknown', 'b')
+        self.assertBefore('unknown', 'c')
+        host.run_service_actions(['a', 'unknown'], self.action,
+                                 dependencies={'a': []}, reverse=True)
+        self.assertBefore('a', 'unknown')
+
+    def test_cycle(self):
+        host.run_service_actions(['a', 'b', 'c'], self.action,
+                                 dependencies={'a': ['b'], 'b': ['a'],
+                                               'c': []})
+        self.assertBefore('a', 'b')
+        self.assertTrue(self.log.called)
+
+    @patch.object(host, 'SERVICE_ACTION_WORKERS', 2)
+    def test_workers(self):
+        services_list = ['s{}'.format(i) for i in range(6)]
+        results = host.run_service_actions(
+            services_list, self.action,
+            dependencies={svc: [] for svc in services_list})
+        self.assertEqual(len(results), 6)
+        self.assertEqual(self.max_running, 2)
+
+    def test_error(self):
+        def action(service_name):
+            self.action(service_name)
+            if service_name == 'libvirtd':
+                raise ValueError(service_name)
+
+        with self.assertRaises(ValueError):
+            host.run_service_actions(
+                ['libvirtd', 'nova-compute'], action,
+                dependencies={'nova-compute': ['libvirtd'], 'libvirtd': []})
+        self.assertNotIn(('start', 'nova-compute'), self.events)
@@ -14,7 +14,7 @@
 
 import platform
 
-from unittest.mock import patch
+from unittest.mock import ANY, patch
 from test_utils import CharmTestCase
 
 import nova_compute_context as context
@@ -103,6 +103,7 @@ class NovaComputeContextTests(CharmTestCase):
         self.os_release.return_value = 'kilo'
         self.relation_get.side_effect = self.test_relation.get
         self.config.side_effect = self.test_config.get
+        context.reset_config_snapshot()
         self.log.side_effect = fake_log
         self.host_uuid = 'e46e530d-18ae-4a67-9ff0-e6e2ba7c60a7'
         self.maxDiff = None
@@ -516,6 +517,25 @@ class NovaComputeContextTests(CharmTestCase):
              'reserved_huge_pages': ['node:0,size:2048,count:6',
                                      'node:1,size:1G,count:32']}, libvirt())
 
+    @patch.object(context, 'hugepage_reservations')
+    def test_libvirt_context_libvirtd_reserved_huge_pages_plan(
+            self, hugepage_reservations):
+        self.lsb_release.return_value = {'DISTRIB_CODENAME': 'yakkety'}
+        self.os_release.return_value = 'ocata'
+        self.kv.return_value = FakeUnitdata(**{'host_uuid': self.host_uuid})
+        self.test_config.set('hugepages', '1G:16@node0/2,16@node1/4')
+        self.test_config.set(
+            'reserved-huge-pages', 'node:1,size:1G,count:8')
+        hugepage_reservations.return_value = [
+            'node:0,size:1048576,count:2', 'node:1,size:1048576,count:4']
+        libvirt = context.NovaComputeLibvirtContext()
+
+        self.assertEqual(['node:1,size:1G,count:8',
+                          'node:0,size:1048576,count:2'],
+                         libvirt()['reserved_huge_pages'])
+        hugepage_reservations.assert_called_once_with(
+            '1G:16@node0/2,16@node1/4')
+
     def test_libvirt_bin_context_no_migration(self):
         self.lsb_release.return_value = {'DISTRIB_CODENAME': 'lucid'}
         self.kv.return_value = FakeUnitdata(**{'host_uuid': self.host_uuid})
@@ -1019,6 +1039,87 @@ class NovaComputeContextTests(CharmTestCase):
         libvirt = context.NovaComputeLibvirtContext()
         self.assertEqual(expected, libvirt())
 
+    @patch.object(context, 'check_cpu_sets')
+    @patch('nova_compute_cpus.plan_cpu_sets')
+    def test_cpu_partitioning(self, plan_cpu_sets, check_cpu_sets):
+        self.kv.return_value = FakeUnitdata(**{'host_uuid': self.host_uuid})
+        self.lsb_release.return_value = {'DISTRIB_CODENAME': 'lucid'}
+        self.test_config.set('cpu-partitioning', 'host:1,shared:1')
+        plan_cpu_sets.return_value = {'host': {0, 4}, 'shared': {1, 5},
+                                      'dedicated': {2, 3, 6, 7}}
+        check_cpu_sets.return_value = ['Dedicated CPUs 3 share their core']
+        ctxt = context.NovaComputeLibvirtContext()()
+        self.assertEqual(ctxt['cpu_dedicated_set'], '2-3,6-7')
+        self.assertEqual(ctxt['cpu_shared_set'], '1,5')
+        plan_cpu_sets.assert_called_once_with('host:1,shared:1', given={})
+        check_cpu_sets.assert_called_once_with('2-3,6-7', '1,5')
+        self.log.assert_any_call('Dedicated CPUs 3 share their core',
+                                 level=context.WARNING)
+
+        # explicit sets take precedence
+        self.test_config.set('cpu-dedicated-set', '16-31')
+        context.reset_config_snapshot()
+        ctxt = context.NovaComputeLibvirtContext()()
+        self.assertEqual(ctxt['cpu_dedicated_set'], '16-31')
+        self.assertEqual(ctxt['cpu_shared_set'], '1,5')
+
+        plan_cpu_sets.side_effect = ValueError('too few cores')
+        ctxt = context.NovaComputeLibvirtContext()()
+        self.assertEqual(ctxt['cpu_dedicated_set'], '16-31')
+        self.assertNotIn('cpu_shared_set', ctxt)
+
+    @patch.object(context, 'check_cpu_sets')
+    @patch('nova_compute_cpus.plan_cpu_sets')
+    def test_cpu_partitioning_invalid_sets(self, plan_cpu_sets,
+                                           check_cpu_sets):
+        self.kv.return_value = FakeUnitdata(**{'host_uuid': self.host_uuid})
+        self.lsb_release.return_value = {'DISTRIB_CODENAME': 'lucid'}
+        self.test_config.set('cpu-partitioning', 'host:1,shared:1')
+        self.test_config.set('vcpu-pin-set', '16-31')
+        context.reset_config_snapshot()
+        plan_cpu_sets.return_value = {'host': {0, 4}, 'shared': {1, 5},
+                                      'dedicated': {2, 3, 6, 7}}
+        check_cpu_sets.side_effect = ValueError('CPUs 1 are both dedicated '
+                                                'and shared')
+        ctxt = context.NovaComputeLibvirtContext()()
+        # the planned sets are dropped
+        self.assertNotIn('cpu_dedicated_set', ctxt)
+        self.assertNotIn('cpu_shared_set', ctxt)
+        self.assertEqual(ctxt['vcpu_pin_set'], '16-31')
+        self.assertEqual(self.log.call_args[1]['level'], context.ERROR)
+
+    def test_reserved_host_memory_auto(self):
+        self.lsb_release.return_value = {'DISTRIB_CODENAME': 'lucid'}
+        self.kv.return_value = FakeUnitdata(**{'host_uuid': self.host_uuid})
+        self.test_config.set('reserved-host-memory-auto', True)
+        self.assertEqual(
+            context.NovaComputeLibvirtContext()()['reserved_host_memory'],
+            512)
+        self.kv.return_value = FakeUnitdata(**{
+            'host_uuid': self.host_uuid,
+            'reserved-host-memory-auto': 2048})
+        self.assertEqual(
+            context.NovaComputeLibvirtContext()()['reserved_host_memory'],
+            2048)
+        self.test_config.set('reserved-host-memory-auto', False)
+        context.reset_config_snapshot()
+        self.assertEqual(
+            context.NovaComputeLibvirtContext()()['reserved_host_memory'],
+            512)
+
+    def test_ksm_profiles(self):
+        self.lsb_release.return_value = {'DISTRIB_CODENAME': 'lucid'}
+        self.kv.return_value = FakeUnitdata(**{'host_uuid': self.host_uuid})
+        for profile, enabled, sleep in (
+                ('off', '0', None),
+                ('aggressive', '1', 20),
+                ('memory-pressure-adaptive', '1', None)):
+            self.test_config.set('ksm', profile)
+            context.reset_config_snapshot()
+            ctxt = context.NovaComputeLibvirtContext()()
+            self.assertEqual(ctxt['ksm'], enabled)
+            self.assertEqual(ctxt.get('ksm_sleep_millisecs'), sleep)
+
     def test_ksm_configs(self):
         self.lsb_release.return_value = {'DISTRIB_CODENAME': 'lucid'}
 
@@ -1027,29 +1128,35 @@ class NovaComputeContextTests(CharmTestCase):
         self.assertTrue(libvirt()['ksm'] == '1')
 
         self.test_config.set('ksm', '0')
+        context.reset_config_snapshot()
         libvirt = context.NovaComputeLibvirtContext()
         self.assertTrue(libvirt()['ksm'] == '0')
 
         self.test_config.set('ksm', 'AUTO')
+        context.reset_config_snapshot()
         libvirt = context.NovaComputeLibvirtContext()
         self.assertTrue(libvirt()['ksm'] == 'AUTO')
 
         self.test_config.set('ksm', '')
+        context.reset_config_snapshot()
         libvirt = context.NovaComputeLibvirtContext()
         self.assertTrue(libvirt()['ksm'] == 'AUTO')
 
         self.os_release.return_value = 'ocata'
         self.test_config.set('ksm', 'AUTO')
+        context.reset_config_snapshot()
         libvirt = context.NovaComputeLibvirtContext()
         self.assertTrue(libvirt()['ksm'] == 'AUTO')
 
         self.os_release.return_value = 'kilo'
         self.test_config.set('ksm', 'AUTO')
+        context.reset_config_snapshot()
         libvirt = context.NovaComputeLibvirtContext()
         self.assertTrue(libvirt()['ksm'] == 'AUTO')
 
         self.os_release.return_value = 'diablo'
         self.test_config.set('ksm', 'AUTO')
+        context.reset_config_snapshot()
         libvirt = context.NovaComputeLibvirtContext()
         self.assertTrue(libvirt()['ksm'] == '1')
 
@@ -1309,6 +1416,7 @@ class SerialConsoleContextTests(CharmTestCase):
         super(SerialConsoleContextTests, self).setUp(context, TO_PATCH)
         self.relation_get.side_effect = self.test_relation.get
         self.config.side_effect = self.test_config.get
+        context.reset_config_snapshot()
         self.host_uuid = 'e46e530d-18ae-4a67-9ff0-e6e2ba7c60a7'
 
     def test_serial_console_disabled(self):
@@ -1373,6 +1481,56 @@ class SerialConsoleContextTests(CharmTestCase):
              'reserved_host_memory': 512}, libvirt())
 
 
+class ConfigSnapshotTests(CharmTestCase):
+
+    def setUp(self):
+        super(ConfigSnapshotTests, self).setUp(context, TO_PATCH)
+        self.config.side_effect = self.test_config.get
+        context.reset_config_snapshot()
+
+    def test_config_snapshot(self):
+        self.test_config.set('reserved-huge-pages',
+                             'node:0,size:2048,count:64; node:1,size:1GB')
+        self.test_config.set('cpu-model-extra-flags', 'vmx  pcid')
+        self.test_config.set('pci-alias', '{"name": "IntelNIC"}')
+        cfg = context.config_snapshot()
+        self.assertIs(cfg, context.config_snapshot())
+        self.assertEqual(cfg['virt-type'], 'kvm')
+        self.assertEqual(cfg.reserved_huge_pages,
+                         ('node:0,size:2048,count:64', 'node:1,size:1GB'))
+        self.assertEqual(cfg.cpu_model_extra_flags, ('vmx', 'pcid'))
+        self.assertEqual(cfg.pci_aliases, {'name': 'IntelNIC'})
+        self.assertIs(cfg.pci_aliases, cfg.pci_aliases)
+        with self.assertRaises(AttributeError):
+            cfg.pci_aliases = None
+        with self.assertRaises(TypeError):
+            cfg['virt-type'] = 'lxd'
+
+    def test_config_snapshot_defaults(self):
+        self.config.side_effect = lambda: {'virt-type': 'lxd'}
+        context.reset_config_snapshot()
+        cfg = context.config_snapshot()
+        self.assertEqual(cfg['virt-type'], 'lxd')
+        self.assertIsNone(cfg['pci-alias'])
+        self.assertEqual(cfg.reserved_huge_pages, ())
+
+    @patch.object(context, 'CONFIG_YAML', '/nonexistent/config.yaml')
+    @patch.object(context, '_config_defaults', None)
+    def test_config_snapshot_unknown_option(self):
+        # config-get --all omits options without a value; without the
+        # config.yaml defaults they must still read as None.
+        self.config.side_effect = lambda: {'virt-type': 'lxd'}
+        context.reset_config_snapshot()
+        cfg = context.config_snapshot()
+        self.assertIsNone(cfg['pci-alias'])
+        self.assertIsNone(cfg.get('pci-alias'))
+        self.assertEqual(cfg.get('pci-alias', 'x'), 'x')
+        self.assertNotIn('pci-alias', cfg)
+        self.assertIsNone(cfg.pci_aliases)
+        self.assertEqual(cfg.cpu_model_extra_flags, ())
+        self.log.assert_called_once_with(ANY, level='ERROR')
+
+
 class NovaComputeAvailabilityZoneContextTests(CharmTestCase):
 
     def setUp(self):
@@ -1380,44 +1538,34 @@ class NovaComputeAvailabilityZoneContextTests(CharmTestCase):
               self).setUp(context, TO_PATCH)
         self.os_release.return_value = 'kilo'
 
-    @patch('nova_compute_context.config')
     @patch('os.environ.get')
-    def test_availability_zone_no_juju_with_env(self, mock_get,
-                                                mock_config):
+    def test_availability_zone_no_juju_with_env(self, mock_get):
         def environ_get_side_effect(key):
             return {
                 'JUJU_AVAILABILITY_ZONE': 'az1',
             }[key]
         mock_get.side_effect = environ_get_side_effect
 
-        def config_side_effect(key):
-            return {
-                'customize-failure-domain': False,
-                'default-availability-zone': 'nova',
-            }[key]
-
-        mock_config.side_effect = config_side_effect
+        self.config.side_effect = self.test_config.get
+        context.reset_config_snapshot()
+        self.test_config.set('customize-failure-domain', False)
+        self.test_config.set('default-availability-zone', 'nova')
         az_context = context.NovaComputeAvailabilityZoneContext()
         self.assertEqual(
             {'default_availability_zone': 'nova'}, az_context())
 
-    @patch('nova_compute_context.config')
     @patch('os.environ.get')
-    def test_availability_zone_no_juju_no_env(self, mock_get,
-                                              mock_config):
+    def test_availability_zone_no_juju_no_env(self, mock_get):
         def environ_get_side_effect(key):
             return {
                 'JUJU_AVAILABILITY_ZONE': '',
             }[key]
         mock_get.side_effect = environ_get_side_effect
 
-        def config_side_effect(key):
-            return {
-                'customize-failure-domain': False,
-                'default-availability-zone': 'nova',
-            }[key]
-
-        mock_config.side_effect = config_side_effect
+        self.config.side_effect = self.test_config.get
+        context.reset_config_snapshot()
+        self.test_config.set('customize-failure-domain', False)
+        self.test_config.set('default-availability-zone', 'nova')
         az_context = context.NovaComputeAvailabilityZoneContext()
 
         self.assertEqual(
@@ -1432,6 +1580,7 @@ class NovaComputeAvailabilityZoneContextTests(CharmTestCase):
         mock_get.side_effect = environ_get_side_effect
 
         self.config.side_effect = self.test_config.get
+        context.reset_config_snapshot()
         self.test_config.set('customize-failure-domain', True)
         az_context = context.NovaComputeAvailabilityZoneContext()
         self.assertEqual(
@@ -1507,6 +1656,7 @@ class NovaComputeCephContextTest(CharmTestCase):
     def setUp(self):
         super().setUp(context, TO_PATCH)
         self.config.side_effect = self.test_config.get
+        context.reset_config_snapshot()
         self.os_release.return_value = 'queens'
 
     @patch('nova_compute_context.sent_ceph_application_name')
@@ -1564,6 +1714,7 @@ class NovaComputeCephContextTest(CharmTestCase):
         self.assertEqual(ctxt['rbd_pool'], 'nova-metadata')
 
         self.test_config.set('ec-rbd-metadata-pool', 'nova-newmetadata')
+        context.reset_config_snapshot()
         ctxt = context.NovaComputeCephContext()()
         self.assertEqual(ctxt['rbd_pool'], 'nova-newmetadata')
 
@@ -1589,6 +1740,7 @@ class NovaComputePlacementContextTest(CharmTestCase):
     def setUp(self):
         super(NovaComputePlacementContextTest, self).setUp(context, TO_PATCH)
         self.config.side_effect = self.test_config.get
+        context.reset_config_snapshot()
         self.os_release.return_value = 'train'
         self.maxDiff = None
 
@@ -1657,6 +1809,7 @@ class NovaComputeSWTPMContextTest(CharmTestCase):
     def setUp(self):
         super(NovaComputeSWTPMContextTest, self).setUp(context, TO_PATCH)
         self.config.side_effect = self.test_config.get
+        context.reset_config_snapshot()
         self.os_release.return_value = 'wallaby'
         self.maxDiff = None
 
@@ -1693,6 +1846,7 @@ class NovaComputeVirtMkfsContext(CharmTestCase):
     def setUp(self):
         super(NovaComputeVirtMkfsContext, self).setUp(context, TO_PATCH)
         self.config.side_effect = self.test_config.get
+        context.reset_config_snapshot()
         self.os_release.return_value = 'zed'
 
     def test_cfg_none(self):
@@ -1719,6 +1873,7 @@ class TestNovaComputeHostInfoContext(CharmTestCase):
     def setUp(self):
         super().setUp(context, TO_PATCH)
         self.config.side_effect = self.test_config.get
+        context.reset_config_snapshot()
         self.os_release.return_value = 'ussuri'
 
     def test_use_fqdn_hint(self):
@@ -0,0 +1,133 @@
+# Copyright 2024 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest.mock import patch
+
+import nova_compute_cpus as cpus
+
+# 2 NUMA nodes of 4 cores with 2 threads, siblings n and n + 8
+TOPOLOGY = {
+    0: [(0, 8), (1, 9), (2, 10), (3, 11)],
+    1: [(4, 12), (5, 13), (6, 14), (7, 15)],
+}
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content + '\n')
+
+
+class CpuPartitioningTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sysfs = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.sysfs)
+        for target, value in (('SYSFS', self.sysfs),
+                              ('KERNELCMD',
+                               os.path.join(self.sysfs, 'cmdline'))):
+            p = patch.object(cpus, target, value)
+            p.start()
+            self.addCleanup(p.stop)
+        write(os.path.join(self.sysfs, cpus.CPU_PATH, 'online'), '0-15')
+        for node, cores in TOPOLOGY.items():
+            write(os.path.join(self.sysfs, cpus.NODE_PATH,
+                               'node{}'.format(node), 'cpulist'),
+                  cpus.format_cpu_spec(c for core in cores for c in core))
+            for core in cores:
+                for cpu in core:
+                    write(os.path.join(self.sysfs, cpus.CPU_PATH,
+                                       'cpu{}'.format(cpu), 'topology',
+                                       'thread_siblings_list'),
+                          cpus.format_cpu_spec(core))
+        write(os.path.join(self.sysfs, 'cmdline'),
+              'root=/dev/sda1 isolcpus=managed_irq,domain,0-1,8-9')
+
+    def test_parse_cpu_spec(self):
+        self.assertEqual(cpus.parse_cpu_spec('0-3,8'), {0, 1, 2, 3, 8})
+        self.assertEqual(cpus.parse_cpu_spec('^0,0-3, ^2'), {1, 3})
+        self.assertEqual(cpus.parse_cpu_spec(None), set())
+        for spec in ('0-a', '3-1', 'x'):
+            self.assertRaises(ValueError, cpus.parse_cpu_spec, spec)
+
+    def test_format_cpu_spec(self):
+        self.assertEqual(cpus.format_cpu_spec([8, 0, 1, 2, 3, 10]),
+                         '0-3,8,10')
+        self.assertEqual(cpus.format_cpu_spec([]), '')
+
+    def test_cpu_topology(self):
+        self.assertEqual(cpus.cpu_topology(), TOPOLOGY)
+
+    def test_isolated_cpus(self):
+        self.assertEqual(cpus.isolated_cpus(), {0, 1, 8, 9})
+
+    def test_plan_cpu_sets(self):
+        sets = cpus.plan_cpu_sets('host:1,shared:1')
+        # cores 0 and 1 are isolated, the host and shared get 2 and 3
+        self.assertEqual(sets['host'], {2, 10, 4, 12})
+        self.assertEqual(sets['shared'], {3, 11, 5, 13})
+        self.assertEqual(sets['dedicated'], {0, 8, 1, 9, 6, 14, 7, 15})
+
+    def test_plan_cpu_sets_defaults(self):
+        sets = cpus.plan_cpu_sets('', TOPOLOGY, set())
+        self.assertEqual(sets['host'], {0, 8, 4, 12})
+        self.assertEqual(sets['shared'], set())
+
+    def test_plan_cpu_sets_invalid(self):
+        for policy in ('host:4', 'host:2,shared:2', 'guests:1', 'host:-1',
+                       'host:x'):
+            self.assertRaises(ValueError, cpus.plan_cpu_sets, policy,
+                              TOPOLOGY, set())
+
+    def test_check_cpu_sets(self):
+        self.assertEqual(
+            cpus.check_cpu_sets('1-3,9-11', '4,12', TOPOLOGY), [])
+        self.assertEqual(
+            cpus.check_cpu_sets('1-3,9-10', '4,12', TOPOLOGY),
+            ['Dedicated CPUs 3 share their core with CPUs 11'])
+        self.assertRaises(ValueError, cpus.check_cpu_sets,
+                          '1-3', '3-4', TOPOLOGY)
+
+    def test_cpu_sets(self):
+        self.assertEqual(cpus.cpu_sets(None, '1-3', None), ('1-3', None))
+        self.assertEqual(cpus.cpu_sets('host:1,shared:1', None, None),
+                         ('0-1,6-9,14-15', '3,5,11,13'))
+        self.assertEqual(cpus.cpu_sets('host:1', '6-7', None),
+                         ('6-7', None))
+
+    def test_cpu_sets_one_given(self):
+        # shared planned from the cores not dedicated
+        self.assertEqual(
+            cpus.cpu_sets('host:1,shared:1', '2-3,6-7,10-11,14-15', None),
+            ('2-3,6-7,10-11,14-15', '1,5,9,13'))
+        self.assertRaises(ValueError, cpus.cpu_sets, 'host:1,shared:1',
+                          '1-3,9-11', None)
+        # the shared set given, none of it planned
+        self.assertEqual(
+            cpus.cpu_sets('host:1,shared:1', None, '3,11'),
+            ('0-1,5-9,13-15', '3,11'))
+
+    def test_plan_cpu_sets_given(self):
+        sets = cpus.plan_cpu_sets('host:1', TOPOLOGY, set(),
+                                  given={'dedicated': {0, 1, 2, 3, 8, 9,
+                                                       10, 11, 5}})
+        # node0 is all dedicated, cpu 5 is left out of its core
+        self.assertEqual(sets['host'], {4, 12})
+        self.assertEqual(sets['shared'], set())
+        self.assertEqual(sets['dedicated'], {13, 6, 14, 7, 15})
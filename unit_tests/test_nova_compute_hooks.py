@@ -15,6 +15,9 @@
 import copy
 import importlib
 import json
+import os
+import shutil
+import tempfile
 
 from unittest.mock import (
     ANY,
@@ -24,7 +27,7 @@ from unittest.mock import (
 )
 
 
-from test_utils import CharmTestCase
+from test_utils import CharmTestCase, TestKV
 from nova_compute_context import (
     NovaComputeHostInfoContext
 )
@@ -57,7 +60,7 @@ TO_PATCH = [
     'apt_update',
     'filter_installed_packages',
     'restart_on_change',
-    'service_restart',
+    'queue_restart',
     'is_container',
     'service_running',
     'service_start',
@@ -99,6 +102,8 @@ TO_PATCH = [
     'gethostname',
     'create_sysctl',
     'install_hugepages',
+    'update_reserved_host_memory',
+    'tune_ksm',
     'uuid',
     # unitdata
     'unitdata',
@@ -141,6 +146,11 @@ class NovaComputeRelationsTests(CharmTestCase):
         super(NovaComputeRelationsTests, self).setUp(hooks,
                                                      TO_PATCH)
         self.config.side_effect = self.test_config.get
+        self.test_kv = TestKV()
+        self.patch('kv').return_value = self.test_kv
+        self.boot_id = self.patch('boot_id')
+        self.boot_id.return_value = 'c0d5a1e4-boot-1'
+        self.update_reserved_host_memory.return_value = False
         self.filter_installed_packages.side_effect = \
             MagicMock(side_effect=lambda pkgs: pkgs)
         self.gethostname.return_value = 'testserver'
@@ -453,6 +463,219 @@ class NovaComputeRelationsTests(CharmTestCase):
             user='nova'
         )
 
+    @patch.object(hooks, 'check_and_start_iscsid')
+    @patch.object(hooks, 'compute_joined')
+    def test_config_changed_incremental(self, compute_joined,
+                                        check_and_start_iscsid):
+        self.relation_ids.side_effect = lambda x: {
+            'cloud-compute': ['cloud-compute:1']}.get(x, [])
+        hooks.config_changed()
+        self.assertEqual(
+            self.test_kv.get(hooks.CONFIG_APPLIED_KEY),
+            self.test_config.get_all())
+        self.assertEqual(
+            self.test_kv.get(hooks.CONFIG_APPLIED_BOOT_KEY),
+            'c0d5a1e4-boot-1')
+        compute_joined.reset_mock()
+        self.remove_libvirt_network.reset_mock()
+        self.update_all_configs.reset_mock()
+        self.create_sysctl.reset_mock()
+        self.configure_local_ephemeral_storage.reset_mock()
+        check_and_start_iscsid.reset_mock()
+
+        self.test_config.set('cpu-allocation-ratio', 4.0)
+        hooks.config_changed()
+        self.update_all_configs.assert_called_once_with()
+        compute_joined.assert_not_called()
+        self.remove_libvirt_network.assert_not_called()
+        self.create_sysctl.assert_not_called()
+        self.configure_local_ephemeral_storage.assert_not_called()
+        check_and_start_iscsid.assert_not_called()
+        self.assertEqual(
+            self.test_kv.get(hooks.CONFIG_APPLIED_KEY)['cpu-allocation-ratio'],
+            4.0)
+
+        self.update_all_configs.reset_mock()
+        self.test_config.set('enable-resize', True)
+        hooks.config_changed()
+        self.update_all_configs.assert_called_once_with()
+        self.enable_shell.assert_called_once_with(user='nova')
+        compute_joined.assert_called_once_with('cloud-compute:1')
+
+    @patch('nova_compute_utils.get_subordinate_services')
+    @patch('nova_compute_utils.nova_metadata_requirement')
+    @patch('nova_compute_utils.network_manager')
+    @patch('nova_compute_utils.vaultlocker_installed')
+    @patch('nova_compute_utils.relation_ids')
+    @patch('nova_compute_utils.lsb_release')
+    @patch('nova_compute_utils.os_release')
+    @patch('nova_compute_utils.config')
+    def test_config_changed_steps_cover_services(
+            self, config, os_release, lsb_release, relation_ids,
+            vaultlocker_installed, network_manager,
+            nova_metadata_requirement, get_subordinate_services):
+        import nova_compute_utils as utils
+        read = set()
+
+        def _config(key=None):
+            read.add(key)
+            return self.test_config.get(key)
+        config.side_effect = _config
+        lsb_release.return_value = {'DISTRIB_CODENAME': 'jammy'}
+        relation_ids.return_value = []
+        vaultlocker_installed.return_value = True
+        nova_metadata_requirement.return_value = (False, None)
+        get_subordinate_services.return_value = set()
+        self.test_config.set('multi-host', 'yes')
+        self.addCleanup(utils.reset_resource_map)
+        for manager, release in (('flatdhcpmanager', 'icehouse'),
+                                 ('neutron', 'yoga')):
+            network_manager.return_value = manager
+            os_release.return_value = release
+            utils.reset_resource_map()
+            utils.services()
+        self.assertIn('virt-type', read)
+        nrpe = set(key for key, steps in hooks.CONFIG_CHANGED_STEPS.items()
+                   if 'nrpe' in steps)
+        self.assertEqual(read - nrpe, set())
+
+    @patch.object(hooks, 'compute_joined')
+    def test_config_changed_unchanged(self, compute_joined):
+        hooks.config_changed()
+        self.update_all_configs.reset_mock()
+        hooks.config_changed()
+        self.update_all_configs.assert_not_called()
+        self.assertEqual(self.remove_libvirt_network.call_count, 1)
+
+    @patch.object(hooks, 'install_hugepages')
+    @patch.object(hooks, 'check_and_start_iscsid')
+    @patch.object(hooks, 'compute_joined')
+    def test_config_changed_after_reboot(self, compute_joined,
+                                         check_and_start_iscsid,
+                                         install_hugepages):
+        self.relation_ids.side_effect = lambda x: {
+            'cloud-compute': ['cloud-compute:1']}.get(x, [])
+        self.test_config.set('hugepages', '1G:16@node0')
+        hooks.config_changed()
+        for step in (compute_joined, check_and_start_iscsid,
+                     install_hugepages, self.remove_libvirt_network,
+                     self.create_sysctl,
+                     self.configure_local_ephemeral_storage):
+            step.reset_mock()
+
+        # no option changed but the host rebooted
+        self.boot_id.return_value = 'c0d5a1e4-boot-2'
+        hooks.config_changed()
+        compute_joined.assert_called_once_with('cloud-compute:1')
+        check_and_start_iscsid.assert_called_once_with()
+        install_hugepages.assert_called_once_with()
+        self.remove_libvirt_network.assert_called_once_with('default')
+        self.create_sysctl.assert_called_once()
+        self.configure_local_ephemeral_storage.assert_called_once_with()
+        self.assertEqual(
+            self.test_kv.get(hooks.CONFIG_APPLIED_BOOT_KEY),
+            'c0d5a1e4-boot-2')
+
+        install_hugepages.reset_mock()
+        hooks.config_changed()
+        install_hugepages.assert_not_called()
+
+    @patch.object(hooks, 'compute_joined')
+    def test_config_changed_reserved_host_memory(self, compute_joined):
+        hooks.config_changed()
+        self.update_all_configs.reset_mock()
+        self.update_reserved_host_memory.return_value = True
+        hooks.config_changed()
+        self.update_all_configs.assert_called_once_with()
+
+    @patch.object(hooks, 'compute_joined')
+    def test_config_changed_ksm(self, compute_joined):
+        hooks.config_changed()
+        self.tune_ksm.reset_mock()
+        self.test_config.set('ksm', 'aggressive')
+        hooks.config_changed()
+        self.tune_ksm.assert_called_once_with('aggressive')
+
+    @patch.object(hooks, 'is_unit_paused_set')
+    def test_update_status_tunes_ksm(self, is_unit_paused_set):
+        is_unit_paused_set.return_value = False
+        self.test_config.set('ksm', 'memory-pressure-adaptive')
+        hooks.update_status()
+        self.tune_ksm.assert_called_once_with('memory-pressure-adaptive')
+
+        self.tune_ksm.reset_mock()
+        is_unit_paused_set.return_value = True
+        hooks.update_status()
+        self.tune_ksm.assert_not_called()
+
+    @patch.object(hooks, 'compute_joined')
+    def test_config_changed_full_after_request(self, compute_joined):
+        hooks.config_changed()
+        hooks.request_full_config_changed()
+        self.assertIsNone(self.test_kv.get(hooks.CONFIG_APPLIED_KEY))
+        hooks.config_changed()
+        self.assertEqual(self.remove_libvirt_network.call_count, 2)
+        self.assertEqual(self.update_all_configs.call_count, 2)
+
+    @patch.object(hooks, 'compute_joined')
+    def test_config_changed_full_after_openstack_upgrade(self,
+                                                         compute_joined):
+        self.openstack_upgrade_available.return_value = False
+        hooks.config_changed()
+        self.test_config.set('openstack-origin', 'cloud:focal-victoria')
+        self.openstack_upgrade_available.return_value = True
+        hooks.config_changed()
+        self.do_openstack_upgrade.assert_called_once_with(hooks.CONFIGS)
+        self.assertEqual(self.remove_libvirt_network.call_count, 2)
+
+    @patch.object(hooks, '_handle_ceph_request')
+    @patch.object(hooks, 'create_libvirt_secret')
+    @patch('nova_compute_context.service_name')
+    @patch.object(hooks, 'CONFIGS')
+    @patch.object(hooks, 'compute_joined')
+    def test_config_changed_coalesces_ceph_units(self, compute_joined,
+                                                 configs, service_name,
+                                                 create_libvirt_secret,
+                                                 _handle_ceph_request):
+        service_name.return_value = 'nova-compute-kvm'
+        self.openstack_upgrade_available.return_value = False
+        self.relation_ids.side_effect = lambda x: {
+            'ceph': ['ceph:0'],
+            'ceph-access': ['ceph-access:1']}.get(x, [])
+        self.related_units.side_effect = lambda rid: {
+            'ceph:0': ['ceph-mon/0', 'ceph-mon/1', 'ceph-mon/2'],
+            'ceph-access:1': ['cinder-ceph/0', 'cinder-ceph/1']}[rid]
+        configs.complete_contexts.return_value = ['ceph']
+        self.sent_ceph_application_name.return_value = (
+            hooks.CEPH_AUTH_CRED_NAME)
+        self.ensure_ceph_keyring.return_value = True
+        self.remote_service_name.return_value = 'cinder-ceph'
+        self.relation_get.side_effect = (
+            lambda attribute=None, unit=None, rid=None:
+            {'key': 'mykey', 'secret-uuid': 'uuid2'}.get(attribute))
+        hooks.config_changed()
+        self.assertEqual(configs.write.call_count, 3)
+        _handle_ceph_request.assert_called_once_with()
+        create_libvirt_secret.assert_has_calls([
+            call(secret_file='/etc/ceph/secret.xml', key='mykey',
+                 secret_uuid=hooks.CEPH_SECRET_UUID),
+            call(secret_file='/etc/ceph/secret-cinder-ceph.xml',
+                 secret_uuid='uuid2', key='mykey'),
+        ])
+        self.assertEqual(create_libvirt_secret.call_count, 2)
+        self.assertIsNone(hooks._deferred_work)
+
+    def test_coalesce_relation_work_discarded_on_error(self):
+        work = MagicMock()
+        with self.assertRaises(ValueError):
+            with hooks.coalesce_relation_work():
+                hooks.defer_work('work', work)
+                raise ValueError()
+        work.assert_not_called()
+        self.assertIsNone(hooks._deferred_work)
+        hooks.defer_work('work', work, 1)
+        work.assert_called_once_with(1)
+
     @patch.object(hooks, 'is_container')
     @patch('yaml.safe_load')
     def test_ensure_nf_conntrack_module_loaded_empty(
@@ -688,7 +911,7 @@ class NovaComputeRelationsTests(CharmTestCase):
         self.libvirt_daemon.return_value = 'libvirt-bin'
         hooks.ceph_joined()
         self.apt_install.assert_called_with(['ceph-common'], fatal=True)
-        self.service_restart.assert_called_with('libvirt-bin')
+        self.queue_restart.assert_called_with('libvirt-bin')
         self.libvirt_daemon.assert_called()
         self.send_application_name.assert_called_once_with()
 
@@ -834,7 +1057,7 @@ class NovaComputeRelationsTests(CharmTestCase):
         get_ceph_request.assert_called_once_with()
         get_request_states.assert_called_once_with(request, relation='ceph')
 
-    @patch.object(hooks, 'service_restart')
+    @patch.object(hooks, 'queue_restart')
     @patch.object(hooks, 'mark_broker_action_done')
     @patch.object(hooks, 'is_broker_action_done')
     @patch.object(hooks, 'get_ceph_request')
@@ -843,7 +1066,7 @@ class NovaComputeRelationsTests(CharmTestCase):
     def test__handle_ceph_request_complete_not_action_done(
             self, _get_broker_rid_unit_for_previous_request,
             get_request_states, get_ceph_request, is_broker_action_done,
-            mark_broker_action_done, service_restart):
+            mark_broker_action_done, queue_restart):
         request = hooks.CephBrokerRq()
         get_ceph_request.return_value = request
         get_request_states.return_value = {
@@ -854,15 +1077,19 @@ class NovaComputeRelationsTests(CharmTestCase):
         is_broker_action_done.return_value = False
         hooks._handle_ceph_request()
 
+        queue_restart.assert_called_once_with('nova-compute',
+                                              post_restart_f=ANY)
+        # only recorded once nova-compute has been restarted
+        mark_broker_action_done.assert_not_called()
+        queue_restart.call_args[1]['post_restart_f']('nova-compute')
         mark_broker_action_done.assert_called_once_with(
             'nova_compute_restart', 'ceph:43', 'ceph-mon/0')
-        service_restart.assert_called_once_with('nova-compute')
         is_broker_action_done.assert_called_once_with(
             'nova_compute_restart', 'ceph:43', 'ceph-mon/0')
         get_ceph_request.assert_called_once_with()
         get_request_states.assert_called_once_with(request, relation='ceph')
 
-    @patch.object(hooks, 'service_restart')
+    @patch.object(hooks, 'queue_restart')
     @patch.object(hooks, 'is_broker_action_done')
     @patch.object(hooks, 'get_ceph_request')
     @patch.object(hooks, 'get_request_states')
@@ -870,7 +1097,7 @@ class NovaComputeRelationsTests(CharmTestCase):
     def test__handle_ceph_request_complete_no_restart(
             self, _get_broker_rid_unit_for_previous_request,
             get_request_states, get_ceph_request, is_broker_action_done,
-            service_restart):
+            queue_restart):
         request = hooks.CephBrokerRq()
         get_ceph_request.return_value = request
         get_request_states.return_value = {
@@ -881,7 +1108,7 @@ class NovaComputeRelationsTests(CharmTestCase):
         is_broker_action_done.return_value = True
         hooks._handle_ceph_request()
 
-        service_restart.assert_not_called()
+        queue_restart.assert_not_called()
         is_broker_action_done.assert_called_once_with(
             'nova_compute_restart', 'ceph:43', 'ceph-mon/0')
         get_ceph_request.assert_called_once_with()
@@ -1267,7 +1494,7 @@ class NovaComputeRelationsTests(CharmTestCase):
                  unit=None,
                  rid=None),
         ])
-        self.service_restart.assert_called_with('foobar-service')
+        self.queue_restart.assert_called_with('foobar-service')
         mock_kv.set.assert_called_with('restart-nonce',
                                        'nonce')
         self.assertTrue(mock_kv.flush.called)
@@ -1288,7 +1515,7 @@ class NovaComputeRelationsTests(CharmTestCase):
                  unit=None,
                  rid=None),
         ])
-        self.service_restart.assert_not_called()
+        self.queue_restart.assert_not_called()
         mock_kv.set.assert_called_with('restart-nonce',
                                        'nonce')
         self.assertTrue(mock_kv.flush.called)
@@ -1432,7 +1659,7 @@ class NovaComputeRelationsTests(CharmTestCase):
         hooks.upgrade_charm()
         self.send_application_name.assert_not_called()
         self.remove_old_packages.assert_called_once_with()
-        self.assertFalse(self.service_restart.called)
+        self.assertFalse(self.queue_restart.called)
 
     @patch.object(hooks.grp, 'getgrnam')
     def test_upgrade_charm_send_app_name(self, getgrnam):
@@ -1446,7 +1673,7 @@ class NovaComputeRelationsTests(CharmTestCase):
         self.send_application_name.assert_called_once_with(
             relid='ceph:0', app_name=hooks.CEPH_AUTH_CRED_NAME)
         self.remove_old_packages.assert_called_once_with()
-        self.assertFalse(self.service_restart.called)
+        self.assertFalse(self.queue_restart.called)
 
     @patch.object(hooks.grp, 'getgrnam')
     def test_upgrade_charm_send_app_name_2(self, getgrnam):
@@ -1460,7 +1687,7 @@ class NovaComputeRelationsTests(CharmTestCase):
         self.send_application_name.assert_called_once_with(
             relid='ceph:0', app_name=hooks.CEPH_AUTH_CRED_NAME)
         self.remove_old_packages.assert_called_once_with()
-        self.assertFalse(self.service_restart.called)
+        self.assertFalse(self.queue_restart.called)
 
     @patch.object(hooks.grp, 'getgrnam')
     def test_upgrade_charm_purge(self, getgrnam):
@@ -1471,7 +1698,7 @@ class NovaComputeRelationsTests(CharmTestCase):
         self.services.return_value = ['nova-compute']
         hooks.upgrade_charm()
         self.remove_old_packages.assert_called_once_with()
-        self.service_restart.assert_called_once_with('nova-compute')
+        self.queue_restart.assert_called_once_with('nova-compute')
 
     @patch.object(hooks, 'is_unit_paused_set')
     @patch.object(hooks, 'nova_ceilometer_joined')
@@ -1506,3 +1733,29 @@ class NovaComputeRelationsTests(CharmTestCase):
             relation_id='nova-vgpu:12',
             relation_settings={
                 'restart-trigger': 'uuid1234'})
+
+    @patch.object(hooks, 'kv')
+    @patch.object(hooks, 'hook_name')
+    @patch.object(hooks, 'charm_dir')
+    def test_save_hook_profile(self, charm_dir, hook_name, kv):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(hooks.profiler.reset)
+        charm_dir.return_value = tmpdir
+        hook_name.return_value = 'config-changed'
+        test_kv = TestKV()
+        kv.return_value = test_kv
+        hooks.profiler.enable()
+        with hooks.profiler.phase('renders', '/etc/nova/nova.conf'):
+            pass
+        hooks.save_hook_profile()
+        with open(os.path.join(tmpdir, 'hook-profile.json')) as f:
+            report = json.load(f)
+        self.assertEqual(report['hook'], 'config-changed')
+        self.assertEqual(report['phases']['renders']['count'], 1)
+        self.assertIn({'phase': 'renders', 'name': '/etc/nova/nova.conf',
+                       'time': ANY}, report['slowest'])
+        self.assertIn('juju_tools', report)
+        report.pop('juju_tools')
+        self.assertEqual(test_kv.get('hook-profiles'), [report])
+        self.assertTrue(test_kv.flushed)
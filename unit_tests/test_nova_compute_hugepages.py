@@ -0,0 +1,153 @@
+# Copyright 2024 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from unittest.mock import patch
+
+import nova_compute_hugepages as hugepages
+
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'log',
+]
+
+# 64GiB per node
+NODE_MEMORY = 64 * 1024 * 1024
+
+
+def write_node(sysfs, node, mem_total=NODE_MEMORY, pools=None):
+    """Create the sysfs files of a NUMA node.
+
+    :param pools: {size_kb: nr_hugepages}
+    """
+    path = os.path.join(sysfs, hugepages.NODE_PATH, 'node{}'.format(node))
+    os.makedirs(path)
+    with open(os.path.join(path, 'meminfo'), 'w') as f:
+        f.write('Node {0} MemTotal:       {1} kB\n'
+                'Node {0} MemFree:        {1} kB\n'.format(node, mem_total))
+    for size_kb, count in (pools or {2048: 0, 1048576: 0}).items():
+        pool = os.path.join(path, 'hugepages', 'hugepages-{}kB'.format(
+            size_kb))
+        os.makedirs(pool)
+        with open(os.path.join(pool, 'nr_hugepages'), 'w') as f:
+            f.write('{}\n'.format(count))
+
+
+class HugepagePlanTests(CharmTestCase):
+
+    def setUp(self):
+        super(HugepagePlanTests, self).setUp(hugepages, TO_PATCH)
+        self.sysfs = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.sysfs)
+        p = patch.object(hugepages, 'SYSFS', self.sysfs)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_is_hugepage_plan(self):
+        self.assertTrue(hugepages.is_hugepage_plan('1G:16@node0'))
+        self.assertFalse(hugepages.is_hugepage_plan('10%'))
+        self.assertFalse(hugepages.is_hugepage_plan('1024'))
+        self.assertFalse(hugepages.is_hugepage_plan(None))
+
+    def test_page_size_kb(self):
+        self.assertEqual(hugepages.page_size_kb('2M'), 2048)
+        self.assertEqual(hugepages.page_size_kb('1GB'), 1048576)
+        self.assertEqual(hugepages.page_size_kb('1g'), 1048576)
+        for size in ('', '1X', '512'):
+            self.assertRaises(ValueError, hugepages.page_size_kb, size)
+
+    def test_numa_nodes(self):
+        write_node(self.sysfs, 0)
+        write_node(self.sysfs, 1, mem_total=1024)
+        self.assertEqual(hugepages.numa_nodes(), {0: NODE_MEMORY, 1: 1024})
+
+    def test_plan_hugepages(self):
+        nodes = {0: NODE_MEMORY, 1: NODE_MEMORY}
+        self.assertEqual(
+            hugepages.plan_hugepages('1G:16@node0,16@node1;2M:10%', nodes),
+            [hugepages.Allocation(0, 2048, 3276, 0),
+             hugepages.Allocation(0, 1048576, 16, 0),
+             hugepages.Allocation(1, 2048, 3276, 0),
+             hugepages.Allocation(1, 1048576, 16, 0)])
+
+    def test_plan_hugepages_split(self):
+        nodes = {0: NODE_MEMORY, 1: NODE_MEMORY}
+        self.assertEqual(
+            hugepages.plan_hugepages('1G:5/3', nodes),
+            [hugepages.Allocation(0, 1048576, 3, 2),
+             hugepages.Allocation(1, 1048576, 2, 1)])
+
+    def test_plan_hugepages_invalid(self):
+        nodes = {0: NODE_MEMORY, 1: NODE_MEMORY}
+        for value in ('16@node0',
+                      '1X:16',
+                      '1G:16@numa0',
+                      '1G:1.5',
+                      '1G:16@node2',
+                      '1G:16@node0,8@node0',
+                      '1G:16;1G:8',
+                      '1G:2/4@node0',
+                      '1G:2@node0/4',
+                      '1G:65@node0',
+                      '1G:50%;2M:60%'):
+            self.assertRaises(ValueError, hugepages.plan_hugepages,
+                              value, nodes)
+
+    def test_plan_hugepages_no_nodes(self):
+        self.assertRaises(ValueError, hugepages.plan_hugepages, '1G:16')
+
+    def test_apply_hugepage_plan(self):
+        write_node(self.sysfs, 0, pools={1048576: 0})
+        write_node(self.sysfs, 1, pools={1048576: 16})
+        plan = [hugepages.Allocation(0, 1048576, 16, 2),
+                hugepages.Allocation(1, 1048576, 16, 0)]
+        self.assertEqual(hugepages.apply_hugepage_plan(plan), [])
+        self.assertEqual(hugepages.allocated_hugepages(0, 1048576), 16)
+        self.assertEqual(hugepages.allocated_hugepages(1, 1048576), 16)
+
+    def test_apply_hugepage_plan_shortfall(self):
+        write_node(self.sysfs, 0, pools={1048576: 0})
+        plan = [hugepages.Allocation(0, 1048576, 16, 2),
+                hugepages.Allocation(0, 2048, 16, 0)]
+        # the kernel only finds room for a single 1G page
+        with patch.object(hugepages, 'allocated_hugepages',
+                          side_effect=[0, 1]):
+            shortfalls = hugepages.apply_hugepage_plan(plan)
+        self.assertEqual(shortfalls,
+                         [hugepages.Allocation(0, 1048576, 1, 1),
+                          hugepages.Allocation(0, 2048, 0, 0)])
+
+    def test_hugepage_reservations(self):
+        write_node(self.sysfs, 0, pools={1048576: 1})
+        write_node(self.sysfs, 1, pools={1048576: 16})
+        self.assertEqual(
+            hugepages.hugepage_reservations(
+                '1G:16@node0/2,16@node1/4'),
+            ['node:0,size:1048576,count:1',
+             'node:1,size:1048576,count:4'])
+        self.assertEqual(hugepages.hugepage_reservations('10%'), [])
+        self.assertEqual(hugepages.hugepage_reservations('1G:16@node7'), [])
+
+    def test_merge_reservations(self):
+        self.assertEqual(
+            hugepages.merge_reservations(
+                ['node:0,size:1GB,count:1', 'node:1,size:2048,count:64'],
+                ['node:0,size:1048576,count:2',
+                 'node:1,size:1048576,count:4']),
+            ['node:0,size:1GB,count:1', 'node:1,size:2048,count:64',
+             'node:1,size:1048576,count:4'])
@@ -0,0 +1,158 @@
+# Copyright 2024 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from unittest.mock import patch
+
+import nova_compute_ksm as ksm
+
+from test_utils import (
+    CharmTestCase,
+    TestKV,
+)
+
+TO_PATCH = [
+    'kv',
+    'log',
+]
+
+# 64GiB
+MEM_TOTAL = 64 * 1024 * 1024
+
+
+class KsmTests(CharmTestCase):
+
+    def setUp(self):
+        super(KsmTests, self).setUp(ksm, TO_PATCH)
+        self.test_kv = TestKV()
+        self.kv.return_value = self.test_kv
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        for target, value in (('SYSFS', self.root),
+                              ('PROC_MEMINFO',
+                               os.path.join(self.root, 'meminfo'))):
+            p = patch.object(ksm, target, value)
+            p.start()
+            self.addCleanup(p.stop)
+        os.makedirs(os.path.join(self.root, ksm.KSM_PATH))
+        self.write_ksm(run=1, pages_to_scan=100, sleep_millisecs=200,
+                       pages_shared=1000, pages_sharing=5000,
+                       pages_unshared=20000)
+        self.write_meminfo(MEM_TOTAL // 10)
+
+    def write_ksm(self, **values):
+        for name, value in values.items():
+            with open(ksm._path(name), 'w') as f:
+                f.write('{}\n'.format(value))
+
+    def write_meminfo(self, available):
+        with open(os.path.join(self.root, 'meminfo'), 'w') as f:
+            f.write('MemTotal:       {} kB\n'
+                    'MemFree:        1024 kB\n'
+                    'MemAvailable:   {} kB\n'.format(MEM_TOTAL, available))
+
+    def test_is_ksm_profile(self):
+        self.assertTrue(ksm.is_ksm_profile('aggressive'))
+        self.assertFalse(ksm.is_ksm_profile('AUTO'))
+        self.assertFalse(ksm.is_ksm_profile(None))
+
+    def test_tune_ksm_profile(self):
+        ksm.tune_ksm('aggressive')
+        self.assertEqual(ksm.read_ksm()['pages_to_scan'], 1250)
+        self.assertEqual(ksm.read_ksm()['sleep_millisecs'], 20)
+        ksm.tune_ksm('off')
+        self.assertEqual(ksm.read_ksm()['run'], 0)
+        self.assertEqual(ksm.read_ksm()['pages_to_scan'], 1250)
+        self.assertIsNone(self.test_kv.get(ksm.ADAPTIVE_HISTORY_KEY))
+
+    def test_tune_ksm_not_profile(self):
+        ksm.tune_ksm('AUTO')
+        self.assertEqual(ksm.read_ksm()['pages_to_scan'], 100)
+        # left as they are when no profile was applied
+        self.assertEqual(ksm.read_ksm()['sleep_millisecs'], 200)
+
+    def test_tune_ksm_profile_removed(self):
+        ksm.tune_ksm('aggressive')
+        self.assertEqual(self.test_kv.get(ksm.PROFILE_KEY), 'aggressive')
+        ksm.tune_ksm('memory-pressure-adaptive')
+        self.assertEqual(self.test_kv.get(ksm.PROFILE_KEY),
+                         'memory-pressure-adaptive')
+        ksm.tune_ksm('1')
+        self.assertEqual(ksm.read_ksm()['pages_to_scan'], 100)
+        self.assertEqual(ksm.read_ksm()['sleep_millisecs'], 20)
+        self.assertIsNone(self.test_kv.get(ksm.PROFILE_KEY))
+
+        self.write_ksm(pages_to_scan=300)
+        ksm.tune_ksm('AUTO')
+        self.assertEqual(ksm.read_ksm()['pages_to_scan'], 300)
+
+    def test_adaptive_decision(self):
+        meminfo = {'MemTotal': MEM_TOTAL, 'MemAvailable': MEM_TOTAL // 2}
+        current = ksm.read_ksm()
+        self.assertEqual(ksm.adaptive_decision(current, meminfo)[0],
+                         {'run': 0})
+
+        meminfo['MemAvailable'] = MEM_TOTAL // 10
+        self.assertEqual(
+            ksm.adaptive_decision(current, meminfo),
+            ({'run': 1, 'pages_to_scan': 400, 'sleep_millisecs': 10},
+             'memory pressure, free memory 10.0%'))
+
+        current['pages_unshared'] = 60000
+        self.assertEqual(
+            ksm.adaptive_decision(current, meminfo)[0]['pages_to_scan'], 64)
+
+        current['run'] = 0
+        self.assertEqual(
+            ksm.adaptive_decision(current, meminfo)[0]['pages_to_scan'], 64)
+
+        current.update(run=1, pages_unshared=0, pages_to_scan=1200)
+        meminfo = {'MemTotal': MEM_TOTAL // 16, 'MemAvailable': 0}
+        self.assertEqual(
+            ksm.adaptive_decision(current, meminfo)[0],
+            {'run': 1, 'pages_to_scan': 1250, 'sleep_millisecs': 40})
+
+    def test_tune_ksm_adaptive(self):
+        ksm.tune_ksm('memory-pressure-adaptive')
+        self.assertEqual(ksm.read_ksm()['pages_to_scan'], 400)
+        ksm.tune_ksm('memory-pressure-adaptive')
+        self.assertEqual(ksm.read_ksm()['pages_to_scan'], 700)
+        self.write_meminfo(MEM_TOTAL // 2)
+        ksm.tune_ksm('memory-pressure-adaptive')
+        self.assertEqual(ksm.read_ksm()['run'], 0)
+
+        history = self.test_kv.get(ksm.ADAPTIVE_HISTORY_KEY)
+        self.assertEqual([h['tunables'] for h in history],
+                         [{'run': 1, 'pages_to_scan': 400,
+                           'sleep_millisecs': 10},
+                          {'run': 1, 'pages_to_scan': 700,
+                           'sleep_millisecs': 10},
+                          {'run': 0}])
+        self.assertEqual(history[0]['pages_sharing'], 5000)
+
+    @patch.object(ksm, 'ADAPTIVE_HISTORY_SIZE', 2)
+    def test_tune_ksm_adaptive_history_size(self):
+        for _ in range(3):
+            ksm.tune_ksm('memory-pressure-adaptive')
+        history = self.test_kv.get(ksm.ADAPTIVE_HISTORY_KEY)
+        self.assertEqual([h['tunables']['pages_to_scan'] for h in history],
+                         [700, 1000])
+
+    def test_tune_ksm_unavailable(self):
+        shutil.rmtree(os.path.join(self.root, ksm.KSM_PATH))
+        ksm.tune_ksm('aggressive')
+        self.assertTrue(self.log.called)
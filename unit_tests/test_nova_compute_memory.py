@@ -0,0 +1,154 @@
+# Copyright 2024 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+
+from unittest.mock import patch
+
+import nova_compute_ksm as ksm
+import nova_compute_memory as memory
+
+from test_utils import (
+    CharmTestCase,
+    TestKV,
+)
+
+TO_PATCH = [
+    'config',
+    'hugepage_reservations',
+    'kv',
+    'log',
+]
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+class MemoryTests(CharmTestCase):
+
+    def setUp(self):
+        super(MemoryTests, self).setUp(memory, TO_PATCH)
+        self.config.side_effect = self.test_config.get
+        self.test_kv = TestKV()
+        self.kv.return_value = self.test_kv
+        self.hugepage_reservations.return_value = []
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        for module, target, path in ((memory, 'PROC', 'proc'),
+                                     (ksm, 'SYSFS', 'sys')):
+            p = patch.object(module, target, os.path.join(self.root, path))
+            p.start()
+            self.addCleanup(p.stop)
+        for pid, comm, rss in ((1, 'systemd', 9000),
+                               (10, 'nova-compute', 153600),
+                               (20, 'libvirtd', 51200)):
+            write(os.path.join(self.root, 'proc', str(pid), 'comm'),
+                  comm + '\n')
+            write(os.path.join(self.root, 'proc', str(pid), 'status'),
+                  'Name:\t{}\nVmRSS:\t  {} kB\n'.format(comm, rss))
+        ksm_path = os.path.join(self.root, 'sys', ksm.KSM_PATH)
+        write(os.path.join(ksm_path, 'run'), '1\n')
+        write(os.path.join(ksm_path, 'pages_sharing'), '{}\n'.format(
+            100 * 1048576 // os.sysconf('SC_PAGE_SIZE')))
+        p = patch('subprocess.check_output',
+                  side_effect=FileNotFoundError('ovs-vsctl'))
+        self.check_output = p.start()
+        self.addCleanup(p.stop)
+
+    def test_process_rss_kb(self):
+        self.assertEqual(memory.process_rss_kb(), 204800)
+        self.assertEqual(memory.process_rss_kb(('systemd',)), 9000)
+
+    def test_ksm_shared_kb(self):
+        self.assertEqual(memory.ksm_shared_kb(), 102400)
+        write(os.path.join(self.root, 'sys', ksm.KSM_PATH, 'run'), '0\n')
+        self.assertEqual(memory.ksm_shared_kb(), 0)
+
+    def test_ovs_dpdk_socket_mem_mb(self):
+        self.assertEqual(memory.ovs_dpdk_socket_mem_mb(), 0)
+        self.check_output.side_effect = subprocess.CalledProcessError(
+            1, 'ovs-vsctl')
+        self.assertEqual(memory.ovs_dpdk_socket_mem_mb(), 0)
+        self.check_output.side_effect = None
+        self.check_output.return_value = b'"1024,2048"\n'
+        self.assertEqual(memory.ovs_dpdk_socket_mem_mb(), 3072)
+        self.check_output.assert_called_with(
+            ['ovs-vsctl', '--no-wait', '--timeout=10', 'get', 'Open_vSwitch',
+             '.', 'other_config:dpdk-socket-mem'],
+            stderr=subprocess.DEVNULL, timeout=15)
+        self.log.assert_not_called()
+
+    def test_ovs_dpdk_socket_mem_mb_timeout(self):
+        for error in (subprocess.TimeoutExpired('ovs-vsctl', 15),
+                      subprocess.CalledProcessError(-signal.SIGALRM,
+                                                    'ovs-vsctl')):
+            self.log.reset_mock()
+            self.check_output.side_effect = error
+            self.assertEqual(memory.ovs_dpdk_socket_mem_mb(), 0)
+            self.log.assert_called_once_with(
+                'ovs-vsctl timed out, not reserving OVS-DPDK memory',
+                level=memory.WARNING)
+
+    def test_memory_breakdown(self):
+        self.test_config.set('reserved-huge-pages',
+                             'node:0,size:1GB,count:1')
+        self.test_config.set('rbd-client-cache', 'enabled')
+        self.test_config.set('reserved-host-memory-rbd-disks', 2)
+        self.hugepage_reservations.return_value = [
+            'node:1,size:1048576,count:1']
+        self.check_output.side_effect = None
+        self.check_output.return_value = b'"2048,2048"\n'
+        breakdown = memory.memory_breakdown()
+        # the 2GB of huge pages kept for the host are left out by nova
+        self.assertEqual(list(breakdown.items()),
+                         [('base', 512),
+                          ('ovs_dpdk', 2048),
+                          ('rbd_cache', 128),
+                          ('services', 200),
+                          ('ksm', 100)])
+        self.assertEqual(
+            memory.recommended_reserved_host_memory(breakdown), 3072)
+
+        self.test_config.set('rbd-client-cache', 'disabled')
+        self.assertEqual(memory.memory_breakdown()['rbd_cache'], 0)
+
+    def test_update_reserved_host_memory(self):
+        self.assertFalse(memory.update_reserved_host_memory())
+        self.assertIsNone(self.test_kv.get(memory.RESERVED_HOST_MEMORY_KEY))
+
+        self.test_config.set('reserved-host-memory-auto', True)
+        self.assertTrue(memory.update_reserved_host_memory())
+        # 512 + 200 + 100
+        self.assertEqual(self.test_kv.get(memory.RESERVED_HOST_MEMORY_KEY),
+                         1024)
+        self.assertFalse(memory.update_reserved_host_memory())
+
+        # lowered by a granule only, kept
+        self.test_config.set('reserved-host-memory', 256)
+        self.assertFalse(memory.update_reserved_host_memory())
+        self.test_config.set('reserved-host-memory', 0)
+        self.assertTrue(memory.update_reserved_host_memory())
+        self.assertEqual(self.test_kv.get(memory.RESERVED_HOST_MEMORY_KEY),
+                         512)
+
+        self.test_config.set('reserved-host-memory-auto', False)
+        self.assertTrue(memory.update_reserved_host_memory())
+        self.assertIsNone(self.test_kv.get(memory.RESERVED_HOST_MEMORY_KEY))
@@ -22,6 +22,8 @@ import charmhelpers.contrib.openstack.templating as os_templating
 import nova_compute_context as compute_context
 import nova_compute_utils as utils
 
+from nova_compute_hugepages import Allocation
+
 from unittest.mock import (
     patch,
     MagicMock,
@@ -87,6 +89,8 @@ class NovaComputeUtilsTests(CharmTestCase):
         self.lsb_release.return_value = {'DISTRIB_CODENAME': 'precise'}
         self.test_kv = TestKV()
         self.kv.return_value = self.test_kv
+        utils.reset_resource_map()
+        self.addCleanup(utils.reset_resource_map)
 
     @patch.object(utils, 'get_subordinate_release_packages')
     @patch.object(utils, 'nova_metadata_requirement')
@@ -671,6 +675,31 @@ class NovaComputeUtilsTests(CharmTestCase):
         result = utils.resource_map()['/etc/nova/nova.conf']['services']
         self.assertTrue('nova-api-metadata' in result)
 
+    @patch.object(utils, 'get_subordinate_services')
+    @patch.object(utils, 'nova_metadata_requirement')
+    @patch.object(utils, 'neutron_plugin')
+    @patch.object(utils, 'network_manager')
+    def test_resource_map_cached(self, net_man, _plugin, _metadata,
+                                 _subordinate_services):
+        _subordinate_services.return_value = []
+        _metadata.return_value = (False, None)
+        net_man.return_value = 'neutron'
+        self.relation_ids.return_value = []
+        self.os_release.return_value = 'diablo'
+        result = utils.resource_map()
+        self.assertIs(result, utils.resource_map())
+        self.assertIs(utils.restart_map(), utils.restart_map())
+        self.assertEqual(net_man.call_count, 1)
+        self.assertNotIn('nova-api-metadata',
+                         result['/etc/nova/nova.conf']['services'])
+
+        _metadata.return_value = (True, None)
+        self.assertNotIn('nova-api-metadata', utils.services())
+        utils.reset_resource_map()
+        self.assertIsNot(result, utils.resource_map())
+        self.assertEqual(net_man.call_count, 2)
+        self.assertIn('nova-api-metadata', utils.services())
+
     @patch.object(compute_context, 'os_release')
     def _get_rendered_template(self, template, resource_map, _os_release):
         _os_release.return_value = self.os_release.return_value
@@ -948,13 +977,47 @@ class NovaComputeUtilsTests(CharmTestCase):
             mock_ceph_config_file.return_value = tmpfile.name
             utils.register_configs()
             renderer.assert_called_with(
-                openstack_release='havana', templates_dir='templates/')
+                openstack_release='havana', templates_dir='templates/',
+                prefetch_relations=True)
             ex_reg = [
                 call('/etc/nova/nova.conf', [ctxt1]),
                 call('/etc/nova/nova-compute.conf', [ctxt2]),
             ]
             fake_renderer.register.assert_has_calls(ex_reg, any_order=True)
 
+    @patch.object(utils, 'hook_name')
+    def test_lazy_config_renderer(self, hook_name):
+        hook_name.return_value = 'config-changed'
+        factory = MagicMock()
+        factory.return_value.complete_contexts.return_value = ['amqp']
+        configs = utils.LazyConfigRenderer(factory)
+        factory.assert_not_called()
+        configs.write_all()
+        self.assertEqual(configs.complete_contexts(), ['amqp'])
+        factory.assert_called_once_with()
+        factory.return_value.write_all.assert_called_once_with()
+        factory.return_value.complete_contexts.assert_called_once_with()
+        self.assertEqual(self.test_kv.get(utils.COMPLETE_CONTEXTS_KEY),
+                         ['amqp'])
+
+    @patch.object(utils, 'hook_name')
+    def test_lazy_config_renderer_update_status(self, hook_name):
+        hook_name.return_value = 'update-status'
+        factory = MagicMock()
+        factory.return_value.complete_contexts.return_value = ['amqp']
+        # nothing recorded yet, the contexts are evaluated
+        self.assertEqual(
+            utils.LazyConfigRenderer(factory).complete_contexts(), ['amqp'])
+        factory.reset_mock()
+        factory.return_value.complete_contexts.return_value = []
+        # then the configs are neither registered nor evaluated
+        configs = utils.LazyConfigRenderer(factory)
+        self.assertEqual(configs.complete_contexts(), ['amqp'])
+        factory.assert_not_called()
+        # but they are once the renderer is in use
+        configs.write_all()
+        self.assertEqual(configs.complete_contexts(), [])
+
     @patch.object(utils, 'check_call')
     def test_enable_shell(self, _check_call):
         utils.enable_shell('dummy')
@@ -1077,6 +1140,72 @@ class NovaComputeUtilsTests(CharmTestCase):
         self.Fstab.remove_by_mountpoint.assert_called_with(
             '/run/hugepages/kvm')
 
+    @patch.object(utils, 'render')
+    @patch.object(utils, 'apply_hugepage_plan')
+    @patch.object(utils, 'default_page_size_kb', return_value=2048)
+    @patch.object(utils, 'plan_hugepages')
+    @patch('subprocess.check_call')
+    @patch('subprocess.call')
+    def test_install_hugepages_plan(self, _call, _check_call, plan_hugepages,
+                                    default_page_size_kb,
+                                    apply_hugepage_plan, render):
+        self.test_config.set('hugepages', '1G:16@node0,16@node1;2M:10%')
+        plan = [Allocation(0, 2048, 100, 0),
+                Allocation(0, 1048576, 16, 0),
+                Allocation(1, 2048, 100, 0),
+                Allocation(1, 1048576, 16, 0)]
+        plan_hugepages.return_value = plan
+        _call.return_value = 0
+        utils.install_hugepages()
+        self.hugepage_support.assert_called_with(
+            'nova',
+            mnt_point='/run/hugepages/kvm',
+            group='root',
+            nr_hugepages=200,
+            mount=False,
+            set_shmmax=True,
+        )
+        apply_hugepage_plan.assert_called_once_with(plan)
+        # the node pools are resized again at boot
+        render.assert_called_once_with(
+            utils.HUGEPAGES_SERVICE,
+            '/etc/systemd/system/nova-compute-hugepages.service',
+            {'pools': [
+                ('/sys/devices/system/node/node0/hugepages/'
+                 'hugepages-2048kB/nr_hugepages', 100),
+                ('/sys/devices/system/node/node0/hugepages/'
+                 'hugepages-1048576kB/nr_hugepages', 16),
+                ('/sys/devices/system/node/node1/hugepages/'
+                 'hugepages-2048kB/nr_hugepages', 100),
+                ('/sys/devices/system/node/node1/hugepages/'
+                 'hugepages-1048576kB/nr_hugepages', 16)]},
+            perms=0o644)
+        _check_call.assert_any_call(
+            ['systemctl', 'enable', 'nova-compute-hugepages.service'])
+
+    @patch('os.remove')
+    @patch('os.path.exists')
+    @patch('subprocess.check_call')
+    @patch('subprocess.call')
+    def test_persist_hugepage_plan_removed(self, _call, _check_call, exists,
+                                           remove):
+        exists.return_value = False
+        utils.persist_hugepage_plan([])
+        self.assertFalse(remove.called)
+        exists.return_value = True
+        utils.persist_hugepage_plan([])
+        _call.assert_called_once_with(
+            ['systemctl', 'disable', 'nova-compute-hugepages.service'])
+        remove.assert_called_once_with(utils.HUGEPAGES_SERVICE_PATH)
+        _check_call.assert_called_once_with(['systemctl', 'daemon-reload'])
+
+    @patch.object(utils, 'plan_hugepages')
+    def test_install_hugepages_invalid_plan(self, plan_hugepages):
+        self.test_config.set('hugepages', '1G:16@node7')
+        plan_hugepages.side_effect = ValueError('Unknown NUMA node 7')
+        utils.install_hugepages()
+        self.assertFalse(self.hugepage_support.called)
+
     @patch('psutil.virtual_memory')
     @patch('subprocess.check_call')
     @patch('subprocess.call')
@@ -1158,13 +1287,15 @@ class NovaComputeUtilsTests(CharmTestCase):
             utils.resume_unit_helper('random-config')
             prh.assert_called_once_with(utils.resume_unit, 'random-config')
 
+    @patch.object(utils, 'service_dependencies')
     @patch.object(utils, 'os_release')
     @patch.object(utils, 'is_unit_paused_set')
     @patch.object(utils, 'services')
     def test_pause_resume_helper(self, services, mock_is_paused,
-                                 mock_os_release):
+                                 mock_os_release, service_dependencies):
         f = MagicMock()
         services.return_value = ['s1']
+        service_dependencies.return_value = {'s1': []}
         mock_is_paused.return_value = False
         mock_os_release.return_value = 'queens'
         with patch.object(utils, 'assess_status_func') as asf:
@@ -1172,7 +1303,8 @@ class NovaComputeUtilsTests(CharmTestCase):
             utils._pause_resume_helper(f, 'some-config')
             asf.assert_called_once_with('some-config', ['s1'])
             # ports=None whilst port checks are disabled.
-            f.assert_called_once_with('assessor', services=['s1'], ports=None)
+            f.assert_called_once_with('assessor', services=['s1'], ports=None,
+                                      dependencies={'s1': []})
 
     @patch.object(utils, 'check_call')
     @patch.object(utils, 'check_output')
@@ -1459,6 +1591,22 @@ class NovaComputeUtilsTests(CharmTestCase):
         self.assertEqual(expected_service_set, set(actual_service_list))
         self.assertEqual(expected_last_service, actual_service_list[-1])
 
+    @patch.object(utils, 'get_subordinate_services')
+    @patch.object(utils, 'restart_map')
+    def test_service_dependencies(self, restart_map, subordinate_services):
+        restart_map.return_value = {
+            '/etc/nova/nova.conf': ['nova-compute', 'nova-api-metadata'],
+            '/etc/libvirt/qemu.conf': ['libvirtd'],
+        }
+        subordinate_services.return_value = set(['ceilometer-agent-compute'])
+        self.assertEqual(utils.service_dependencies(), {
+            'nova-compute': ['libvirtd'],
+            'nova-api-metadata': [],
+            'libvirtd': [],
+            'ceilometer-agent-compute': ['libvirtd', 'nova-api-metadata',
+                                         'nova-compute'],
+        })
+
     @patch.object(utils, 'render')
     def test_install_mount_override(self, render):
         utils.install_mount_override('/srv/test')
@@ -0,0 +1,301 @@
+# Copyright 2024 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from concurrent import futures
+from unittest.mock import patch
+
+from charmhelpers.core import host, systemd
+
+# NOTE: messages laid out as systemd's sd-bus writes them, unlike
+# encode_message(): little endian, NO_REPLY_EXPECTED set on replies and
+# signals, header fields in the order they were added rather than sorted,
+# and no SENDER or DESTINATION on the private socket.
+SUBSCRIBE_REPLY = bytes.fromhex(
+    # header: no body, REPLY_SERIAL 1
+    '6c0201010000000001000000080000000501750001000000'
+)
+LIST_UNITS_REPLY = bytes.fromhex(
+    # header: REPLY_SERIAL 2, SIGNATURE a(ssssssouso)
+    '6c0201015e010000070000001b0000000501750002000000080167000d612873'
+    '73737373736f75736f29000000000000'
+    # array length, padded to the 8 byte boundary of its structs
+    '5601000000000000'
+    # nova-compute.service, loaded, active
+    '140000006e6f76612d636f6d707574652e736572766963650000000011000000'
+    '4f70656e537461636b20436f6d70757465000000060000006c6f616465640000'
+    '0600000061637469766500000700000072756e6e696e67000000000000000000'
+    '370000002f6f72672f667265656465736b746f702f73797374656d64312f756e'
+    '69742f6e6f76615f3264636f6d707574655f3265736572766963650000000000'
+    '0000000000000000010000002f00'
+    # missing.service, not-found, inactive
+    '00000f0000006d697373696e672e73657276696365000f0000006d697373696e'
+    '672e7365727669636500090000006e6f742d666f756e6400000008000000696e'
+    '6163746976650000000004000000646561640000000000000000000000003000'
+    '00002f6f72672f667265656465736b746f702f73797374656d64312f756e6974'
+    '2f6d697373696e675f3265736572766963650000000000000000000000000000'
+    '0000010000002f00'
+)
+RESTART_UNIT_REPLY = bytes.fromhex(
+    # header: REPLY_SERIAL 3, SIGNATURE o
+    '6c02010127000000090000000f000000050175000300000008016700016f0000'
+    # /org/freedesktop/systemd1/job/4213
+    '220000002f6f72672f667265656465736b746f702f73797374656d64312f6a6f'
+    '622f3432313300'
+)
+JOB_REMOVED_SIGNAL = bytes.fromhex(
+    # header: PATH, INTERFACE, MEMBER JobRemoved, SIGNATURE uoss
+    '6c04010151000000080000007a00000001016f00190000002f6f72672f667265'
+    '656465736b746f702f73797374656d6431000000000000000201730020000000'
+    '6f72672e667265656465736b746f702e73797374656d64312e4d616e61676572'
+    '0000000000000000030173000a0000004a6f6252656d6f766564000000000000'
+    '0801670004756f737300000000000000'
+    # 4213, /org/freedesktop/systemd1/job/4213, nova-compute.service, done
+    '75100000220000002f6f72672f667265656465736b746f702f73797374656d64'
+    '312f6a6f622f343231330000140000006e6f76612d636f6d707574652e736572'
+    '766963650000000004000000646f6e6500'
+)
+
+
+class MarshalTests(unittest.TestCase):
+
+    def test_split_signature(self):
+        self.assertEqual(systemd.split_signature('sa(ss)a{sv}uo'),
+                         ['s', 'a(ss)', 'a{sv}', 'u', 'o'])
+
+    def test_round_trip(self):
+        for signature, value in (
+                ('s', 'nova-compute.service'),
+                ('as', ['a', 'bc', '']),
+                ('a(ssu)', [('a', 'b', 1), ('c', 'd', 2)]),
+                ('a{sv}', {'x': ('u', 7), 'y': ('s', 'z')}),
+                ('(ybt)', (1, True, 2 ** 40))):
+            buf = bytearray()
+            systemd.marshal(buf, signature, value)
+            decoded, offset = systemd.unmarshal(buf, 0, signature)
+            if signature == 'a{sv}':
+                value = {k: v[1] for k, v in value.items()}
+            self.assertEqual(decoded, value)
+            self.assertEqual(offset, len(buf))
+
+    def test_unit_name(self):
+        self.assertEqual(systemd.unit_name('nova-compute'),
+                         'nova-compute.service')
+        self.assertEqual(systemd.unit_name('iscsid.socket'), 'iscsid.socket')
+        self.assertEqual(systemd.unit_name('snap.lxd.daemon'),
+                         'snap.lxd.daemon.service')
+
+
+class WireFormatTests(unittest.TestCase):
+    """Decode messages in the layout systemd sends them."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'private')
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(self.server.close)
+        self.server.bind(self.path)
+        self.server.listen(1)
+
+    def serve(self, replies):
+        """Answer the n-th method call with the n-th messages of replies."""
+        def serve():
+            conn, _ = self.server.accept()
+            with conn:
+                buf = bytearray()
+                while not buf.endswith(b'BEGIN\r\n'):
+                    buf.extend(conn.recv(1))
+                    if buf.endswith(b'\r\n') and b'AUTH' in buf:
+                        conn.sendall(b'OK 0123456789abcdef\r\n')
+                        del buf[:]
+                for messages in replies:
+                    systemd.recv_message(conn)
+                    conn.sendall(b''.join(messages))
+                conn.recv(1)
+
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+
+    def decode(self, data):
+        a, b = socket.socketpair()
+        with a, b:
+            a.sendall(data)
+            return systemd.recv_message(b)
+
+    def test_list_units_reply(self):
+        message_type, flags, serial, fields, body = self.decode(
+            LIST_UNITS_REPLY)
+        self.assertEqual((message_type, flags, serial),
+                         (systemd.METHOD_RETURN, systemd.NO_REPLY_EXPECTED, 7))
+        self.assertEqual(fields, {systemd.REPLY_SERIAL: 2,
+                                  systemd.SIGNATURE: 'a(ssssssouso)'})
+        self.assertEqual(body, ([
+            ('nova-compute.service', 'OpenStack Compute', 'loaded', 'active',
+             'running', '',
+             '/org/freedesktop/systemd1/unit/nova_2dcompute_2eservice', 0,
+             '', '/'),
+            ('missing.service', 'missing.service', 'not-found', 'inactive',
+             'dead', '', '/org/freedesktop/systemd1/unit/missing_2eservice',
+             0, '', '/'),
+        ],))
+
+    def test_job_removed_signal(self):
+        message_type, flags, serial, fields, body = self.decode(
+            JOB_REMOVED_SIGNAL)
+        self.assertEqual(message_type, systemd.SIGNAL)
+        self.assertEqual(fields, {
+            systemd.PATH: systemd.SYSTEMD_PATH,
+            systemd.INTERFACE: systemd.MANAGER_INTERFACE,
+            systemd.MEMBER: 'JobRemoved',
+            systemd.SIGNATURE: 'uoss'})
+        self.assertEqual(body, (4213, '/org/freedesktop/systemd1/job/4213',
+                                'nova-compute.service', 'done'))
+
+    def test_client(self):
+        self.serve([[SUBSCRIBE_REPLY], [LIST_UNITS_REPLY],
+                    [RESTART_UNIT_REPLY, JOB_REMOVED_SIGNAL]])
+        client = systemd.Systemd(self.path, timeout=10)
+        self.addCleanup(client.close)
+        self.assertEqual(client.active_states(['nova-compute', 'missing']),
+                         {'nova-compute': 'active', 'missing': 'inactive'})
+        self.assertTrue(client.run_job('restart', 'nova-compute'))
+        self.assertEqual(
+            list(client.connection.signals[(systemd.MANAGER_INTERFACE,
+                                            'JobRemoved')]), [])
+
+
+class SystemdTests(unittest.TestCase):
+
+    def setUp(self):
+        self.local = systemd.LocalSystemd(
+            {'nova-compute.service': 'active',
+             'libvirtd.service': 'failed',
+             'iscsid.service': 'inactive'},
+            results={'iscsid.service': 'failed'},
+            aliases={'libvirt-bin.service': 'libvirtd.service'})
+        self.addCleanup(self.local.close)
+        self.client = systemd.Systemd(self.local.path, timeout=10)
+        self.addCleanup(self.client.close)
+        systemd.set_client(self.client)
+        self.addCleanup(systemd.set_client, False)
+
+    def test_active_states_single_round_trip(self):
+        self.assertEqual(
+            systemd.active_states(['nova-compute', 'libvirtd', 'missing']),
+            {'nova-compute': 'active', 'libvirtd': 'failed',
+             'missing': 'inactive'})
+        self.assertEqual([c[0] for c in self.local.calls],
+                         ['Subscribe', 'ListUnitsByNames'])
+
+    def test_active_states_alias(self):
+        self.assertEqual(
+            systemd.active_states(['libvirt-bin', 'nova-compute', 'missing']),
+            {'libvirt-bin': 'failed', 'nova-compute': 'active',
+             'missing': 'inactive'})
+        self.assertEqual([c for c in self.local.calls if c[0] == 'GetUnit'],
+                         [('GetUnit', ('libvirt-bin.service',))])
+        self.assertTrue(systemd.run_job('restart', 'libvirt-bin'))
+        self.assertEqual(systemd.active_states(['libvirt-bin']),
+                         {'libvirt-bin': 'active'})
+
+    def test_run_job(self):
+        self.assertTrue(systemd.run_job('restart', 'libvirtd'))
+        self.assertEqual(self.local.units['libvirtd.service'], 'active')
+        self.assertTrue(systemd.run_job('stop', 'nova-compute'))
+        self.assertEqual(self.local.units['nova-compute.service'],
+                         'inactive')
+        self.assertFalse(systemd.run_job('start', 'iscsid'))
+        self.assertFalse(systemd.run_job('start', 'missing'))
+        self.assertIsNone(systemd.run_job('enable', 'iscsid'))
+        self.assertIn(('RestartUnit', ('libvirtd.service', 'replace')),
+                      self.local.calls)
+
+    def test_signals_bounded(self):
+        connection = self.client.connection
+        job_removed = connection.signals[(systemd.MANAGER_INTERFACE,
+                                          'JobRemoved')]
+        for i in range(systemd.MAX_SIGNALS + 10):
+            for member in ('JobRemoved', 'UnitNew'):
+                connection._dispatch(
+                    systemd.SIGNAL, 0, i,
+                    {systemd.INTERFACE: systemd.MANAGER_INTERFACE,
+                     systemd.MEMBER: member},
+                    (i, '/job/{}'.format(i), 'other.service', 'done'))
+        self.assertEqual(list(connection.signals),
+                         [(systemd.MANAGER_INTERFACE, 'JobRemoved')])
+        self.assertEqual(len(job_removed), systemd.MAX_SIGNALS)
+        self.assertEqual(job_removed[0][0], 10)
+        self.assertTrue(systemd.run_job('restart', 'libvirtd'))
+
+    def test_run_job_concurrently(self):
+        with futures.ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(
+                lambda name: systemd.run_job('restart', name),
+                ['nova-compute', 'libvirtd'] * 4))
+        self.assertEqual(results, [True] * 8)
+
+    @patch.object(host, 'init_is_systemd', return_value=True)
+    @patch('subprocess.call')
+    def test_host_service(self, call, init_is_systemd):
+        self.assertTrue(host.service_restart('nova-compute'))
+        self.assertTrue(host.service_running('nova-compute'))
+        self.assertFalse(host.service_running('iscsid'))
+        self.assertEqual(
+            host.services_running(['nova-compute', 'libvirtd']),
+            {'nova-compute': True, 'libvirtd': False})
+        call.assert_not_called()
+        # enabling a unit is not a job
+        host.service('enable', 'iscsid')
+        call.assert_called_once_with(['systemctl', 'enable', 'iscsid'])
+
+    @patch.object(systemd, 'log')
+    @patch.object(host, 'init_is_systemd', return_value=True)
+    @patch('subprocess.call')
+    def test_host_service_fallback(self, call, init_is_systemd, log):
+        self.local.close()
+        self.client.close()
+        call.return_value = 0
+        self.assertTrue(host.service_restart('nova-compute'))
+        call.assert_called_once_with(
+            ['systemctl', 'restart', 'nova-compute'])
+        self.assertIsNone(systemd.client())
+
+    @patch.object(systemd, 'log')
+    @patch.object(host, 'init_is_systemd', return_value=True)
+    @patch('subprocess.call')
+    def test_host_service_job_not_completed(self, call, init_is_systemd,
+                                            log):
+        self.local.results['nova-compute.service'] = None
+        self.client.connection.sock.settimeout(0.2)
+        self.assertFalse(host.service_restart('nova-compute'))
+        # the job was queued, it is not run a second time with systemctl
+        call.assert_not_called()
+        self.assertEqual(
+            [c[0] for c in self.local.calls].count('RestartUnit'), 1)
+        self.assertIsNone(systemd.client())
+
+    @patch.object(systemd, 'log')
+    def test_client_unreachable(self, log):
+        systemd.set_client(None)
+        with patch.object(systemd, 'SYSTEMD_PRIVATE_SOCKET',
+                          self.local.path + '.missing'):
+            self.assertIsNone(systemd.client())
+        self.assertIsNone(systemd.active_states(['nova-compute']))
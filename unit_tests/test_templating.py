@@ -0,0 +1,177 @@
+# Copyright 2024 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from charmhelpers.contrib.openstack import templating
+
+
+class WriteIfChangedTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, 'nova.conf')
+
+    def read(self, path=None):
+        with open(path or self.path, 'rb') as f:
+            return f.read()
+
+    def test_new_file(self):
+        self.assertTrue(templating._write_if_changed(self.path, b'a'))
+        self.assertEqual(self.read(), b'a')
+        self.assertEqual(os.listdir(self.tmp), ['nova.conf'])
+
+    def test_unchanged(self):
+        templating._write_if_changed(self.path, b'a')
+        inode = os.stat(self.path).st_ino
+        self.assertFalse(templating._write_if_changed(self.path, b'a'))
+        self.assertEqual(os.stat(self.path).st_ino, inode)
+
+    def test_changed_keeps_mode(self):
+        templating._write_if_changed(self.path, b'a')
+        os.chmod(self.path, 0o640)
+        inode = os.stat(self.path).st_ino
+        self.assertTrue(templating._write_if_changed(self.path, b'b'))
+        st = os.stat(self.path)
+        self.assertEqual(self.read(), b'b')
+        self.assertEqual(stat.S_IMODE(st.st_mode), 0o640)
+        # replaced with a rename, not rewritten in place
+        self.assertNotEqual(st.st_ino, inode)
+
+    @unittest.skipUnless(os.geteuid() == 0, 'changing owner requires root')
+    def test_changed_keeps_owner(self):
+        templating._write_if_changed(self.path, b'a')
+        os.chown(self.path, 1234, 4321)
+        templating._write_if_changed(self.path, b'b')
+        st = os.stat(self.path)
+        self.assertEqual((st.st_uid, st.st_gid), (1234, 4321))
+
+    def test_follows_symlink(self):
+        target = os.path.join(self.tmp, 'target.conf')
+        templating._write_if_changed(target, b'a')
+        os.symlink(target, self.path)
+        self.assertTrue(templating._write_if_changed(self.path, b'b'))
+        self.assertTrue(os.path.islink(self.path))
+        self.assertEqual(self.read(target), b'b')
+
+    def test_failure_keeps_original(self):
+        templating._write_if_changed(self.path, b'a')
+        with patch.object(templating.os, 'rename',
+                          side_effect=OSError('rename')):
+            with self.assertRaises(OSError):
+                templating._write_if_changed(self.path, b'b')
+        self.assertEqual(self.read(), b'a')
+        self.assertEqual(os.listdir(self.tmp), ['nova.conf'])
+
+
+class FakeContext(object):
+
+    interfaces = ['amqp']
+
+    def __init__(self, name, value=None):
+        self.name = name
+        self.value = value
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        self.complete = self.value is not None
+        return {self.name: self.value} if self.complete else {}
+
+
+class ContextCacheTests(unittest.TestCase):
+
+    def test_equivalent_instances_share_result(self):
+        cache = templating.ContextCache()
+        first, second = FakeContext('a', 1), FakeContext('a', 1)
+        self.assertEqual(cache(first), {'a': 1})
+        self.assertEqual(cache(second), {'a': 1})
+        self.assertEqual((first.calls, second.calls), (1, 0))
+        # the state of the evaluation is copied onto the cached instance
+        self.assertTrue(second.complete)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_different_arguments(self):
+        cache = templating.ContextCache()
+        self.assertEqual(cache(FakeContext('a', 1)), {'a': 1})
+        self.assertEqual(cache(FakeContext('a', 2)), {'a': 2})
+        self.assertEqual(cache(FakeContext('b', 1)), {'b': 1})
+        self.assertEqual((cache.hits, cache.misses), (0, 3))
+
+    def test_state_is_not_part_of_key(self):
+        cache = templating.ContextCache()
+        context = FakeContext('a', 1)
+        cache(context)
+        self.assertEqual(cache(FakeContext('a', 1)), {'a': 1})
+        self.assertEqual(cache(context), {'a': 1})
+        self.assertEqual(context.calls, 1)
+
+    def test_functions_keyed_on_identity(self):
+        def one():
+            return {'one': 1}
+
+        def other():
+            return {'one': 2}
+
+        cache = templating.ContextCache()
+        self.assertEqual(cache(one), {'one': 1})
+        self.assertEqual(cache(other), {'one': 2})
+        self.assertEqual(cache(one), {'one': 1})
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_result_is_a_copy(self):
+        cache = templating.ContextCache()
+        cache(FakeContext('a', 1))['a'] = 2
+        self.assertEqual(cache(FakeContext('a', 1)), {'a': 1})
+
+    def test_write_all_evaluates_once(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        shared = FakeContext('a', 1)
+        with patch.object(templating, 'log'):
+            renderer = templating.OSConfigRenderer(tmp, 'yoga')
+            for name in ('one.conf', 'two.conf'):
+                renderer.register(os.path.join(tmp, name),
+                                  [shared, FakeContext('a', 1)],
+                                  config_template='{{ a }}')
+            renderer.write_all()
+        for name in ('one.conf', 'two.conf'):
+            with open(os.path.join(tmp, name)) as f:
+                self.assertEqual(f.read(), '1')
+        self.assertEqual(shared.calls, 1)
+        self.assertEqual((renderer.last_context_cache.hits,
+                          renderer.last_context_cache.misses), (3, 1))
+
+    @patch.object(templating, 'prefetch_relations')
+    def test_write_all_prefetches_relations(self, prefetch_relations):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        ceph = FakeContext('b', 2)
+        ceph.interfaces = ['ceph', 'amqp']
+        with patch.object(templating, 'log'):
+            renderer = templating.OSConfigRenderer(tmp, 'yoga')
+            renderer.register(os.path.join(tmp, 'one.conf'),
+                              [FakeContext('a', 1), ceph, lambda: {}],
+                              config_template='{{ a }}')
+            renderer.write_all()
+            prefetch_relations.assert_not_called()
+            renderer.prefetch_relations = True
+            renderer.write_all()
+        prefetch_relations.assert_called_once_with(['amqp', 'ceph'])
@@ -0,0 +1,152 @@
+# Copyright 2024 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from charmhelpers.core import unitdata
+
+
+class HookTransactionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, 'unit-state.db')
+        self.kv = unitdata.Storage(self.path)
+        self.addCleanup(self.kv.close)
+        self.kv.set('kept', 1)
+        self.kv.set('removed', 1)
+        self.kv.flush()
+
+    def stored(self):
+        """The values another process would read."""
+        other = unitdata.Storage(self.path)
+        try:
+            return other.getrange('')
+        finally:
+            other.close()
+
+    def test_commit(self):
+        with self.kv.hook_transaction():
+            self.kv.set('a', 1)
+            self.kv.unset('removed')
+            self.kv.flush()
+            self.kv.set('b', [2])
+            self.assertEqual(self.kv.get('b'), [2])
+            self.assertIsNone(self.kv.get('removed'))
+            self.assertEqual(self.kv.getrange(''),
+                             {'a': 1, 'b': [2], 'kept': 1})
+            # nothing is written out before the end of the transaction
+            self.assertEqual(self.stored(), {'kept': 1, 'removed': 1})
+        self.assertEqual(self.stored(), {'a': 1, 'b': [2], 'kept': 1})
+
+    def test_rollback(self):
+        with self.assertRaises(ValueError):
+            with self.kv.hook_transaction():
+                self.kv.set('a', 1)
+                self.kv.flush()
+                self.kv.set('b', 2)
+                self.kv.unset('kept')
+                raise ValueError()
+        # modifications flushed before the error are written out
+        self.assertEqual(self.stored(), {'a': 1, 'kept': 1, 'removed': 1})
+
+    def test_successful_exit(self):
+        for code in (0, None):
+            with self.assertRaises(SystemExit):
+                with self.kv.hook_transaction():
+                    self.kv.set('exit', code)
+                    raise SystemExit(code)
+            self.assertIn('exit', self.stored())
+            self.assertEqual(self.stored()['exit'], code)
+
+    def test_failed_exit(self):
+        with self.assertRaises(SystemExit):
+            with self.kv.hook_transaction():
+                self.kv.set('a', 1)
+                raise SystemExit(1)
+        self.assertNotIn('a', self.stored())
+
+    def test_nested(self):
+        with self.kv.hook_transaction():
+            with self.kv.hook_transaction():
+                self.kv.set('a', 1)
+            self.assertNotIn('a', self.stored())
+        self.assertIn('a', self.stored())
+
+
+class PreloadTests(unittest.TestCase):
+
+    KEYS = {'rel.a': 1, 'rel.b': 2, 'rel_c': 3, 'relation': 4, 'r': 5,
+            'unit.a': 6}
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, 'unit-state.db')
+        kv = unitdata.Storage(self.path)
+        kv.update(self.KEYS)
+        kv.flush()
+        kv.close()
+        self.kv = unitdata.Storage(self.path, preload=True)
+        self.addCleanup(self.kv.close)
+
+    def test_getrange(self):
+        self.assertEqual(self.kv.getrange('rel.'), {'rel.a': 1, 'rel.b': 2})
+        self.assertEqual(self.kv.getrange('rel', strip=True),
+                         {'.a': 1, '.b': 2, '_c': 3, 'ation': 4})
+        self.assertEqual(self.kv.getrange('unit.a'), {'unit.a': 6})
+        self.assertEqual(self.kv.getrange('z'), {})
+        self.assertEqual(self.kv.getrange(''), self.KEYS)
+
+    def test_same_as_without_preload(self):
+        kv = unitdata.Storage(self.path)
+        self.addCleanup(kv.close)
+        for prefix in ('', 'r', 'rel', 'rel.', 'rel_', 'unit', 'x'):
+            self.assertEqual(self.kv.getrange(prefix), kv.getrange(prefix))
+
+    def test_modifications(self):
+        self.kv.set('rel.aa', 7)
+        self.kv.unset('rel.b')
+        self.assertEqual(self.kv.getrange('rel.'), {'rel.a': 1, 'rel.aa': 7})
+        self.kv.unsetrange(prefix='rel')
+        self.assertEqual(self.kv.getrange(''), {'r': 5, 'unit.a': 6})
+        self.kv.unsetrange(['a'], prefix='unit.')
+        self.assertEqual(self.kv.getrange(''), {'r': 5})
+        self.kv.flush(False)
+        self.assertEqual(self.kv.getrange(''), self.KEYS)
+
+    def test_changes_from_other_connections(self):
+        self.assertEqual(self.kv.get('rel.a'), 1)
+        other = unitdata.Storage(self.path)
+        other.set('rel.a', 10)
+        other.set('rel.d', 11)
+        other.flush()
+        other.close()
+        self.assertEqual(self.kv.get('rel.a'), 10)
+        self.assertEqual(self.kv.getrange('rel.'),
+                         {'rel.a': 10, 'rel.b': 2, 'rel.d': 11})
+        # a write of the value read before is not skipped
+        other = unitdata.Storage(self.path)
+        other.set('rel.a', 1)
+        other.flush()
+        other.close()
+        self.kv.set('rel.a', 10)
+        self.kv.flush()
+        other = unitdata.Storage(self.path)
+        self.addCleanup(other.close)
+        self.assertEqual(other.get('rel.a'), 10)
@@ -135,6 +135,9 @@ class TestKV(dict):
     def set(self, attribute, value):
         self.data[attribute] = value
 
+    def unset(self, attribute):
+        self.data.pop(attribute, None)
+
     def flush(self):
         self.flushed = True
 